@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+#
+# Microbenchmarks for the bTCP implementation.
+#
+#   python3 benchmark.py codec -o codec.json
+#   python3 benchmark.py codec --compare codec.json
+#   python3 benchmark.py send
+#   python3 benchmark.py latency
+#   python3 benchmark.py send --filter transport
+#
+# Results are written as JSON so they can be kept around and compared across
+# commits; --compare exits with status 1 if any operation got slower than the
+# given threshold.
+
+import argparse
+import functools
+import json
+import logging
+import multiprocessing
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import timeit
+
+from btcp import checksum, shm_transport
+from btcp.btcp_socket import BTCPSocket
+from btcp.constants import *
+from btcp.lossy_layer import LossyLayer
+from btcp.segment import AckTemplate, SegmentEncoder, SegmentView
+from btcp.shm_transport import SharedMemoryLossyLayer
+from btcp.transports import TRANSPORTS
+from btcp.unix_transport import UnixLossyLayer
+
+
+logger = logging.getLogger(__name__)
+
+PAYLOAD_LENGTHS = (0, 64, 512, PAYLOAD_SIZE)
+BUFFER_TYPES = {
+    "bytes": bytes,
+    "bytearray": bytearray,
+    "memoryview": memoryview,
+}
+BATCH_SIZE = 64
+
+
+def measure(func, min_time, repeat=3):
+    """Return the best time per call of func in nanoseconds, timing loops of
+    at least min_time seconds."""
+    timer = timeit.Timer(func)
+    number = 1
+    while (elapsed := timer.timeit(number)) < min_time:
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9)))
+    times = timer.repeat(repeat=repeat - 1, number=number) + [elapsed]
+    return min(times) / number * 1e9
+
+
+def make_segment(datalen, rng):
+    payload = rng.randbytes(datalen)
+    return bytes(SegmentEncoder().encode(rng.randrange(0x10000),
+                                         rng.randrange(0x10000),
+                                         ack_set=True, window=100,
+                                         payload=payload))
+
+
+def codec_cases(rng):
+    """Yield (operation, parameters, function) for every codec benchmark."""
+    for datalen in PAYLOAD_LENGTHS:
+        segment = make_segment(datalen, rng)
+        payload = segment[HEADER_SIZE:HEADER_SIZE + datalen]
+
+        yield ("build_segment_header", dict(payload_len=datalen),
+               functools.partial(BTCPSocket.build_segment_header, 1, 2,
+                                 ack_set=True, window=100, length=datalen))
+        encoder = SegmentEncoder()
+        yield ("SegmentEncoder.encode", dict(payload_len=datalen),
+               functools.partial(encoder.encode, 1, 2, ack_set=True,
+                                 window=100, payload=payload))
+
+        if datalen == 0:
+            yield ("AckTemplate.encode", dict(payload_len=datalen),
+                   functools.partial(AckTemplate().encode, 1, 2, window=100))
+
+        for buffer_type, convert in BUFFER_TYPES.items():
+            buf = convert(segment)
+            params = dict(payload_len=datalen, buffer=buffer_type)
+            header = buf[:HEADER_SIZE]
+            yield ("unpack_segment_header", params,
+                   functools.partial(BTCPSocket.unpack_segment_header, header))
+            yield ("SegmentView", params,
+                   lambda buf=buf: SegmentView(buf).payload)
+
+            for backend in checksum.BACKENDS:
+                cksum_func = checksum.get_backend(backend)
+                params = dict(payload_len=datalen, buffer=buffer_type,
+                              backend=backend)
+                yield ("in_cksum", params, functools.partial(cksum_func, buf))
+                yield ("verify_checksum", params,
+                       functools.partial(checksum.verify, cksum_func, buf))
+
+        batch = [segment] * BATCH_SIZE
+        for backend in checksum.BACKENDS:
+            cksum_func = checksum.get_backend(backend)
+            yield ("verify_batch", dict(payload_len=datalen, backend=backend,
+                                        batch=BATCH_SIZE),
+                   functools.partial(checksum.verify_batch, batch, cksum_func))
+
+
+class NullSocket:
+    """Stands in for a bTCP socket on top of a LossyLayer."""
+
+    def lossy_layer_segment_received(self, segment):
+        pass
+
+    def lossy_layer_segments_received(self, segments):
+        pass
+
+    def lossy_layer_tick(self):
+        pass
+
+
+def send_cases(rng):
+    """Yield (operation, parameters, function) for every send benchmark.
+
+    Segments go to a socket on loopback that never reads them; once its
+    receive buffer is full the kernel drops them, which costs the sender
+    nothing extra.
+    """
+    segment = make_segment(PAYLOAD_SIZE, rng)
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    port = sink.getsockname()[1]
+    unconnected = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    connected = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    connected.connect(("127.0.0.1", port))
+    lossy_layer = LossyLayer(NullSocket(), "127.0.0.1", 0, "localhost", port)
+    lossy_layer.start_network_thread()
+    transmit_layer = LossyLayer(NullSocket(), "127.0.0.1", 0, "localhost", port,
+                                transmit_thread=True)
+    transmit_layer.start_network_thread()
+    # A peer that drains its ring as fast as it can, in the same process.
+    # Segments that find the ring full are dropped, which is cheaper than
+    # copying them in, so batches measure an upper bound.
+    shm_layers = []
+    if shm_transport.SUPPORTED:
+        shm_layers = [SharedMemoryLossyLayer(NullSocket(), "127.0.0.1", port,
+                                             "127.0.0.1", port + 1),
+                      SharedMemoryLossyLayer(NullSocket(), "127.0.0.1", port + 1,
+                                             "127.0.0.1", port)]
+    for layer in shm_layers:
+        layer.start_network_thread()
+    # UDP over loopback against AF_UNIX datagrams, each to a peer in this
+    # process that reads them as fast as it can. Where it can not keep up,
+    # UDP drops at the receiver and AF_UNIX at the sender, before copying;
+    # the statistics of both sides are logged at INFO level to tell.
+    pairs = {}
+    for transport in (LossyLayer, UnixLossyLayer):
+        pairs[transport] = [transport(NullSocket(), "127.0.0.1", 41010,
+                                      "127.0.0.1", 41011),
+                            transport(NullSocket(), "127.0.0.1", 41011,
+                                      "127.0.0.1", 41010)]
+        for layer in pairs[transport]:
+            layer.start_network_thread()
+    try:
+        # What BottomHandler used to do for every segment.
+        yield ("sendto", dict(address="hostname"),
+               functools.partial(unconnected.sendto, segment, ("localhost", port)))
+        yield ("sendto", dict(address="resolved"),
+               functools.partial(unconnected.sendto, segment, ("127.0.0.1", port)))
+        yield ("send", dict(address="connected"),
+               functools.partial(connected.send, segment))
+        yield ("LossyLayer.send_segment", dict(),
+               functools.partial(lossy_layer.send_segment, segment))
+        yield ("LossyLayer.send_segments", dict(batch=BATCH_SIZE),
+               functools.partial(lossy_layer.send_segments, [segment] * BATCH_SIZE))
+        # Until the transmit thread sent them, so this is its throughput; the
+        # application thread is done after queueing.
+        yield ("LossyLayer.send_segment", dict(transmit_thread=True),
+               functools.partial(send_flushed, transmit_layer, [segment]))
+        yield ("LossyLayer.send_segments", dict(transmit_thread=True,
+                                                batch=BATCH_SIZE),
+               functools.partial(send_flushed, transmit_layer,
+                                 [segment] * BATCH_SIZE))
+        for transport, layers in pairs.items():
+            yield (f"{transport.__name__}.send_segments",
+                   dict(batch=BATCH_SIZE, peer="reading"),
+                   functools.partial(layers[0].send_segments,
+                                     [segment] * BATCH_SIZE))
+        if shm_layers:
+            yield ("SharedMemoryLossyLayer.send_segment", dict(),
+                   functools.partial(shm_layers[0].send_segment, segment))
+            yield ("SharedMemoryLossyLayer.send_segments", dict(batch=BATCH_SIZE),
+                   functools.partial(shm_layers[0].send_segments,
+                                     [segment] * BATCH_SIZE))
+    finally:
+        lossy_layer.destroy()
+        logger.info("transmit thread %s", transmit_layer.statistics()["transmit"])
+        transmit_layer.destroy()
+        for transport, layers in pairs.items():
+            logger.info("%s sender %s, receiver %s", transport.__name__,
+                        layers[0].statistics(), layers[1].statistics())
+            for layer in layers:
+                layer.destroy()
+        for layer in shm_layers:
+            layer.destroy()
+        for sock in (sink, unconnected, connected):
+            sock.close()
+
+
+def send_flushed(lossy_layer, segments):
+    """Send segments through lossy_layer's transmit thread, and wait until it
+    sent them."""
+    transmitter = lossy_layer.transmitter
+    lossy_layer.send_segments(segments)
+    while transmitter.sent + transmitter.dropped < transmitter.queued:
+        # Spinning would hold on to the GIL.
+        time.sleep(0)
+
+
+class EchoSocket(NullSocket):
+    """Sends every segment it receives straight back."""
+
+    def __init__(self):
+        self.lossy_layer = None
+
+    def lossy_layer_segment_received(self, segment):
+        self.lossy_layer.send_segment(segment)
+
+    def lossy_layer_segments_received(self, segments):
+        self.lossy_layer.send_segments(segments)
+
+
+class PongSocket(NullSocket):
+    """Signals every segment it receives."""
+
+    def __init__(self):
+        self.received = threading.Event()
+
+    def lossy_layer_segment_received(self, segment):
+        self.received.set()
+
+    def lossy_layer_segments_received(self, segments):
+        self.received.set()
+
+
+def run_echo(port, stop, transport, **layer_kwargs):
+    echo = EchoSocket()
+    echo.lossy_layer = TRANSPORTS[transport](echo, "127.0.0.1", port,
+                                             "127.0.0.1", port + 1,
+                                             **layer_kwargs)
+    echo.lossy_layer.start_network_thread()
+    stop.wait()
+    echo.lossy_layer.destroy()
+
+
+def ping(lossy_layer, pong, segment):
+    pong.received.clear()
+    lossy_layer.send_segment(segment)
+    pong.received.wait()
+
+
+def latency_cases(rng):
+    """Yield (operation, parameters, function) for every latency benchmark:
+    the round trip of one segment to an echoing lossy layer in another
+    process, with busy polling off, measuring only, and spinning, with
+    transmit threads on both sides, and over AF_UNIX instead of UDP.
+
+    The histograms of the busy polling modes and the transmit threads are
+    logged at INFO level. Spinning only pays off with a CPU core to spare for
+    each side.
+    """
+    segment = make_segment(64, rng)
+    port = 41000
+    for transport, layer_kwargs in (("udp", dict(busy_poll=None)),
+                                    ("udp", dict(busy_poll=0)),
+                                    ("udp", dict(busy_poll=50)),
+                                    ("udp", dict(transmit_thread=True)),
+                                    ("unix", dict())):
+        stop = multiprocessing.Event()
+        echo = multiprocessing.Process(target=run_echo,
+                                       args=(port, stop, transport),
+                                       kwargs=layer_kwargs)
+        echo.start()
+        pong = PongSocket()
+        lossy_layer = TRANSPORTS[transport](pong, "127.0.0.1", port + 1,
+                                            "127.0.0.1", port, **layer_kwargs)
+        lossy_layer.start_network_thread()
+        try:
+            # Wait for the echo side to come up.
+            while not pong.received.is_set():
+                lossy_layer.send_segment(segment)
+                pong.received.wait(0.01)
+            params = dict(busy_poll_us=layer_kwargs.get("busy_poll"))
+            if "transmit_thread" in layer_kwargs:
+                params.update(transmit_thread=True)
+            if transport != "udp":
+                params.update(transport=transport)
+            yield ("round_trip", params,
+                   functools.partial(ping, lossy_layer, pong, segment))
+            if lossy_layer.busy_poll is not None:
+                logger.info("busy poll %s", lossy_layer.busy_poll.summary())
+            if lossy_layer.transmitter is not None:
+                logger.info("transmit thread %s",
+                            lossy_layer.transmitter.summary())
+        finally:
+            lossy_layer.destroy()
+            stop.set()
+            echo.join()
+
+
+SUITES = {
+    "codec": codec_cases,
+    "send": send_cases,
+    "latency": latency_cases,
+}
+
+
+def run_suite(args):
+    rng = random.Random(0)
+    results = []
+    for operation, params, func in SUITES[args.suite](rng):
+        if args.filter and args.filter not in operation:
+            continue
+        ns = measure(func, args.min_time)
+        if "batch" in params:
+            ns /= params["batch"]
+        result = dict(operation=operation, **params,
+                      ns_per_segment=round(ns, 1),
+                      segments_per_s=round(1e9 / ns))
+        logger.info("%s", result)
+        results.append(result)
+    return results
+
+
+def result_key(result):
+    return tuple(sorted((k, v) for k, v in result.items()
+                        if k not in ("ns_per_segment", "segments_per_s")))
+
+
+def compare(results, baseline, threshold):
+    """Print the change per operation against baseline results and return
+    the number of regressions beyond threshold (a fraction)."""
+    old = {result_key(r): r["ns_per_segment"] for r in baseline["results"]}
+    regressions = 0
+    for result in results:
+        before = old.get(result_key(result))
+        if before is None:
+            continue
+        change = result["ns_per_segment"] / before - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        params = " ".join(f"{k}={v}" for k, v in result_key(result)
+                          if k != "operation")
+        print(f"{result['operation']:<22} {params:<50} "
+              f"{before:>10.1f} -> {result['ns_per_segment']:>10.1f} ns "
+              f"({change:+.1%}){flag}")
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bTCP microbenchmarks")
+    parser.add_argument("-l", "--loglevel",
+                        choices=["DEBUG", "INFO", "WARNING",
+                                 "ERROR", "CRITICAL"],
+                        help="Log level "
+                             "for the python built-in logging module. ",
+                        default="WARNING")
+    parser.add_argument("-o", "--output",
+                        help="Write the results as JSON to this file")
+    parser.add_argument("-c", "--compare",
+                        help="Compare against results of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="Slowdown (fraction) reported as a regression")
+    parser.add_argument("--min-time", type=float, default=0.05,
+                        help="Minimum time in seconds per timing loop")
+    parser.add_argument("-f", "--filter",
+                        help="Only run operations containing this string")
+    parser.add_argument("suite", choices=sorted(SUITES),
+                        help="Which benchmark suite to run")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper()),
+                        format="%(asctime)s:%(name)s:%(levelname)s:%(message)s")
+
+    results = run_suite(args)
+    report = dict(suite=args.suite,
+                  revision=git_revision(),
+                  python=platform.python_version(),
+                  platform=platform.platform(),
+                  results=results)
+
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(report, outfile, indent=1)
+    else:
+        for result in results:
+            print(json.dumps(result))
+
+    if args.compare:
+        with open(args.compare) as infile:
+            baseline = json.load(infile)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    logger = logging.getLogger("benchmark.py")
+    main()
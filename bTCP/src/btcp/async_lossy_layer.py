@@ -0,0 +1,157 @@
+"""A lossy layer that runs on an asyncio event loop.
+
+LossyLayer gives every bTCP socket its own network thread blocking in
+select. AsyncLossyLayer offers the same interface to the sockets, but is an
+asyncio.DatagramProtocol instead: segments are delivered from the event
+loop's datagram_received callback, lossy_layer_tick and the socket timers
+are event loop timers. Any number of sockets can share one event loop, and
+therefore one thread.
+
+Since everything happens in the event loop thread, the transport layer
+callbacks never run concurrently with the application's coroutines. The
+handler stack and effect() work exactly like they do for LossyLayer.
+"""
+
+import asyncio
+import logging
+import socket
+
+from btcp.constants import *
+from btcp.lossy_layer import LossyLayer, BottomHandler
+from btcp.timers import EventLoopTimerService
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncLossyLayer(LossyLayer, asyncio.DatagramProtocol):
+    """Lossy layer driven by the running asyncio event loop.
+
+    Must be created from a coroutine or callback of the event loop it is going
+    to use. The UDP socket is bound straight away, but only attached to the
+    event loop by start_network_thread (which, despite its name, starts no
+    thread); await opened() before relying on segments getting through.
+    """
+
+    def __init__(self, btcp_socket, local_ip, local_port, remote_ip, remote_port):
+        logger.info("AsyncLossyLayer.__init__() was called")
+        self._loop = asyncio.get_running_loop()
+        # The event loop reads the datagrams and does the ticking: no buffer
+        # pool, reactor or threads.
+        super().__init__(btcp_socket, local_ip, local_port, remote_ip, remote_port,
+                         pool_size=0, reactor=False, transmit_thread=False)
+        self._handler_stack = (AsyncBottomHandler(self),)
+
+        self._transport = None
+        self._opening = None
+        self._tick_handle = None
+        self._last_received = 0.0
+
+    def _create_timers(self):
+        """See LossyLayer._create_timers. The timers are event loop timers."""
+        return EventLoopTimerService(self._loop)
+
+    def start_network_thread(self):
+        """Attach the UDP socket to the event loop and start ticking."""
+        logger.info("Attaching lossy layer to the event loop")
+        self._opening = self._loop.create_task(
+            self._loop.create_datagram_endpoint(lambda: self,
+                                                sock=self._udp_socket))
+        self._last_received = self._loop.time()
+        self._tick_handle = self._loop.call_later(TIMER_TICK / 1000, self._tick)
+
+    async def opened(self):
+        """Wait until the UDP socket is attached to the event loop."""
+        await self._opening
+
+    def connection_made(self, transport):
+        self._transport = transport
+        logger.info("Lossy layer initialized, listening on "
+                    "local address %s & port %i, "
+                    "remote address %s & port %i",
+                    self._local_ip,
+                    self._local_port,
+                    self._remote_ip,
+                    self._remote_port)
+
+    def datagram_received(self, data, address):
+        self._last_received = self._loop.time()
+        # There is no buffer pool here: data is a fresh bytes object that the
+        # handlers may keep.
+        self._handler_stack[-1].segment_received(data)
+
+    def error_received(self, exc):
+        # E.g. ICMP port unreachable while the peer is not up yet; just like
+        # lost segments, that is for bTCP's retransmissions to deal with.
+        logger.debug("Lossy layer error: %s", exc)
+
+    def _tick(self):
+        """Call lossy_layer_tick once no segment arrived for TIMER_TICK ms."""
+        tick = TIMER_TICK / 1000
+        now = self._loop.time()
+        if now - self._last_received >= tick:
+            self._handler_stack[-1].tick()
+            self._last_received = now
+        self._tick_handle = self._loop.call_at(self._last_received + tick,
+                                               self._tick)
+
+    def statistics(self):
+        """See LossyLayer.statistics. The event loop reads the datagrams, so
+        kernel drops are not counted."""
+        stats = dict(kernel_drops=None, receive_buffer=None, send_buffer=None)
+        if self._udp_socket is not None:
+            stats.update(
+                receive_buffer=self._udp_socket.getsockopt(socket.SOL_SOCKET,
+                                                           socket.SO_RCVBUF),
+                send_buffer=self._udp_socket.getsockopt(socket.SOL_SOCKET,
+                                                        socket.SO_SNDBUF))
+        return stats
+
+    def wakeup(self):
+        """See LossyLayer.wakeup. Safe to call from any thread."""
+        self._loop.call_soon_threadsafe(self._tick_now)
+
+    def _tick_now(self):
+        if self._transport is not None:
+            self._handler_stack[-1].tick()
+
+    def destroy(self):
+        """Detach from the event loop and close the UDP socket.
+
+        Safe to call multiple times, so safe to call from __del__.
+        """
+        logger.info("AsyncLossyLayer.destroy() called.")
+        if self._tick_handle is not None:
+            self._tick_handle.cancel()
+            self._tick_handle = None
+        if self._opening is not None and not self._opening.done():
+            self._opening.cancel()
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        elif self._udp_socket is not None:
+            self._udp_socket.close()
+        self._udp_socket = None
+
+
+class AsyncBottomHandler(BottomHandler):
+    """Bottom handler that sends through the asyncio datagram transport.
+
+    The transport copies segments it can not send right away, so segments
+    passed in only have to stay valid for the duration of the call.
+    """
+
+    def send_segment(self, segment):
+        transport = self._lossy_layer._transport
+        if transport is None:
+            # Not attached (yet or anymore): as good as lost in the network.
+            return
+        transport.sendto(segment)
+
+    def send_segments(self, segments):
+        transport = self._lossy_layer._transport
+        if transport is None:
+            return
+        sendto = transport.sendto
+        for segment in segments:
+            sendto(segment)
@@ -0,0 +1,138 @@
+"""bTCP sockets with an asyncio API.
+
+AsyncBTCPClientSocket and AsyncBTCPServerSocket run the same state machine
+and segment codec as BTCPClientSocket and BTCPServerSocket, on an
+AsyncLossyLayer instead of a network thread. The application side is a set
+of coroutines:
+
+    async def client():
+        c = AsyncBTCPClientSocket(window, timeout)
+        await c.connect()
+        await c.send(data)
+        await c.shutdown()
+        c.close()
+
+    async def server():
+        s = AsyncBTCPServerSocket(window, timeout)
+        await s.accept()
+        data = await s.recv()
+        s.close()
+
+Sockets must be created inside a running event loop. Instead of polling the
+state from another thread, the coroutines wait on an asyncio.Event that is
+set whenever a segment was handled or the state changed.
+"""
+
+import asyncio
+import logging
+import queue
+
+from btcp.async_lossy_layer import AsyncLossyLayer
+from btcp.btcp_socket import BTCPStates
+from btcp.client_socket import BTCPClientSocket
+from btcp.server_socket import BTCPServerSocket
+
+
+logger = logging.getLogger(__name__)
+
+
+class _AsyncSocketMixin:
+    """Wakes up the coroutines waiting for the transport layer."""
+
+    _lossy_layer_class = AsyncLossyLayer
+
+    def _set_state(self, state):
+        super()._set_state(state)
+        self._changed.set()
+
+    def lossy_layer_segment_received(self, segment):
+        super().lossy_layer_segment_received(segment)
+        self._changed.set()
+
+    def lossy_layer_segments_received(self, segments):
+        super().lossy_layer_segments_received(segments)
+        self._changed.set()
+
+    async def _wait_until(self, predicate):
+        """Wait until predicate() is true, checking it again every time the
+        transport layer handled a segment or changed state."""
+        await self._lossy_layer.opened()
+        while not predicate():
+            self._changed.clear()
+            await self._changed.wait()
+
+
+class AsyncBTCPClientSocket(_AsyncSocketMixin, BTCPClientSocket):
+    """bTCP client socket for asyncio applications, see the module
+    docstring."""
+
+    def __init__(self, *args, **kwargs):
+        """Takes the same arguments as BTCPClientSocket."""
+        self._changed = asyncio.Event()
+        super().__init__(*args, **kwargs)
+
+    async def connect(self):
+        """Perform the three-way handshake, see BTCPClientSocket.connect."""
+        await self._lossy_layer.opened()
+        self._start_handshake()
+        await self._wait_until(lambda: self._state != BTCPStates.SYN_SENT)
+        logger.info("Connected, trusted-transport mode %s",
+                    "on" if self._skip_checksum else "off")
+
+    async def send(self, data):
+        """Queue data for sending and return the number of bytes queued, see
+        BTCPClientSocket.send.
+
+        As there is no other thread competing for the segments, they are put
+        into the network right away instead of on the next tick.
+        """
+        sent_bytes = self._queue_data(data)
+        self._transmit()
+        return sent_bytes
+
+    async def shutdown(self):
+        """Wait until all data sent so far has been acknowledged.
+
+        Like BTCPClientSocket.shutdown, this does not perform a termination
+        handshake (yet); the server notices the disconnect by timing out.
+        """
+        await self._wait_until(lambda: not self._unacked
+                               and self._sendbuf.empty())
+
+
+class AsyncBTCPServerSocket(_AsyncSocketMixin, BTCPServerSocket):
+    """bTCP server socket for asyncio applications, see the module
+    docstring."""
+
+    def __init__(self, *args, **kwargs):
+        """Takes the same arguments as BTCPServerSocket."""
+        self._changed = asyncio.Event()
+        super().__init__(*args, **kwargs)
+
+    async def accept(self):
+        """Wait for a client to connect, see BTCPServerSocket.accept."""
+        self._skip_checksum = False
+        self._set_state(BTCPStates.ACCEPTING)
+        await self._wait_until(lambda: self._state == BTCPStates.ESTABLISHED)
+        logger.info("Accepted, trusted-transport mode %s",
+                    "on" if self._skip_checksum else "off")
+
+    async def recv(self):
+        """Return all data received so far, waiting for some to arrive if
+        there is none. Like BTCPServerSocket.recv, returns b'' to signal a
+        disconnect once no data arrived for timeout seconds.
+        """
+        try:
+            await asyncio.wait_for(
+                self._wait_until(lambda: not self._recvbuf.empty()),
+                self.timeout_secs)
+        except asyncio.TimeoutError:
+            logger.info("No data received for %s seconds.", self.timeout_secs)
+            return b""
+        data = bytearray()
+        try:
+            while True:
+                data.extend(self._recvbuf.get_nowait())
+        except queue.Empty:
+            pass
+        return bytes(data)
@@ -1,8 +1,15 @@
 import struct
 import logging
 import random
+import functools
 from enum import IntEnum
 
+from btcp import checksum
+from btcp import tracing
+from btcp.tracing import TraceEvent
+from btcp.segment import (AckTemplate, CKSUM_OFFSET, HEADER_STRUCT, NOCKSUM_FLAG,
+                          SegmentEncoder)
+
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +35,7 @@ class BTCPStates(IntEnum):
     FIN_SENT    = 5
     CLOSING     = 6
     __          = 7 # If you need more states, extend the Enum like this.
+    ESTABLISHED = 8
 
 
 class BTCPSignals(IntEnum):
@@ -47,7 +55,8 @@ class BTCPSocket:
     """Base class for bTCP client and server sockets. Contains static helper
     methods that will definitely be useful for both sending and receiving side.
     """
-    def __init__(self, window, timeout, isn):
+    def __init__(self, window, timeout, isn, checksum_backend=None,
+                 trusted_transport=False):
         logger.debug("__init__ called")
         self._window = window
         self._timeout_secs = timeout
@@ -57,10 +66,58 @@ class BTCPSocket:
             isn = random.randint(0,0xffff)
         self._seqnum = isn
 
+        # Shadow the static checksum helpers if this socket should use another
+        # backend than the process-wide default, see btcp/checksum.py.
+        cksum_func = None
+        if checksum_backend is not None:
+            cksum_func = checksum.get_backend(checksum_backend)
+            self.in_cksum = cksum_func
+            self.verify_checksum = functools.partial(checksum.verify,
+                                                     cksum_func)
+            self.verify_checksums = functools.partial(checksum.verify_batch,
+                                                      cksum_func=cksum_func)
+
+        # Build the segments sent from the network and application thread
+        # respectively; encoders must not be shared between threads.
+        self._encoder = SegmentEncoder(cksum_func)
+        self._app_encoder = SegmentEncoder(cksum_func)
+        # Pure ACKs only ever go out from the network thread.
+        self._ack_template = AckTemplate()
+
+        # Trusted-transport mode: if both sides ask for it during the SYN
+        # exchange, and both lossy layers are trusted, segments are sent
+        # without checksum. _skip_checksum is the negotiated outcome.
+        self._trusted_transport = trusted_transport
+        self._skip_checksum = False
+
+        # The window the peer advertised during the SYN exchange.
+        self._peer_window = None
+
         #raise_NotImplementedError("Check btcp_socket.py's BTCPStates enum. We left out some states you will need.")
         logger.debug("Socket initialized with window %i and timeout %i secs and isn %i",
                      self._window, self._timeout_secs, isn)
 
+    def _set_state(self, state):
+        """Transition the state machine to state, tracing the transition."""
+        if tracing.enabled:
+            tracing.record(TraceEvent.STATE, self._state, state)
+        self._state = state
+
+    def _peer_window_received(self, window):
+        """Remember the window the peer advertised during the SYN exchange,
+        and size the kernel buffers of the lossy layer for both windows."""
+        self._peer_window = window
+        self._lossy_layer.size_buffers(self._window, window)
+
+    def statistics(self):
+        """Counters of the socket and its lossy layer, as a dict; see
+        LossyLayer.statistics for the latter."""
+        stats = dict(state=self._state.name,
+                     window=self._window,
+                     peer_window=self._peer_window)
+        stats.update(self._lossy_layer.statistics())
+        return stats
+
     @property
     def timeout_secs(self):
         return self._timeout_secs
@@ -80,22 +137,11 @@ class BTCPSocket:
         Remember that, when computing the checksum value before *sending* the
         segment, the checksum field in the header should be set to 0x0000, and
         then the resulting checksum should be put in its place.
-        """
-        
-        logger.debug("in_cksum() called")
-        checksum = 0
-
-        seg_copy = bytearray(segment)
-        seg_copy[8] = 0
-        seg_copy[9] = 0
 
-        for i in range(0, len(seg_copy), 2):
-            word = (seg_copy[i] << 8) + seg_copy[i+1]
-            checksum+=word
-            if checksum > 0xFFFF: checksum = (checksum & 0xFFFF)+1
-
-        checksum = (~checksum) & 0xFFFF
-        return checksum
+        The actual computation is done by the selected backend in
+        btcp/checksum.py; all backends give identical results.
+        """
+        return checksum.in_cksum(segment)
 
     @staticmethod
     def verify_checksum(segment):
@@ -104,10 +150,52 @@ class BTCPSocket:
         Mind that you change *what* signals that to the correct value(s),
         that is, be sure to change the "0xABCD" below.
         """
-        logger.debug("verify_cksum() called")
-        received = struct.unpack_from("!H", segment, 8)[0]
-        computed = BTCPSocket.in_cksum(segment)
-        return received == computed
+        return checksum.verify(checksum.in_cksum, segment)
+
+    @staticmethod
+    def verify_checksums(segments):
+        """Verify the checksums of a burst of segments in one pass.
+
+        Returns a list with a boolean for each segment, see
+        btcp.checksum.verify_batch.
+        """
+        return checksum.verify_batch(segments)
+
+
+    def _nocksum(self):
+        """Whether to send the next segment without computing its checksum."""
+        return self._skip_checksum and self._lossy_layer.trusted
+
+
+    def _checksum_ok(self, segment):
+        """Verify the checksum of a received segment, unless it was sent
+        without one in trusted-transport mode and our lossy layer is still
+        trusted; any effect handler makes us check every segment again.
+        """
+        if self._nocksum() and _sent_without_checksum(segment):
+            return True
+        return self.verify_checksum(segment)
+
+
+    def lossy_layer_segments_received(self, segments):
+        """Called by the lossy layer with a burst of segments that arrived
+        back-to-back.
+
+        All checksums are verified in one batch first, after which the valid
+        segments are passed to the state machine in order of arrival.
+        """
+        if self._nocksum():
+            checked = [segment for segment in segments
+                       if not _sent_without_checksum(segment)]
+        else:
+            checked = segments
+        valid = iter(self.verify_checksums(checked) if checked else ())
+        for segment in segments:
+            if (checked is not segments and _sent_without_checksum(segment)
+                    or next(valid)):
+                self._verified_segment_received(segment)
+            else:
+                logger.warning("Checksum failed - ignoring segment")
 
 
     @staticmethod
@@ -132,11 +220,9 @@ class BTCPSocket:
         you don't have to always set all flags explicitly true/false, or give
         a checksum of 0 when creating the header for checksum computation.
         """
-        logger.debug("build_segment_header() called")
         flag_byte = syn_set << 2 | ack_set << 1 | fin_set
-        logger.debug("build_segment_header() done")
-        return struct.pack("!HHBBHH",
-                           seqnum, acknum, flag_byte, window, length, checksum)
+        return HEADER_STRUCT.pack(seqnum, acknum, flag_byte, window, length,
+                                  checksum)
 
 
     @staticmethod
@@ -146,8 +232,10 @@ class BTCPSocket:
         Remember that Python supports multiple return values through automatic
         tupling, so it's easy to simply return all of them in one go rather
         than make a separate method for every individual field.
+
+        header may also be a complete segment. On the receive path, prefer
+        btcp.segment.SegmentView, which avoids the tuple and the copy.
         """
-        logger.debug("unpack_segment_header() called")
         # raise_NotImplementedError("No implementation of unpack_segment_header present. Read the comments & code of btcp_socket.py. You should really implement the packing / unpacking of the header into field values before doing anything else!")
         """
         struct.pack("!HHBBHH",
@@ -158,18 +246,25 @@ class BTCPSocket:
            length,      # Data Length (bytes 6-7)
            checksum)    # Checksum (bytes 8-9)
         """
-        seqnum, acknum, flag_byte, window, length, checksum = struct.unpack("!HHBBHH", header)
+        seqnum, acknum, flag_byte, window, length, checksum = HEADER_STRUCT.unpack_from(header)
 
         syn_set = (flag_byte >> 2) & 1  # Check bit 2
         ack_set = (flag_byte >> 1) & 1  # Check bit 1
         fin_set = flag_byte & 1          # Check bit 0
 
-        logger.debug(f"Unpacked: seq={seqnum}, ack={acknum}, syn_flag={syn_set}, ack_flag={ack_set}, fin_flag={fin_set}, window={window}, len={length}, cksum={checksum}")
         return seqnum, acknum, syn_set, ack_set, fin_set, window, length, checksum
         
 
 
 
+def _sent_without_checksum(segment):
+    """Whether segment was sent in trusted-transport mode: NOCKSUM_FLAG set
+    and the checksum field left 0. A corrupted flags byte alone does not
+    make a checksummed segment skip verification."""
+    return (segment[4] & NOCKSUM_FLAG
+            and not segment[CKSUM_OFFSET] and not segment[CKSUM_OFFSET + 1])
+
+
 # Ignore the following code;  we use this to test the bTCP project.
 __suppress_nie = False
 
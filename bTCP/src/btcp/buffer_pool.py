@@ -0,0 +1,97 @@
+"""Pool of preallocated receive buffers for the network thread.
+
+Ownership rules:
+    - The network thread acquires a buffer, fills it with recv_into and
+      lends it (or a slice of it, for short datagrams) to the handler stack
+      for the duration of one segment_received call.
+    - Handlers and the transport layer must not keep a reference to that
+      memoryview, nor to slices of it, once segment_received returns. Copy
+      whatever has to outlive the call with bytes(), e.g. payload handed to
+      the application thread.
+    - When segment_received returns, the network thread releases the buffer
+      back into the pool, and it will be overwritten by a later datagram.
+
+Handlers above the BottomHandler never see pool buffers: the lossy layer
+copies segments to bytes before passing them to effect handlers.
+
+In debug mode the pool checks these rules: every lent memoryview is
+released on return to the pool, so any later access through it raises
+ValueError; the buffer itself is filled with a poison pattern that is
+checked on the next acquire to catch writes after release; and releasing a
+buffer twice, or one that did not come from the pool, raises RuntimeError.
+Slices taken from a lent view can not be invalidated, but reading one after
+release yields the poison pattern instead of plausible data.
+"""
+
+import collections
+import logging
+
+from btcp.constants import *
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_POOL_SIZE = 64
+POISON = 0xDB
+
+
+class SegmentBufferPool:
+    """Fixed-size pool of SEGMENT_SIZE buffers, see the module docstring for
+    the ownership rules.
+
+    Not thread safe; only the network thread should use it. If the pool runs
+    dry a fresh buffer is allocated and counted in misses, buffers released
+    into a full pool are dropped.
+    """
+
+    def __init__(self, count=DEFAULT_POOL_SIZE, size=SEGMENT_SIZE, debug=False):
+        self._count = count
+        self._size = size
+        self._debug = debug
+        self._poison = bytes([POISON]) * size
+        # In debug mode the pool holds bare bytearrays and lends out a fresh
+        # memoryview each time, otherwise it holds and reuses memoryviews.
+        self._lent = set()
+        self._free = collections.deque(self._new_buffer() for _ in range(count))
+        self.misses = 0
+
+    def _new_buffer(self):
+        if self._debug:
+            return bytearray(self._poison)
+        return memoryview(bytearray(self._size))
+
+    def acquire(self):
+        """Take a buffer out of the pool, as a writable memoryview."""
+        try:
+            buf = self._free.pop()
+        except IndexError:
+            self.misses += 1
+            buf = self._new_buffer()
+        if self._debug:
+            if buf != self._poison:
+                raise RuntimeError("Segment buffer was written to after it "
+                                   "was released to the pool")
+            self._lent.add(id(buf))
+            buf = memoryview(buf)
+        return buf
+
+    def release(self, buf):
+        """Return a buffer obtained from acquire to the pool."""
+        if self._debug:
+            try:
+                data = buf.obj
+            except ValueError:
+                raise RuntimeError("Segment buffer released twice") from None
+            if id(data) not in self._lent:
+                raise RuntimeError("Segment buffer does not belong to this pool")
+            try:
+                buf.release()
+            except BufferError:
+                raise RuntimeError("Segment buffer released while it is "
+                                   "still being used") from None
+            self._lent.remove(id(data))
+            data[:] = self._poison
+            buf = data
+        if len(self._free) < self._count:
+            self._free.append(buf)
@@ -0,0 +1,114 @@
+"""Adaptive busy polling for the network thread.
+
+Blocking in select costs a scheduler wakeup for every segment that arrives
+while the network thread sleeps, tens of microseconds that dominate the
+round trip of small request/response exchanges on loopback. With busy
+polling enabled the network thread first spins on non-blocking reads for up
+to a budget of time, and only blocks in select when nothing arrived by then:
+
+    LossyLayer(..., busy_poll=50)     # spin up to 50 us
+    BTCP_BUSY_POLL=50 python3 client_app.py
+
+Spinning burns a CPU core and holds the GIL in between reads, which is only
+worth it if the next segment is likely to arrive within the budget. So the
+budget adapts: it is twice the moving average of the time between bursts,
+capped at the configured maximum, and zero (block right away) while that
+average exceeds the maximum. Gaps count as at most four times the maximum in
+the average, so spinning resumes soon after traffic picks up again.
+
+BusyPoll records histograms of the gaps between bursts and of how long a
+successful spin took, next to the number of spins that hit and missed. With
+a maximum of 0 it never spins but still records, to compare against.
+"""
+
+# Weight of a new gap in the moving average, as a shift: 1/8.
+_EWMA_SHIFT = 3
+
+
+class LatencyHistogram:
+    """Counts of durations in nanoseconds, in power-of-two buckets: bucket
+    i counts durations in [2**i, 2**(i + 1)), bucket 0 also those below 1."""
+    __slots__ = ("counts",)
+
+    def __init__(self):
+        self.counts = [0] * 64
+
+    def record(self, duration):
+        self.counts[max(duration, 1).bit_length() - 1] += 1
+
+    @property
+    def total(self):
+        return sum(self.counts)
+
+    def percentile(self, fraction):
+        """Return the upper bound of the bucket holding the given fraction of
+        the durations, or None if nothing was recorded."""
+        rank = fraction * self.total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return 2 ** (i + 1)
+        return None
+
+    def summary(self):
+        """Return the count and the 50th, 90th and 99th percentile bounds."""
+        return dict(count=self.total,
+                    p50_ns=self.percentile(0.50),
+                    p90_ns=self.percentile(0.90),
+                    p99_ns=self.percentile(0.99))
+
+    def __repr__(self):
+        return "LatencyHistogram({})".format(", ".join(
+            f"<{2 ** (i + 1)}ns: {count}"
+            for i, count in enumerate(self.counts) if count))
+
+
+class BusyPoll:
+    """Spin budget of one network thread and its statistics, see the module
+    docstring. Only the network thread updates it."""
+
+    def __init__(self, max_budget):
+        """max_budget is the longest the network thread spins, in
+        nanoseconds."""
+        self.max_budget = max_budget
+        # Start out optimistic, the first gaps correct it.
+        self.budget = max_budget
+        self._average_gap = None
+        self._last_arrival = None
+        self.gaps = LatencyHistogram()
+        self.spins = LatencyHistogram()
+        self.hits = 0
+        self.misses = 0
+
+    def spun(self, duration, hit):
+        """Record a spin of duration ns that did or did not find a segment."""
+        if hit:
+            self.hits += 1
+            self.spins.record(duration)
+        else:
+            self.misses += 1
+
+    def arrived(self, now):
+        """Record that a burst arrived at now, and adapt the budget."""
+        last, self._last_arrival = self._last_arrival, now
+        if last is None:
+            return
+        gap = now - last
+        self.gaps.record(gap)
+        # One long idle period should not switch spinning off for the next
+        # hundred bursts.
+        gap = min(gap, 4 * self.max_budget)
+        average = self._average_gap
+        if average is None:
+            average = gap
+        else:
+            average += (gap - average) >> _EWMA_SHIFT
+        self._average_gap = average
+        self.budget = 0 if average > self.max_budget else min(2 * average,
+                                                               self.max_budget)
+
+    def summary(self):
+        return dict(max_budget_ns=self.max_budget, budget_ns=self.budget,
+                    hits=self.hits, misses=self.misses,
+                    gaps=self.gaps.summary(), spins=self.spins.summary())
@@ -0,0 +1,169 @@
+"""Internet checksum backends for bTCP segments.
+
+All backends compute the same 16 bit one's complement checksum as the
+reference implementation, treating bytes 8 and 9 (the checksum field of the
+header) as zero. They only differ in how fast they get there:
+
+    reference   the original word-by-word Python loop; slow but obviously
+                correct, kept around to test the others against.
+    wide        reads the whole segment as one big integer and reduces it
+                modulo 0xFFFF. Since 2**16 == 1 (mod 0xFFFF), that is the
+                one's complement sum of all 16 bit words, folded.
+    numpy       sums the segment as an array of big-endian uint16 words.
+                Only available if numpy can be imported.
+
+The backend used by BTCPSocket.in_cksum and BTCPSocket.verify_checksum is
+chosen at import time: the BTCP_CHECKSUM_BACKEND environment variable if it
+is set, otherwise the fastest available one. Use set_backend to change it
+for the whole process, or pass checksum_backend to a socket's constructor to
+change it for that socket only.
+
+partial_sum, add and finish expose the one's complement arithmetic itself
+(RFC 1071, RFC 1624), so a sender can cache the partial sum of a payload and
+only recompute the header's contribution when a header field changes.
+
+verify_batch checks the checksums of a whole burst of segments at once.
+"""
+
+import os
+import struct
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+_CKSUM_FIELD = struct.Struct("!H")
+_CKSUM_OFFSET = 8
+
+
+def _reference_cksum(segment):
+    """Word-by-word reference implementation."""
+    checksum = 0
+
+    seg_copy = bytearray(segment)
+    seg_copy[8] = 0
+    seg_copy[9] = 0
+
+    for i in range(0, len(seg_copy), 2):
+        word = (seg_copy[i] << 8) + seg_copy[i+1]
+        checksum += word
+        if checksum > 0xFFFF: checksum = (checksum & 0xFFFF)+1
+
+    return (~checksum) & 0xFFFF
+
+
+def _wide_cksum(segment):
+    """Sum the segment as one large integer and fold at the end."""
+    total = int.from_bytes(segment, "big") % 0xFFFF
+    field, = _CKSUM_FIELD.unpack_from(segment, _CKSUM_OFFSET)
+    total = (total - field) % 0xFFFF
+    if total == 0 and (any(segment[:_CKSUM_OFFSET])
+                       or any(segment[_CKSUM_OFFSET + 2:])):
+        # A nonzero one's complement sum that is a multiple of 0xFFFF is
+        # 0xFFFF ("negative zero"), only an all-zero segment sums to 0.
+        total = 0xFFFF
+    return (~total) & 0xFFFF
+
+
+def _numpy_cksum(segment):
+    """Sum the segment as a vector of big-endian 16 bit words."""
+    words = numpy.frombuffer(segment, dtype=">u2")
+    total = int(words.sum(dtype=numpy.uint64)) - int(words[_CKSUM_OFFSET // 2])
+    if total:
+        total = (total - 1) % 0xFFFF + 1
+    return (~total) & 0xFFFF
+
+
+BACKENDS = {
+    "reference": _reference_cksum,
+    "wide": _wide_cksum,
+}
+if numpy is not None:
+    BACKENDS["numpy"] = _numpy_cksum
+
+
+def get_backend(name):
+    """Return the checksum function registered under name."""
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown checksum backend {name!r}, "
+                         f"choose from {sorted(BACKENDS)}") from None
+
+
+def set_backend(name):
+    """Make name the process-wide default checksum backend."""
+    global in_cksum, backend_name
+    in_cksum = get_backend(name)
+    backend_name = name
+    logger.info("Using %s checksum backend", name)
+
+
+def partial_sum(data):
+    """One's complement sum of the 16 bit words in data, folded to 16 bits but
+    not yet inverted. data of odd length is treated as if padded with a zero
+    byte, so a chunk can be summed before it is padded to PAYLOAD_SIZE.
+
+    The words must be aligned the same way they are in the segment, i.e.
+    data has to start at an even offset (the header and the payload do).
+    """
+    total = int.from_bytes(data, "big")
+    if len(data) & 1:
+        total <<= 8
+    if total == 0:
+        return 0
+    return (total - 1) % 0xFFFF + 1
+
+
+def add(a, b):
+    """One's complement addition of two partial sums."""
+    total = a + b
+    return (total & 0xFFFF) + (total >> 16)
+
+
+def finish(total):
+    """Turn a partial sum over a whole segment into its checksum."""
+    return (~total) & 0xFFFF
+
+
+def verify(cksum_func, segment):
+    """Check the checksum field of segment against cksum_func(segment)."""
+    received, = _CKSUM_FIELD.unpack_from(segment, _CKSUM_OFFSET)
+    return received == cksum_func(segment)
+
+
+def verify_batch(segments, cksum_func=None):
+    """Verify the checksums of a sequence of segments in one go.
+
+    Returns a list of booleans, True for every segment whose checksum is
+    valid. With numpy available, equally sized segments are viewed as an
+    N x (size / 2) matrix of big-endian words that is summed along its rows,
+    instead of paying the per-call overhead of verify for every segment.
+    cksum_func (default: the process-wide backend) is used otherwise, and
+    always if it is the reference backend.
+    """
+    if cksum_func is None:
+        cksum_func = in_cksum
+    if (numpy is None or cksum_func is _reference_cksum or len(segments) < 2
+            or any(len(segment) != len(segments[0]) for segment in segments)):
+        return [verify(cksum_func, segment) for segment in segments]
+
+    words = numpy.frombuffer(b"".join(segments), dtype=">u2")
+    words = words.reshape(len(segments), -1)
+    received = words[:, _CKSUM_OFFSET // 2].astype(numpy.int64)
+    total = words.sum(axis=1, dtype=numpy.int64) - received
+    # Fold to 16 bits, keeping a nonzero sum nonzero (see _numpy_cksum).
+    total = numpy.where(total != 0, (total - 1) % 0xFFFF + 1, 0)
+    return ((~total & 0xFFFF) == received).tolist()
+
+
+# The wide backend beats numpy on single 1018 byte segments: creating the
+# array costs more than the sum itself saves.
+backend_name = os.environ.get("BTCP_CHECKSUM_BACKEND", "wide")
+in_cksum = get_backend(backend_name)
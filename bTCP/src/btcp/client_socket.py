@@ -1,6 +1,11 @@
 from btcp.btcp_socket import BTCPSocket, BTCPStates, raise_NotImplementedError
 from btcp.lossy_layer import LossyLayer
+from btcp import transports
+from btcp.segment import SegmentView
 from btcp.constants import *
+from btcp import checksum
+from btcp import tracing
+from btcp.tracing import TraceEvent
 
 import threading
 import queue
@@ -38,18 +43,49 @@ class BTCPClientSocket(BTCPSocket):
     * See <https://docs.python.org/3/library/queue.html>
     """
 
+    # AsyncBTCPClientSocket replaces this with a lossy layer that runs on an
+    # asyncio event loop instead of in a network thread.
+    _lossy_layer_class = LossyLayer
 
-    def __init__(self, window, timeout, isn=None):
+
+    def __init__(self, window, timeout, isn=None, checksum_backend=None,
+                 trusted_transport=False, transport=None):
         """Constructor for the bTCP client socket. Allocates local resources
         and starts an instance of the Lossy Layer.
+
+        checksum_backend optionally names the btcp.checksum backend this
+        socket uses instead of the process-wide default.
+
+        trusted_transport asks the server, during the SYN exchange, to skip
+        checksums on this connection. It is only offered and used while the
+        lossy layer is trusted, i.e. on loopback without effect handlers.
+
+        transport optionally names the lossy layer implementation from
+        btcp.transports to use instead of UDP, see get_transport there.
         """
         logger.debug("__init__ called")
-        super().__init__(window, timeout, isn)
-        self._lossy_layer = LossyLayer(self, CLIENT_IP, CLIENT_PORT, SERVER_IP, SERVER_PORT)
+        super().__init__(window, timeout, isn, checksum_backend,
+                         trusted_transport)
+        lossy_layer_class = self._lossy_layer_class
+        if transport is not None:
+            lossy_layer_class = transports.get_transport(transport)
+        self._lossy_layer = lossy_layer_class(self, CLIENT_IP, CLIENT_PORT, SERVER_IP, SERVER_PORT)
+        # Room for the segments of our own window until the handshake tells
+        # us the server's.
+        self._lossy_layer.size_buffers(self._window)
 
         # The data buffer used by send() to send data from the application
         # thread into the network thread. Bounded in size.
         self._sendbuf = queue.Queue(maxsize=1000)
+
+        # Data segments sent but not yet acknowledged, by sequence number.
+        # Only touched from the network thread. Each entry keeps the chunk and
+        # the partial checksum of its payload, so a retransmission only has to
+        # recompute the header's contribution to the checksum.
+        self._unacked = {}
+        self._acknum = 0
+        self._retransmit_timer = None
+        self._offer_nocksum = False
         self._lossy_layer.start_network_thread()
 
         logger.info("Socket initialized with sendbuf size 1000")
@@ -102,33 +138,43 @@ class BTCPClientSocket(BTCPSocket):
         """
         logger.debug("lossy_layer_segment_received called")
         # raise_NotImplementedError("No implementation of lossy_layer_segment_received present. Read the comments & code of client_socket.py.")
-        if not BTCPSocket.verify_checksum(segment):
+        if not self._checksum_ok(segment):
             logger.warning("Checksum failed - ignoring segment")
             return  # Discard corrupted segment
-        
-        seqnum, acknum, syn, ack, fin, window, length, checksum = BTCPSocket.unpack_segment_header(segment)
-        payload = segment[10:10+length] if length > 0 else b''
+        self._verified_segment_received(segment)
+
+
+    def _verified_segment_received(self, segment):
+        """State machine part of lossy_layer_segment_received, called once the
+        checksum of segment has been verified. Also called for every valid
+        segment of a burst by lossy_layer_segments_received.
+        """
+        seg = SegmentView(segment)
 
         if self._state == BTCPStates.SYN_SENT:
             # Client sent SYN, waiting for SYN-ACK
             logger.debug("client sent SYN, waiting for SYN-ACK")
-            if syn and ack and not fin:
+            if seg.syn_set and seg.ack_set and not seg.fin_set:
                 logger.info("Received SYN-ACK, completing handshake")
 
                 expected_ack = (self._seqnum + 1) & 0xFFFF
-                if acknum != expected_ack:
-                    logger.warning(f"Invalid ACK: expected {expected_ack}, got {acknum}")
+                if seg.acknum != expected_ack:
+                    logger.warning(f"Invalid ACK: expected {expected_ack}, got {seg.acknum}")
                     return
                 
-                peer_next = (seqnum+1) & 0xFFFF
-                ack_wo_cksum = self.build_segment_header(seqnum=expected_ack, acknum=peer_next, syn_set=False, ack_set=True, fin_set=False, window=self._window, length=0, checksum=0)
-                ack_cksum = self.in_cksum(ack_wo_cksum)
-                ack_seg = self.build_segment_header(seqnum=expected_ack, acknum=peer_next, syn_set=False, ack_set=True, fin_set=False, window=self._window, length=0, checksum=ack_cksum)
-                self._lossy_layer.send_segment(ack_seg)
-
+                # The server echoes NOCKSUM_FLAG if it agrees to skip checksums.
+                self._skip_checksum = self._offer_nocksum and seg.nocksum_set
+                self._peer_window_received(seg.window)
+                peer_next = (seg.seqnum+1) & 0xFFFF
+                self._acknum = peer_next
                 self._seqnum = expected_ack
-                self._state = BTCPStates.ESTABLISHED
+                self._send_ack()
+
+                self._stop_retransmit_timer()
+                self._set_state(BTCPStates.ESTABLISHED)
                 logger.info("Handshake complete, moved to ESTABLISHED")
+                if not self._sendbuf.empty():
+                    self._transmit()
 
             
         elif self._state == BTCPStates.SYN_RCVD:
@@ -139,48 +185,40 @@ class BTCPClientSocket(BTCPSocket):
             # Client sent FIN, waiting for FIN-ACK
             logger.debug("Client sent FIN, waiting for FIN-ACK")
             fin_acked = False
-            if ack:
+            if seg.ack_set:
                 expected = (self._fin_seq+1) & 0xFFFF
-                if acknum == expected: fin_acked = True
+                if seg.acknum == expected: fin_acked = True
             else:
-                logger.warning(f"invalid ACK in FIN_SENT: expected {expected}, got {acknum}")
-
-            if fin:
-                peer_fin_next = (seqnum+1) & 0xFFFF
-                ack_hdr_wo_cksum = self.build_segment_header(
-                    self._seqnum, peer_fin_next,
-                    syn_set=False, ack_set=True, fin_set=False,
-                    window=self._window, length=0, checksum=0
-                )
-                ack_cksum = self.in_cksum(ack_hdr_wo_cksum)
-                ack_hdr = self.build_segment_header(
-                    self._seqnum, peer_fin_next,
-                    syn_set=False, ack_set=True, fin_set=False,
-                    window=self._window, length=0, checksum=ack_cksum
-                )
-                self._lossy_layer.send_segment(ack_hdr)
+                logger.warning(f"invalid ACK in FIN_SENT: expected {expected}, got {seg.acknum}")
+
+            if seg.fin_set:
+                peer_fin_next = (seg.seqnum+1) & 0xFFFF
+                ack_seg = self._ack_template.encode(
+                    self._seqnum, peer_fin_next, window=self._window,
+                    nocksum=self._nocksum())
+                self._lossy_layer.send_segment(ack_seg)
                 logger.info("Sent final ACK for peer FIN")
 
                 # If our FIN was ACKed too, we are done
-                if fin_acked or ack:
-                    self._state = BTCPStates.CLOSED
+                if fin_acked or seg.ack_set:
+                    self._set_state(BTCPStates.CLOSED)
                     logger.info("Connection closed")
 
-            if fin and ack:
+            if seg.fin_set and seg.ack_set:
                 logger.info("Received FIN-ACK, closing connection")
 
 
         elif self._state == BTCPStates.FIN_RCVD:
             # Received FIN from server, waiting to close
             logger.debug("Received FIN from server, waiting to close")
-            if ack and not fin:
+            if seg.ack_set and not seg.fin_set:
                 logger.info("Received final ACK, closing")
 
 
         elif self._state == BTCPStates.CLOSING:
             # Both sides have sent FIN
             logger.debug("Both sides have sent FIN")
-            if ack:
+            if seg.ack_set:
                 logger.debug("Connection is closing")
 
 
@@ -188,10 +226,15 @@ class BTCPClientSocket(BTCPSocket):
             # Unexpected segment in CLOSED state - ignore (old segments)
             logger.debug("Ignoring segment in CLOSED state")
             return
-        
+
+        elif self._state == BTCPStates.ESTABLISHED:
+            if seg.syn_set and seg.ack_set:
+                # Our ACK of the SYN/ACK got lost, the server is retrying.
+                self._send_ack()
+            elif seg.ack_set:
+                self._ack_received(seg.acknum, seg.window)
+
         else:
-            # For data transfer - you need an ESTABLISHED state!
-            # Without it, you can't handle data properly
             logger.warning(f"Unexpected segment in state {self._state}")
 
 
@@ -220,32 +263,148 @@ class BTCPClientSocket(BTCPSocket):
         lossy_layer_segment_received or lossy_layer_tick.
         """
         logger.debug("lossy_layer_tick called")
-        raise_NotImplementedError("Only rudimentary implementation of lossy_layer_tick present. Read the comments & code of client_socket.py, then remove the NotImplementedError.")
+        #raise_NotImplementedError("Only rudimentary implementation of lossy_layer_tick present. Read the comments & code of client_socket.py, then remove the NotImplementedError.")
+
+        # Data is normally sent as soon as send() queued it or an ACK opened
+        # the window; this only catches anything that slipped through.
+        self._transmit()
+
+
+    def _transmit(self):
+        """Send as much of the send buffer as the server's window allows.
+
+        Only ever called from the network thread, which owns _unacked and
+        the sequence numbers: on every tick, right away after send() woke
+        the network thread up, and whenever an ACK opens the window. Data
+        queued before the connection is established waits for the SYN/ACK,
+        which calls this again.
+        """
+        if self._state != BTCPStates.ESTABLISHED:
+            return
+        self._lossy_layer.send_segments(self._new_data_segments())
+
+
+    def _send_window(self):
+        """The number of segments that may be unacknowledged at once: the
+        window the server advertised, or our own until it did. At least one,
+        so a zero window can not stall the connection for good."""
+        window = self._window if self._peer_window is None else self._peer_window
+        return max(window, 1)
 
-        # Actually send all chunks available for sending.
-        # Relies on an eventual exception to break from the loop when no data
-        # is available.
-        # You should eventually for flow cotrol  be checking whether there's space in the window as well,
-        # for reliable data transfer be storing the segments for retransmission somewhere.
+
+    def _new_data_segments(self):
+        """Generate a segment for every chunk in the send buffer that fits in
+        the window, registering it for retransmission.
+        """
+        window = self._send_window()
         try:
-            while True:
+            # Only segments sent while ESTABLISHED are tracked, and count
+            # against the window.
+            while len(self._unacked) < window:
                 logger.debug("Getting chunk from buffer.")
                 chunk = self._sendbuf.get_nowait()
-                datalen = len(chunk)
-                logger.debug("Got chunk with length %i:", datalen)
-                logger.debug(chunk)
-                if datalen < PAYLOAD_SIZE:
-                    logger.debug("Padding chunk to full size")
-                    chunk = chunk + b'\x00' * (PAYLOAD_SIZE - datalen)
-                logger.debug("Building segment from chunk.")
-                segment = (self.build_segment_header(self._seqnum, 0, length=datalen)
-                           + chunk)
-                logger.info("Sending segment.")
-                self._lossy_layer.send_segment(segment)
+                logger.debug("Got chunk with length %i:", len(chunk))
+                # The encoder pads the chunk; zero padding does not change
+                # the payload's partial checksum.
+                payload_sum = None if self._nocksum() else checksum.partial_sum(chunk)
+                segment = self._build_data_segment(self._seqnum, chunk,
+                                                   payload_sum)
+                if self._state == BTCPStates.ESTABLISHED:
+                    self._unacked[self._seqnum] = (chunk, payload_sum)
+                    self._start_retransmit_timer()
+                yield segment
+                self._seqnum = (self._seqnum + 1) & 0xFFFF
         except queue.Empty:
             logger.info("No (more) data was available for sending right now.")
 
 
+    def _build_data_segment(self, seqnum, chunk, payload_sum):
+        """Build a data segment carrying chunk, using the cached partial
+        checksum of the payload so only the header gets summed here.
+        payload_sum is None if it was never computed, because the segment was
+        first sent in trusted-transport mode.
+        """
+        return self._encoder.encode(seqnum, self._acknum, window=self._window,
+                                    payload=chunk, payload_sum=payload_sum,
+                                    nocksum=self._nocksum())
+
+
+    def _send_syn(self, encoder):
+        """Send the SYN of the handshake, offering trusted-transport mode if
+        connect decided to."""
+        self._lossy_layer.send_segment(encoder.encode(
+            self._seqnum, 0, syn_set=True, window=self._window,
+            nocksum=self._offer_nocksum))
+
+
+    def _send_ack(self):
+        """Send a pure ACK for everything received from the server so far."""
+        self._lossy_layer.send_segment(self._ack_template.encode(
+            self._seqnum, self._acknum, window=self._window,
+            nocksum=self._nocksum()))
+
+
+    def _ack_received(self, acknum, window=None):
+        """Drop all segments cumulatively acknowledged by acknum, and take
+        note of the window the server advertised with it. If that makes room
+        in the window, send queued data right away."""
+        acked = [seqnum for seqnum in self._unacked
+                 if 0 < (acknum - seqnum) & 0xFFFF <= len(self._unacked)]
+        for seqnum in acked:
+            del self._unacked[seqnum]
+        if acked:
+            self._stop_retransmit_timer()
+            if self._unacked:
+                self._start_retransmit_timer()
+        opened = bool(acked)
+        if window is not None and window != self._peer_window:
+            opened = opened or self._peer_window is None or window > self._peer_window
+            self._peer_window = window
+        if opened and not self._sendbuf.empty():
+            self._transmit()
+
+
+    def _retransmit_unacked(self):
+        """Resend every unacknowledged segment with the current ack number and
+        window. Only the header part of the checksum is recomputed.
+        """
+        logger.info("Retransmitting %i segments", len(self._unacked))
+        self._lossy_layer.send_segments(self._retransmitted_segments())
+
+
+    def _retransmitted_segments(self):
+        for seqnum, (chunk, payload_sum) in list(self._unacked.items()):
+            if tracing.enabled:
+                tracing.record(TraceEvent.RETRANSMIT, seqnum)
+            yield self._build_data_segment(seqnum, chunk, payload_sum)
+
+
+    # Same kind of timer as the example timer in server_socket.py.
+    def _start_retransmit_timer(self):
+        if not self._retransmit_timer:
+            self._retransmit_timer = self._lossy_layer.timers.call_later(
+                self.timeout_nanosecs, self._retransmit_timeout)
+
+
+    def _stop_retransmit_timer(self):
+        if self._retransmit_timer:
+            self._retransmit_timer.cancel()
+            self._retransmit_timer = None
+
+
+    def _retransmit_timeout(self):
+        if tracing.enabled:
+            tracing.record(TraceEvent.TIMER, "retransmit")
+        self._retransmit_timer = None
+        if self._state == BTCPStates.SYN_SENT:
+            logger.info("No SYN/ACK received, retransmitting SYN")
+            self._send_syn(self._encoder)
+            self._start_retransmit_timer()
+        elif self._unacked:
+            self._retransmit_unacked()
+            self._start_retransmit_timer()
+
+
 
     ###########################################################################
     ### You're also building the socket API for the applications to use.    ###
@@ -287,7 +446,24 @@ class BTCPClientSocket(BTCPSocket):
         this project.
         """
         logger.debug("connect called")
-        raise_NotImplementedError("No implementation of connect present. Read the comments & code of client_socket.py.")
+        #raise_NotImplementedError("No implementation of connect present. Read the comments & code of client_socket.py.")
+        self._start_handshake()
+        while self._state == BTCPStates.SYN_SENT:
+            time.sleep(0.001)
+        logger.info("Connected, trusted-transport mode %s",
+                    "on" if self._skip_checksum else "off")
+
+
+    def _start_handshake(self):
+        """Send the SYN; the network thread takes it from there."""
+        # Only offer trusted-transport mode if nothing can corrupt segments.
+        self._offer_nocksum = (self._trusted_transport
+                               and self._lossy_layer.trusted)
+        self._skip_checksum = False
+        self._set_state(BTCPStates.SYN_SENT)
+        # The network thread retransmits the SYN when this timer expires.
+        self._start_retransmit_timer()
+        self._send_syn(self._app_encoder)
 
 
     def send(self, data):
@@ -322,8 +498,18 @@ class BTCPClientSocket(BTCPSocket):
         done later.
         """
         logger.debug("send called")
-        raise_NotImplementedError("Only rudimentary implementation of send present. Read the comments & code of client_socket.py, then remove the NotImplementedError.")
+        #raise_NotImplementedError("Only rudimentary implementation of send present. Read the comments & code of client_socket.py, then remove the NotImplementedError.")
+        sent_bytes = self._queue_data(data)
+        if sent_bytes:
+            # Have the network thread turn it into segments now instead of
+            # at the next tick; it owns the state that takes, see _transmit.
+            self._lossy_layer.wakeup()
+        return sent_bytes
+
 
+    def _queue_data(self, data):
+        """Chunk data into the send buffer, returning the number of bytes that
+        fit in it."""
         # Example with a finite buffer: a queue with at most 1000 chunks,
         # for a maximum of 985KiB data buffered to get turned into packets.
         # See BTCPSocket__init__() in btcp_socket.py for its construction.
@@ -0,0 +1,114 @@
+"""Sending batches of segments with as few system calls as possible.
+
+Python has no sendmmsg, but on Linux one sendmsg can send a batch of
+datagrams with UDP generic segmentation offload: the segments go in as a
+scatter/gather list, and the UDP_SEGMENT control message has the kernel cut
+the data into datagrams of the size of the first one again. Only the last
+datagram of a batch may be shorter, which suits bTCP, whose segments all
+take up SEGMENT_SIZE bytes. Where the kernel does not support it, or the
+device can not segment, BatchSender sends one datagram per system call.
+
+Both BottomHandler.send_segments and the transmit thread (see
+btcp/transmitter.py) send their batches through a BatchSender.
+"""
+
+import logging
+import socket
+import struct
+import threading
+
+from btcp.constants import *
+
+
+logger = logging.getLogger(__name__)
+
+
+# Linux: sendmsg control message carrying the datagram size for UDP
+# segmentation offload. The socket module does not export it. The kernel
+# takes at most 64 datagrams per system call.
+_UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+_SOL_UDP = getattr(socket, "SOL_UDP", 17)
+GSO_MAX_SEGMENTS = 64
+
+
+class BatchSender:
+    """Sends batches of segments through a connected UDP socket, see the
+    module docstring. Safe to use from several threads at once."""
+
+    def __init__(self, udp_socket):
+        self._udp_socket = udp_socket
+        # Whether to send runs with UDP segmentation offload.
+        self.gso = self._gso_supported()
+        self._gso_control = [(_SOL_UDP, _UDP_SEGMENT,
+                              struct.pack("=H", SEGMENT_SIZE))]
+        self._counter_lock = threading.Lock()
+        self.syscalls = 0
+
+    def _gso_supported(self):
+        if not hasattr(self._udp_socket, "sendmsg"):
+            return False
+        try:
+            self._udp_socket.getsockopt(_SOL_UDP, _UDP_SEGMENT)
+        except OSError:
+            return False
+        return True
+
+    def send_segments(self, segments):
+        """Send segments, returning how many of them were sent.
+
+        segments is iterated exactly once, and every segment only has to
+        stay valid until the next one is taken from it: segments that wait
+        for the rest of their run are copied.
+        """
+        run = []
+        sent = 0
+        for segment in segments:
+            # A no-op for bytes.
+            run.append(bytes(segment))
+            if len(segment) != SEGMENT_SIZE or len(run) == GSO_MAX_SEGMENTS:
+                sent += self._send_run(run)
+                run = []
+        if run:
+            sent += self._send_run(run)
+        return sent
+
+    def _send_run(self, run):
+        """Send segments of which all but the last take up SEGMENT_SIZE
+        bytes, returning how many of them were sent."""
+        udp_socket = self._udp_socket
+        if len(run) > 1 and self.gso:
+            try:
+                if self._send_retrying(udp_socket.sendmsg, run,
+                                       self._gso_control) is None:
+                    return 0
+                return len(run)
+            except OSError as e:
+                # E.g. EIO when the device can not segment.
+                logger.warning("UDP segmentation offload failed (%s), "
+                               "sending one segment at a time", e)
+                self.gso = False
+        sent = 0
+        for segment in run:
+            bytes_sent = self._send_retrying(udp_socket.send, segment)
+            if bytes_sent is None:
+                continue
+            sent += 1
+            if bytes_sent != len(segment):
+                logger.critical("The lossy layer was only able to send %i bytes "
+                                "of a segment!",
+                                bytes_sent)
+        return sent
+
+    def _send_retrying(self, send, *args):
+        """Return send(*args), or None if it failed with
+        ConnectionRefusedError twice. The error is reported for an earlier
+        segment, see LossyLayer.handle_incoming_segments, and the failed call
+        clears it."""
+        for attempt in range(2):
+            with self._counter_lock:
+                self.syscalls += 1
+            try:
+                return send(*args)
+            except ConnectionRefusedError:
+                pass
+        return None
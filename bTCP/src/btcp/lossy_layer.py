@@ -12,16 +12,51 @@ import sys
 import threading
 import signal
 import contextlib
+import ipaddress
+import os
+import platform
+import time
 from _thread import interrupt_main
 
 import logging
 
 from btcp.constants import *
+from btcp.buffer_pool import SegmentBufferPool, DEFAULT_POOL_SIZE
+from btcp.busy_poll import BusyPoll
+from btcp.gso import BatchSender
+from btcp.reactor import default_reactor
+from btcp.timers import TimerGroup, TimerService
+from btcp.transmitter import Transmitter
+from btcp.wakeup import Wakeup
+from btcp import tracing
+from btcp.tracing import TraceEvent
 
 
 logger = logging.getLogger(__name__)
 
 
+DEFAULT_BURST_SIZE = 32
+TICK_NS = TIMER_TICK * 1_000_000
+_MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+
+# Kernel memory a SEGMENT_SIZE datagram takes up in a socket's receive queue,
+# overhead included, as measured on Linux x86-64 loopback. The default
+# receive buffer of 208KiB only holds 92 of them.
+SEGMENT_TRUESIZE = 2304
+
+# Linux: have recvmsg report the number of datagrams the kernel dropped for
+# lack of receive buffer space. The socket module does not export it. 40 is
+# the asm-generic value; alpha, parisc and sparc number their socket options
+# differently, so only fall back to it on architectures known to use those.
+_GENERIC_SOCKET_OPTIONS = (
+    sys.platform.startswith("linux")
+    and platform.machine().lower() in ("x86_64", "amd64", "i386", "i686",
+                                       "aarch64", "arm64", "armv7l", "armv6l",
+                                       "riscv64", "ppc64le", "s390x"))
+_SO_RXQ_OVFL = getattr(socket, "SO_RXQ_OVFL",
+                       40 if _GENERIC_SOCKET_OPTIONS else None)
+_RXQ_OVFL_ANCBUFSIZE = socket.CMSG_SPACE(4) if hasattr(socket, "CMSG_SPACE") else 0
+
 
 class LossyLayer:
     """The lossy layer emulates the network layer in that it provides bTCP with
@@ -32,9 +67,18 @@ class LossyLayer:
     will signal that thread to end, join it, wait for it to terminate, then
     destroy its UDP socketet.
 
+    By default there is no network thread of its own though: the lossy layer
+    attaches to the process-wide reactor, which does the same for all lossy
+    layers in one thread, see btcp/reactor.py.
+
     Students should NOT need to modify any code in this class.
     """
 
+    # Lossy layers for other transports always run a network thread, and
+    # send from the calling thread.
+    _reactor = None
+    transmitter = None
+
     def handle_incoming_segments(self):
         """This is the main method of the "network thread".
 
@@ -44,41 +88,273 @@ class LossyLayer:
         If no segment is received for TIMER_TICK ms, call the lossy_layer_tick
         method of the associated socket.
 
+        In between, run the callbacks of the timers in self.timers as their
+        deadlines pass, see btcp/timers.py.
+
         When flagged, return from the function. This is used by LossyLayer's
-        destructor. Note that destruction will *not* attempt to receive or send any
-        more data; after event gets set the method will send one final segment to
-        the transport layer, or give one final tick if no segment is received in
-        TIMER_TICK ms, then return.
+        destructor, which also wakes the thread up, see btcp/wakeup.py. Note
+        that destruction will *not* attempt to receive or send any more data;
+        after event gets set the method will send at most one final segment
+        to the transport layer, or give one final tick, then return.
+
+        The wakeup also lets other threads ask for a tick right away, see
+        wakeup.
 
         Students should NOT need to modify any code in this method.
         """
-        btcp_socket, event, udp_socket = self._bTCP_socket, self._event, self._udp_socket
+        if self.busy_poll is not None:
+            return self._busy_poll_incoming_segments()
+        event, udp_socket, wakeup = self._event, self._udp_socket, self._wakeup
+        pool, burst_counts = self._buffer_pool, self.burst_counts
+        wakeup.owner = threading.get_ident()
 
         logger.info("Starting handle_incoming_segments")
+        next_tick = time.monotonic_ns() + TICK_NS
         while not event.is_set():
             try:
-                # We do not block here, because we might never check the loop condition in that case
-                rlist, wlist, elist = select.select([udp_socket], [], [], TIMER_TICK / 1000)
-                if rlist:
-                    segment, address = udp_socket.recvfrom(SEGMENT_SIZE)
-                    
-                    with self._handler_lock:
-                        self._handler_stack[-1].segment_received(segment)
-
-                    # We *assume* here that students aren't leaving multiple processes
-                    # sending segments from different remote IPs and ports running.
-                    # We *could* check the address for validity but then we'd have
-                    # to resolve hostnames etc and honestly I don't see a pressing need
-                    # for that.
+                # We do not block for longer than until the next tick or timer
+                # deadline, so ticks and timers are never late; anything else
+                # that should end the wait goes through wakeup.
+                rlist, wlist, elist = select.select([udp_socket, wakeup], [], [],
+                                                    self._wait_timeout(next_tick))
+                if wakeup in rlist:
+                    wakeup.drain()
+                if udp_socket in rlist:
+                    bufs = []
+                    segments = []
+                    try:
+                        # The first read can not block, select said so.
+                        self._receive_burst(bufs, segments)
+                        burst_counts[len(segments)] += 1
+                        if segments:
+                            self._deliver(segments)
+                    finally:
+                        for buf in bufs:
+                            pool.release(buf)
+
+                    now = time.monotonic_ns()
+                    next_tick = now + TICK_NS
                 else:
-                    with self._handler_lock:
-                        self._handler_stack[-1].tick()
+                    now = time.monotonic_ns()
+                    if now >= next_tick:
+                        self._tick()
+                        next_tick = now + TICK_NS
+                if self._tick_requested:
+                    self._tick_requested = False
+                    self._tick()
+                self._run_timers(now)
             except Exception as e:
                 logger.exception("Exception in the network thread")
                 signal.raise_signal(signal.SIGTERM)
                 raise
 
-    def __init__(self, btcp_socket, local_ip, local_port, remote_ip, remote_port):
+    def _busy_poll_incoming_segments(self):
+        """handle_incoming_segments in busy polling mode, see btcp/busy_poll.py:
+        before blocking in select, spin on non-blocking reads for as long as
+        the current budget allows."""
+        event, udp_socket, wakeup = self._event, self._udp_socket, self._wakeup
+        pool, burst_counts, poll = self._buffer_pool, self.burst_counts, self.busy_poll
+        wakeup.owner = threading.get_ident()
+
+        logger.info("Starting handle_incoming_segments, busy polling")
+        next_tick = time.monotonic_ns() + TICK_NS
+        while not event.is_set():
+            try:
+                bufs = []
+                segments = []
+                try:
+                    budget = poll.budget
+                    if budget:
+                        start = time.monotonic_ns()
+                        # Never spin past the next tick or timer deadline.
+                        end = start + min(budget,
+                                          int(self._wait_timeout(next_tick) * 1e9))
+                        while True:
+                            self._receive_burst(bufs, segments, _MSG_DONTWAIT)
+                            now = time.monotonic_ns()
+                            if segments or now >= end or self._tick_requested:
+                                break
+                        poll.spun(now - start, bool(segments))
+                    if not segments and not self._tick_requested:
+                        rlist, wlist, elist = select.select(
+                            [udp_socket, wakeup], [], [],
+                            self._wait_timeout(next_tick))
+                        if wakeup in rlist:
+                            wakeup.drain()
+                        if udp_socket in rlist:
+                            self._receive_burst(bufs, segments)
+                        now = time.monotonic_ns()
+                    if segments:
+                        poll.arrived(now)
+                        burst_counts[len(segments)] += 1
+                        self._deliver(segments)
+                finally:
+                    for buf in bufs:
+                        pool.release(buf)
+
+                if segments:
+                    now = time.monotonic_ns()
+                    next_tick = now + TICK_NS
+                elif now >= next_tick:
+                    self._tick()
+                    next_tick = now + TICK_NS
+                if self._tick_requested:
+                    self._tick_requested = False
+                    self._tick()
+                self._run_timers(now)
+            except Exception as e:
+                logger.exception("Exception in the network thread")
+                signal.raise_signal(signal.SIGTERM)
+                raise
+
+    def _receive_burst(self, bufs, segments, flags=0):
+        """Read pending datagrams into buffers from the pool, until
+        burst_size segments were read or nothing is pending.
+
+        The buffers are appended to bufs and the segments read into them to
+        segments. flags are those of the first read. The buffers are only lent
+        to the handlers, the caller releases them once they are done, see
+        btcp/buffer_pool.py for the ownership rules.
+        """
+        udp_socket, pool, burst_size = self._udp_socket, self._buffer_pool, self._burst_size
+        # The kernel's drop counter is cumulative, reading it with the first
+        # datagram of every burst is enough.
+        count_drops = self.kernel_drops is not None
+        # Drain everything that is pending, so a burst of datagrams costs one
+        # select instead of one each.
+        while len(segments) < burst_size:
+            buf = pool.acquire()
+            try:
+                if count_drops:
+                    count_drops = False
+                    nbytes, ancdata, msg_flags, address = udp_socket.recvmsg_into(
+                        [buf], _RXQ_OVFL_ANCBUFSIZE, flags)
+                    for level, kind, data in ancdata:
+                        if level == socket.SOL_SOCKET and kind == _SO_RXQ_OVFL:
+                            self.kernel_drops = int.from_bytes(data[:4], sys.byteorder)
+                else:
+                    nbytes = udp_socket.recv_into(buf, 0, flags)
+            except BlockingIOError:
+                pool.release(buf)
+                break
+            except ConnectionRefusedError:
+                # ICMP port unreachable for something we sent, the peer is
+                # not up (yet): a lost segment.
+                pool.release(buf)
+                flags = _MSG_DONTWAIT
+                continue
+            except BaseException:
+                pool.release(buf)
+                raise
+            bufs.append(buf)
+            # The UDP socket is connected to the peer, so the kernel already
+            # dropped datagrams from any other address.
+            segments.append(buf if nbytes == SEGMENT_SIZE else buf[:nbytes])
+            flags = _MSG_DONTWAIT
+
+    def _reactor_readable(self):
+        """Called by the reactor when the UDP socket is readable: one
+        iteration of handle_incoming_segments."""
+        pool = self._buffer_pool
+        bufs = []
+        segments = []
+        try:
+            # Other lossy layers wait while this one blocks, so do not rely on
+            # the selector being right.
+            self._receive_burst(bufs, segments, _MSG_DONTWAIT)
+            self.burst_counts[len(segments)] += 1
+            if segments:
+                self._deliver(segments)
+        finally:
+            for buf in bufs:
+                pool.release(buf)
+        self._next_tick = time.monotonic_ns() + TICK_NS
+
+    def _reactor_tick_now(self):
+        """Called by the reactor for a tick requested with wakeup."""
+        self._tick_requested = False
+        self._tick()
+        self._next_tick = time.monotonic_ns() + TICK_NS
+
+    def _reactor_tick(self):
+        """The tick timer of a lossy layer attached to a reactor. Segments
+        arriving only push _next_tick back; instead of being rescheduled for
+        every burst, the timer reschedules itself when it fires early."""
+        now = time.monotonic_ns()
+        if now >= self._next_tick:
+            self._tick()
+            self._next_tick = now + TICK_NS
+        self.timers.call_at(self._next_tick, self._reactor_tick)
+
+    # Building blocks of the network thread's loop, shared with the lossy
+    # layers for other transports.
+
+    def _wait_timeout(self, next_tick):
+        """Seconds until next_tick or the nearest timer deadline, whichever
+        comes first."""
+        deadline = self.timers.next_deadline()
+        if deadline is None or deadline > next_tick:
+            deadline = next_tick
+        return max(deadline - time.monotonic_ns(), 0) / 1e9
+
+    def _deliver(self, segments):
+        """Pass a burst of received segments up the handler stack."""
+        handlers = self._handler_stack
+        if len(handlers) == 1:
+            deliver_segments(handlers[0], segments)
+        else:
+            with self._handler_lock:
+                # Effect handlers may keep segments around.
+                segments = [bytes(segment) for segment in segments]
+                deliver_segments(self._handler_stack[-1], segments)
+
+    def _tick(self):
+        handlers = self._handler_stack
+        if len(handlers) == 1:
+            handlers[0].tick()
+        else:
+            with self._handler_lock:
+                self._handler_stack[-1].tick()
+
+    def _run_timers(self, now):
+        deadline = self.timers.next_deadline()
+        if deadline is None or deadline > now:
+            return
+        if len(self._handler_stack) == 1:
+            self.timers.run_expired(now)
+        else:
+            with self._handler_lock:
+                self.timers.run_expired(now)
+
+    def _run_timer(self, callback, args):
+        """Call the callback of a timer the reactor runs, locking like
+        _run_timers does."""
+        if len(self._handler_stack) == 1:
+            callback(*args)
+        else:
+            with self._handler_lock:
+                callback(*args)
+
+    def __init__(self, btcp_socket, local_ip, local_port, remote_ip, remote_port,
+                 pool_size=DEFAULT_POOL_SIZE, debug_buffers=None,
+                 burst_size=DEFAULT_BURST_SIZE, busy_poll=None, reactor=None,
+                 transmit_thread=None):
+        """pool_size is the number of preallocated receive buffers.
+        debug_buffers enables the use-after-release checks of the buffer
+        pool; it defaults to whether BTCP_DEBUG_BUFFERS is set.
+        burst_size is the maximum number of datagrams the network thread
+        reads per wakeup before passing them on as one batch.
+        busy_poll is the maximum time in microseconds the network thread
+        spins before blocking, see btcp/busy_poll.py; it defaults to
+        BTCP_BUSY_POLL, and busy polling is off if neither is set.
+        reactor is the btcp.reactor.Reactor to attach to instead of starting
+        a network thread, see btcp/reactor.py. It defaults to the process-wide
+        one unless BTCP_REACTOR is 0 or busy polling is on; pass False for a
+        network thread.
+        transmit_thread makes a thread of its own send the segments, so the
+        threads sending them only queue them, see btcp/transmitter.py. It
+        defaults to whether BTCP_TRANSMIT_THREAD is set.
+        """
         logger.info("LossyLayer.__init__() was called")
         self._bTCP_socket = btcp_socket
         self._remote_ip = remote_ip
@@ -86,11 +362,74 @@ class LossyLayer:
         self._local_ip = local_ip
         self._local_port = local_port
 
-        self._handler_lock = threading.RLock() 
-        # _handler_lock protects _handler_stack;  it's reentrant because BTCP implementations
-        # are likely to sent a segment in response to one received
-        self._handler_stack = [BottomHandler(self)]
+        # _handler_stack is an immutable tuple, replaced as a whole when
+        # temporary_handler pushes or pops a handler, so the per-segment paths
+        # can read it without locking. Only the BottomHandler is known to be
+        # thread safe though: while effect handlers are active, calls into
+        # the stack are serialized with _handler_lock. It's reentrant because
+        # BTCP implementations are likely to sent a segment in response to
+        # one received
+        self._handler_lock = threading.RLock()
+        self._handler_stack = (BottomHandler(self),)
+
+        if debug_buffers is None:
+            debug_buffers = bool(os.environ.get("BTCP_DEBUG_BUFFERS"))
+        self._buffer_pool = SegmentBufferPool(pool_size, debug=debug_buffers)
+
+        if not _MSG_DONTWAIT:
+            # Without non-blocking reads we can not tell when to stop.
+            burst_size = 1
+        self._burst_size = burst_size
+        # burst_counts[n] is the number of wakeups that read n datagrams.
+        self.burst_counts = [0] * (burst_size + 1)
+
+        if busy_poll is None and os.environ.get("BTCP_BUSY_POLL"):
+            busy_poll = int(os.environ["BTCP_BUSY_POLL"])
+        if busy_poll is not None and not _MSG_DONTWAIT:
+            logger.warning("Busy polling needs non-blocking reads, disabled")
+            busy_poll = None
+        # The spin budget and latency histograms of busy polling mode, or None.
+        self.busy_poll = None if busy_poll is None else BusyPoll(busy_poll * 1000)
+
+        if reactor is None:
+            reactor = (busy_poll is None
+                       and os.environ.get("BTCP_REACTOR", "1") != "0")
+        if reactor is True:
+            reactor = default_reactor()
+        elif busy_poll is not None and reactor:
+            raise ValueError("Busy polling needs a network thread of its own")
+        self._reactor = reactor or None
+        # Timers whose callbacks the network thread or reactor runs, see
+        # btcp/timers.py.
+        self._wakeup = None
+        self._tick_requested = False
+        if self._reactor is not None:
+            self.timers = TimerGroup(self._reactor.timers, self._run_timer)
+        else:
+            self.timers = self._create_timers()
+
+        # Set before the socket is opened, which may fail, for destroy.
+        self._event = threading.Event()
+        self._thread = None
+        self._open_socket(local_ip, local_port, remote_ip, remote_port)
+
+        if transmit_thread is None:
+            transmit_thread = bool(os.environ.get("BTCP_TRANSMIT_THREAD"))
+        if transmit_thread:
+            self.transmitter = Transmitter(self._udp_socket)
+            self._handler_stack = (QueueingBottomHandler(self),)
+
+
+    def _create_timers(self):
+        """The timers of a lossy layer with a network thread of its own, which
+        waits for a Wakeup. Lossy layers whose network thread waits for
+        something else override this, and wakeup and destroy with it."""
+        self._wakeup = Wakeup()
+        return TimerService(self._wakeup.wake)
 
+    def _open_socket(self, local_ip, local_port, remote_ip, remote_port):
+        """Create, bind and connect the UDP socket. Lossy layers for other
+        datagram sockets override this, and keep the rest of LossyLayer."""
         self._udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
@@ -101,16 +440,37 @@ class LossyLayer:
         ## except OSError as err:
         ##     logger.debug("Could not set SO_NO_CHECK - testframework.py might not create corrupted packages reliably!  (unittests.py should still work fine.) ")
 
-        self._udp_socket.bind((local_ip, local_port))        
-
-        self._event = threading.Event()
-        self._thread = threading.Thread(target=self.handle_incoming_segments,
-                                        daemon=True)
+        self._udp_socket.bind((local_ip, local_port))
+        # Datagrams the kernel dropped because the receive buffer was full,
+        # None where it does not tell; see size_buffers.
+        self.kernel_drops = None
+        if _SO_RXQ_OVFL is not None and _RXQ_OVFL_ANCBUFSIZE:
+            try:
+                self._udp_socket.setsockopt(socket.SOL_SOCKET, _SO_RXQ_OVFL, 1)
+                self.kernel_drops = 0
+            except OSError:
+                pass
+        # Resolve the peer once and connect to it, so sending needs no
+        # address at all and the kernel filters out other senders.
+        self._remote_address = _resolve(remote_ip, remote_port)
+        self._udp_socket.connect(self._remote_address)
+        self._loopback = ipaddress.ip_address(self._remote_address[0]).is_loopback
+        self._batch_sender = BatchSender(self._udp_socket)
 
 
     def start_network_thread(self):
-        logger.info("Starting network thread")
-        self._thread.start()
+        if self.transmitter is not None:
+            self.transmitter.start()
+        if self._reactor is not None:
+            logger.info("Attaching to the reactor")
+            self._next_tick = time.monotonic_ns() + TICK_NS
+            self.timers.call_at(self._next_tick, self._reactor_tick)
+            self._reactor.register(self)
+        else:
+            logger.info("Starting network thread")
+            self._thread = threading.Thread(target=self.handle_incoming_segments,
+                                            daemon=True)
+            self._thread.start()
         logger.info("Lossy layer initialized, listening on "
                     "local address %s & port %i, "
                     "remote address %s & port %i",
@@ -133,9 +493,19 @@ class LossyLayer:
         Should be safe to call multiple times, so safe to call from __del__.
         """
         logger.info("LossyLayer.destroy() called.")
+        if self._reactor is not None:
+            self._reactor.unregister(self)
+            self._reactor = None
         if self._event is not None and self._thread is not None:
             self._event.set()
+            self._wakeup.wake()
             self._thread.join()
+        if self.transmitter is not None:
+            # Sends what was queued before destroy was called.
+            self.transmitter.stop()
+        if self._wakeup is not None:
+            self._wakeup.close()
+            self._wakeup = None
         if self._udp_socket is not None:
             self._udp_socket.close()
         self._event = None
@@ -144,16 +514,130 @@ class LossyLayer:
         logger.info("LossyLayer.destroy() finished.")
 
 
+    def wakeup(self):
+        """Have the network thread call lossy_layer_tick right away rather
+        than after TIMER_TICK ms, e.g. because the application queued data to
+        send. Safe to call from any thread; only ever wakes up the network
+        thread once for calls made before it gets to the tick.
+        """
+        if self._tick_requested:
+            return
+        reactor, wakeup = self._reactor, self._wakeup
+        if reactor is None and wakeup is None:
+            # Destroyed, e.g. by close() racing the application's send().
+            return
+        self._tick_requested = True
+        if reactor is not None:
+            reactor.request_tick(self)
+        else:
+            wakeup.wake()
+
+    def size_buffers(self, receive_window, send_window=None):
+        """Make the kernel buffers of the UDP socket big enough for
+        receive_window incoming and send_window outgoing segments.
+
+        A burst the receive buffer can not hold is dropped by the kernel,
+        which looks just like loss on the network to bTCP; the sockets call
+        this with the windows they exchange in the handshake. Buffers are
+        never made smaller than they are, and the kernel caps them at
+        net.core.rmem_max and net.core.wmem_max.
+        """
+        for option, window in ((socket.SO_RCVBUF, receive_window),
+                               (socket.SO_SNDBUF, send_window)):
+            if not window:
+                continue
+            # The kernel reports, and allots, twice the size that is set;
+            # the other half covers its bookkeeping, and gives us some slack.
+            wanted = window * SEGMENT_TRUESIZE
+            if self._udp_socket.getsockopt(socket.SOL_SOCKET, option) >= wanted:
+                continue
+            self._udp_socket.setsockopt(socket.SOL_SOCKET, option, wanted)
+            size = self._udp_socket.getsockopt(socket.SOL_SOCKET, option)
+            if size < wanted:
+                logger.warning("Kernel limits socket buffer to %i bytes, "
+                               "%i needed for a window of %i segments",
+                               size, wanted, window)
+
+    def statistics(self):
+        """Counters of the lossy layer, as a dict.
+
+        kernel_drops is the number of segments the kernel dropped because
+        the receive buffer was full, so loss caused by too small a buffer
+        can be told apart from loss emulated by effect handlers. It is None
+        if the platform does not report it.
+
+        With a transmit thread, transmit holds its counters and queueing
+        latency, see btcp/transmitter.py.
+        """
+        stats = dict(kernel_drops=self.kernel_drops,
+                     receive_buffer=None,
+                     send_buffer=None,
+                     buffer_pool_misses=self._buffer_pool.misses,
+                     burst_counts=list(self.burst_counts))
+        if self.transmitter is not None:
+            stats.update(transmit=self.transmitter.summary())
+        if self._udp_socket is not None:
+            stats.update(
+                receive_buffer=self._udp_socket.getsockopt(socket.SOL_SOCKET,
+                                                           socket.SO_RCVBUF),
+                send_buffer=self._udp_socket.getsockopt(socket.SOL_SOCKET,
+                                                        socket.SO_SNDBUF))
+        return stats
+
     def send_segment(self, segment):
         """Put the segment into the network
 
         Should be safe to call from either the application thread or the
         network thread.
+
+        segment may be any bytes-like object, e.g. the memoryview returned by
+        a SegmentEncoder. It is only used for the duration of this call.
         """
-        logger.debug("Attempting to send segment:")
+        if tracing.enabled:
+            tracing.record_segment(TraceEvent.SEGMENT_OUT, segment)
+        handlers = self._handler_stack
+        if len(handlers) == 1:
+            handlers[0].send_segment(segment)
+            return
         with self._handler_lock:
+            if type(segment) is not bytes:
+                # Effect handlers may hold on to, hash or compare segments,
+                # so they only ever get to see immutable copies.
+                segment = bytes(segment)
             self._handler_stack[-1].send_segment(segment)
 
+    def send_segments(self, segments):
+        """Put a batch of segments into the network.
+
+        Same as calling send_segment for every segment, but with effect
+        handlers active the handler lock is only taken once, and the batch
+        goes down the handler stack as a whole where the handlers allow it.
+
+        segments is iterated exactly once, in order, and every segment only
+        has to stay valid until the next one is taken from it; so a generator
+        may yield the views returned by a single SegmentEncoder.
+        """
+        if tracing.enabled:
+            segments = _traced(segments)
+        handlers = self._handler_stack
+        if len(handlers) == 1:
+            handlers[0].send_segments(segments)
+            return
+        with self._handler_lock:
+            segments = [bytes(segment) for segment in segments]
+            send_segments(self._handler_stack[-1], segments)
+
+    @property
+    def trusted(self):
+        """Whether segments can not get corrupted on their way to the peer.
+
+        That is the case if the peer is on this host (a loopback address) and
+        no effect handlers are active: any handler could corrupt segments.
+        Sockets check this both when negotiating trusted-transport mode and
+        for every segment they send or receive in that mode.
+        """
+        return self._loopback and len(self._handler_stack) == 1
+
     def effect(self, handler_creator, *handler_args, **handler_kwargs):
         """Temporarily changes the behaviour of the lossy layer by adding
         a handler that has first dibs on incoming segments from the UDP socket,
@@ -169,6 +653,12 @@ class LossyLayer:
             - segment_received(self, segment)
             - tick(self)
 
+        Handlers may also implement segments_received(self, segments) and
+        send_segments(self, segments), which get a whole batch of segments.
+        Handlers without them get the batch one segment at a time.
+        BasicHandler only passes batches on as such if the subclass does not
+        override the corresponding single segment method.
+
         The tick method should always call the tick method on the old handler.
 
         A trivial handler would have the first two methods pass the segment to the corresponding method 
@@ -179,18 +669,48 @@ class LossyLayer:
         """
         return temporary_handler(self, handler_creator, *handler_args, **handler_kwargs)
  
+def _resolve(host, port):
+    """Resolve host and port to the IPv4 socket address to send to."""
+    return socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_DGRAM)[0][4]
+
+def _traced(segments):
+    for segment in segments:
+        tracing.record_segment(TraceEvent.SEGMENT_OUT, segment)
+        yield segment
+
+def send_segments(handler, segments):
+    """Pass a batch of segments to be sent to handler, as one batch if it
+    implements send_segments."""
+    handler_send_segments = getattr(handler, "send_segments", None)
+    if handler_send_segments is not None:
+        handler_send_segments(segments)
+    else:
+        for segment in segments:
+            handler.send_segment(segment)
+
+def deliver_segments(handler, segments):
+    """Pass a burst of received segments to handler, as one batch if it
+    implements segments_received."""
+    segments_received = getattr(handler, "segments_received", None)
+    if segments_received is not None:
+        segments_received(segments)
+    else:
+        for segment in segments:
+            handler.segment_received(segment)
+
 @contextlib.contextmanager
 def temporary_handler(lossy_layer, handler_creator, *args, **kwargs):
     with lossy_layer._handler_lock:
         old_handler = lossy_layer._handler_stack[-1]
         handler = handler_creator(old_handler, *args, **kwargs)
-        lossy_layer._handler_stack.append(handler)
+        lossy_layer._handler_stack += (handler,)
     try:
         yield handler
     finally:
         with lossy_layer._handler_lock:
-            popped_handler = lossy_layer._handler_stack.pop()
+            *handlers, popped_handler = lossy_layer._handler_stack
             assert(handler == popped_handler)
+            lossy_layer._handler_stack = tuple(handlers)
 
 class BasicHandler:
     """A default handler implementation that passes all segment to the old handler."""
@@ -203,6 +723,20 @@ class BasicHandler:
     def segment_received(self, segment):
         self._old_handler.segment_received(segment)
 
+    def send_segments(self, segments):
+        if type(self).send_segment is BasicHandler.send_segment:
+            send_segments(self._old_handler, segments)
+        else:
+            for segment in segments:
+                self.send_segment(segment)
+
+    def segments_received(self, segments):
+        if type(self).segment_received is BasicHandler.segment_received:
+            deliver_segments(self._old_handler, segments)
+        else:
+            for segment in segments:
+                self.segment_received(segment)
+
     def tick(self):
         self._old_handler.tick()
 
@@ -214,17 +748,48 @@ class BottomHandler:
 
     def send_segment(self, segment):
         # we do not log here on purpose
-        bytes_sent = self._lossy_layer._udp_socket.sendto(segment,
-                                             (self._lossy_layer._remote_ip,
-                                              self._lossy_layer._remote_port))
+        try:
+            bytes_sent = self._lossy_layer._udp_socket.send(segment)
+        except ConnectionRefusedError:
+            # Reported for an earlier segment, see handle_incoming_segments.
+            return
         if bytes_sent != len(segment):
             logger.critical("The lossy layer was only able to send %i bytes "
                             "of a segment!",
                             bytes_sent)
 
+    def send_segments(self, segments):
+        # Runs of up to GSO_MAX_SEGMENTS segments per system call, see
+        # btcp/gso.py.
+        self._lossy_layer._batch_sender.send_segments(segments)
+
     def segment_received(self, segment):
+        if tracing.enabled:
+            tracing.record_segment(TraceEvent.SEGMENT_IN, segment)
         self._lossy_layer._bTCP_socket.lossy_layer_segment_received(segment)
 
+    def segments_received(self, segments):
+        if tracing.enabled:
+            for segment in segments:
+                tracing.record_segment(TraceEvent.SEGMENT_IN, segment)
+        if len(segments) == 1:
+            self._lossy_layer._bTCP_socket.lossy_layer_segment_received(segments[0])
+        else:
+            self._lossy_layer._bTCP_socket.lossy_layer_segments_received(segments)
+
     def tick(self):
         self._lossy_layer._bTCP_socket.lossy_layer_tick()
 
+
+class QueueingBottomHandler(BottomHandler):
+    """Bottom handler queueing segments for the lossy layer's transmit
+    thread, see btcp/transmitter.py."""
+
+    def send_segment(self, segment):
+        # Segments are only valid for the duration of the call.
+        self._lossy_layer.transmitter.enqueue(bytes(segment))
+
+    def send_segments(self, segments):
+        enqueue = self._lossy_layer.transmitter.enqueue
+        for segment in segments:
+            enqueue(bytes(segment))
@@ -0,0 +1,199 @@
+"""In-process transport for the lossy layer.
+
+MemoryLossyLayer connects two bTCP sockets in the same process without any
+UDP: every lossy layer registers its local address in a process-wide table,
+and sending a segment appends a copy of it to the inbox of the lossy layer
+registered at the remote address, then sets that layer's doorbell event. The
+inbox is a collections.deque, whose append and popleft are atomic, so
+neither side takes a lock to pass segments.
+
+Everything above MemoryBottomHandler is the same as for LossyLayer: the
+network thread, bursts, ticks, timers and the handler stack, so effect()
+handlers work unchanged. Like a UDP socket's receive buffer the inbox is
+bounded; segments sent to a full inbox, or to an address nobody registered,
+are dropped.
+
+Select it with transport="memory" on the bTCP sockets, see
+btcp/transports.py.
+"""
+
+import collections
+import errno
+import logging
+import threading
+
+import signal
+import time
+
+from btcp.constants import *
+from btcp.lossy_layer import (LossyLayer, BottomHandler, DEFAULT_BURST_SIZE,
+                              TICK_NS, _resolve)
+from btcp.timers import TimerService
+
+
+logger = logging.getLogger(__name__)
+
+
+INBOX_SIZE = 1024
+
+# Lossy layers by their local address.
+_endpoints = {}
+_endpoints_lock = threading.Lock()
+
+
+class MemoryLossyLayer(LossyLayer):
+    """Lossy layer delivering segments to another MemoryLossyLayer in the same
+    process, see the module docstring."""
+
+    def handle_incoming_segments(self):
+        """The main method of the network thread, see
+        LossyLayer.handle_incoming_segments. Waits on the doorbell event
+        instead of a socket."""
+        event, doorbell, inbox = self._event, self._doorbell, self._inbox
+        burst_size, burst_counts = self._burst_size, self.burst_counts
+
+        logger.info("Starting handle_incoming_segments")
+        next_tick = time.monotonic_ns() + TICK_NS
+        while not event.is_set():
+            try:
+                if doorbell.wait(self._wait_timeout(next_tick)):
+                    # Clear before draining: a segment appended after the
+                    # drain sets the event again.
+                    doorbell.clear()
+                    segments = []
+                    try:
+                        while len(segments) < burst_size:
+                            segments.append(inbox.popleft())
+                    except IndexError:
+                        pass
+                    else:
+                        # Burst cap reached, come back for the rest.
+                        doorbell.set()
+                    burst_counts[len(segments)] += 1
+                    if segments:
+                        self._deliver(segments)
+                        now = time.monotonic_ns()
+                        next_tick = now + TICK_NS
+                    else:
+                        now = time.monotonic_ns()
+                else:
+                    now = time.monotonic_ns()
+                    if now >= next_tick:
+                        self._tick()
+                        next_tick = now + TICK_NS
+                if self._tick_requested:
+                    self._tick_requested = False
+                    self._tick()
+                self._run_timers(now)
+            except Exception as e:
+                logger.exception("Exception in the network thread")
+                signal.raise_signal(signal.SIGTERM)
+                raise
+
+    def __init__(self, btcp_socket, local_ip, local_port, remote_ip, remote_port,
+                 burst_size=DEFAULT_BURST_SIZE, inbox_size=INBOX_SIZE):
+        """burst_size is the maximum number of segments the network thread
+        takes from the inbox per wakeup. inbox_size is the number of segments
+        the inbox holds before further segments are dropped.
+        """
+        logger.info("MemoryLossyLayer.__init__() was called")
+        self._inbox = collections.deque()
+        self._inbox_size = inbox_size
+        # Set by senders, timers and wakeup; the network thread waits for it.
+        self._doorbell = threading.Event()
+        self._receive_lock = threading.Lock()
+        self.dropped = 0
+        self._local_key = None
+        # Segments are copied into the inbox, there is no buffer pool, and
+        # the network thread does not wait in select.
+        super().__init__(btcp_socket, local_ip, local_port, remote_ip, remote_port,
+                         pool_size=0, burst_size=burst_size, reactor=False,
+                         transmit_thread=False)
+        self._handler_stack = (MemoryBottomHandler(self),)
+
+    def _create_timers(self):
+        """See LossyLayer._create_timers."""
+        return TimerService(self._doorbell.set)
+
+    def _open_socket(self, local_ip, local_port, remote_ip, remote_port):
+        """See LossyLayer._open_socket. Registers the local address instead
+        of binding a socket to it."""
+        # Nothing between the two sockets can corrupt segments.
+        self._loopback = True
+        local_key = _resolve(local_ip, local_port)
+        self._remote_key = _resolve(remote_ip, remote_port)
+        with _endpoints_lock:
+            if local_key in _endpoints:
+                raise OSError(errno.EADDRINUSE, "Address already in use",
+                              local_key)
+            _endpoints[local_key] = self
+        self._local_key = local_key
+
+    def destroy(self):
+        """Stop the network thread and unregister the local address.
+
+        Should be safe to call multiple times, so safe to call from __del__.
+        """
+        logger.info("MemoryLossyLayer.destroy() called.")
+        if self._event is not None and self._thread is not None:
+            self._event.set()
+            self._doorbell.set()
+            self._thread.join()
+        with _endpoints_lock:
+            if _endpoints.get(self._local_key) is self:
+                del _endpoints[self._local_key]
+        self._event = None
+        self._thread = None
+
+    def wakeup(self):
+        """See LossyLayer.wakeup."""
+        if not self._tick_requested:
+            self._tick_requested = True
+            self._doorbell.set()
+
+    def size_buffers(self, receive_window, send_window=None):
+        """See LossyLayer.size_buffers. The inbox has a fixed size."""
+
+    def statistics(self):
+        """See LossyLayer.statistics. dropped counts the segments that found
+        the inbox full."""
+        return dict(dropped=self.dropped, burst_counts=list(self.burst_counts))
+
+    def _receive(self, segments):
+        """Called by the peer's bottom handler, from the peer's threads."""
+        # Copy: the segments may be views of the sender's encoder. Done
+        # before taking the lock, segments may be a generator.
+        segments = [bytes(segment) for segment in segments]
+        inbox = self._inbox
+        # Both of the peer's threads send: the lock keeps the inbox within
+        # its bound and the drop count exact. The network thread only takes
+        # segments out, which needs no lock.
+        with self._receive_lock:
+            room = max(self._inbox_size - len(inbox), 0)
+            inbox.extend(segments[:room])
+            self.dropped += max(len(segments) - room, 0)
+
+
+class MemoryBottomHandler(BottomHandler):
+    """Bottom handler passing segments to the peer MemoryLossyLayer."""
+
+    def send_segment(self, segment):
+        peer = _endpoints.get(self._lossy_layer._remote_key)
+        if peer is not None:
+            peer._receive((segment,))
+            # Event.set takes a lock, is_set does not. If the event is still
+            # set, the network thread has yet to clear it and drain the inbox.
+            if not peer._doorbell.is_set():
+                peer._doorbell.set()
+
+    def send_segments(self, segments):
+        peer = _endpoints.get(self._lossy_layer._remote_key)
+        if peer is None:
+            # Still consume the segments: generators passed in may have
+            # side effects, like registering segments for retransmission.
+            for segment in segments:
+                pass
+            return
+        peer._receive(segments)
+        if not peer._doorbell.is_set():
+            peer._doorbell.set()
@@ -0,0 +1,154 @@
+"""Process-wide reactor for the network side of many lossy layers.
+
+A LossyLayer with its own network thread costs a thread and a select loop
+per bTCP socket. By default, LossyLayers instead attach to one Reactor per
+process: a single thread that waits for all their UDP sockets at once with
+a selectors.DefaultSelector (epoll on Linux), and runs the timers of all of
+them, their ticks included, from one TimerService heap.
+
+For every lossy layer the reactor does what its network thread would do:
+read bursts of datagrams when the socket becomes readable, pass them up
+the handler stack, call lossy_layer_tick after TIMER_TICK ms without
+segments, and run its timers. Each lossy layer's timers are a TimerGroup on
+the shared service, so destroying the layer cancels them all.
+
+The reactor holds its lock while it calls into a lossy layer, and
+unregistering a layer takes the same lock, so once LossyLayer.destroy has
+returned the reactor never calls into that layer again. The flip side is
+that a handler that blocks stalls all lossy layers of the process, not
+just its own.
+
+Pass reactor=False to LossyLayer, or set BTCP_REACTOR=0, for the original
+thread per lossy layer. Busy polling (btcp/busy_poll.py) always uses a
+thread of its own. A forked child gets a fresh default reactor, the
+parent's thread does not exist there.
+"""
+
+import collections
+import logging
+import os
+import selectors
+import signal
+import threading
+import time
+
+from btcp.timers import TimerService
+from btcp.wakeup import Wakeup
+
+
+logger = logging.getLogger(__name__)
+
+
+class Reactor:
+    """One thread multiplexing the UDP sockets of any number of lossy layers,
+    see the module docstring."""
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        # Interrupts the wait when a socket is registered, for selectors that
+        # do not pick up new sockets while waiting, when a lossy layer asks
+        # for a tick, or for a timer that is due earlier.
+        self._wakeup = Wakeup()
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
+        self.timers = TimerService(self._wakeup.wake)
+        # Held while calling into lossy layers. Reentrant, because a lossy
+        # layer may be destroyed from one of its own callbacks.
+        self._lock = threading.RLock()
+        # Lossy layers that asked for a tick with LossyLayer.wakeup.
+        self._tick_requests = collections.deque()
+        self._thread = None
+        self._pid = os.getpid()
+
+    def register(self, lossy_layer):
+        """Start receiving for lossy_layer, starting the reactor thread if
+        it is not running yet."""
+        with self._lock:
+            self._selector.register(lossy_layer._udp_socket,
+                                    selectors.EVENT_READ, lossy_layer)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name="btcp-reactor", daemon=True)
+                self._thread.start()
+        self._wakeup.wake()
+
+    def unregister(self, lossy_layer):
+        """Stop receiving for lossy_layer and cancel its timers. Once this
+        returns the reactor does not call into lossy_layer anymore.
+
+        Does nothing if lossy_layer is not registered.
+        """
+        with self._lock:
+            # In a forked child the selector is still the parent's epoll
+            # instance, which must not be touched.
+            if os.getpid() == self._pid:
+                try:
+                    self._selector.unregister(lossy_layer._udp_socket)
+                except (KeyError, ValueError):
+                    pass
+            lossy_layer.timers.close()
+
+    def request_tick(self, lossy_layer):
+        """Call lossy_layer_tick of lossy_layer's socket from the reactor
+        thread as soon as possible, see LossyLayer.wakeup."""
+        self._tick_requests.append(lossy_layer)
+        self._wakeup.wake()
+
+    def _run(self):
+        selector, timers, lock = self._selector, self.timers, self._lock
+        tick_requests = self._tick_requests
+        fd_map = selector.get_map()
+        self._wakeup.owner = threading.get_ident()
+
+        logger.info("Starting the reactor")
+        while True:
+            try:
+                # Every registered lossy layer has a tick timer, so this never
+                # waits longer than TIMER_TICK ms while there is work.
+                deadline = timers.next_deadline()
+                timeout = None
+                if deadline is not None:
+                    timeout = max(deadline - time.monotonic_ns(), 0) / 1e9
+                events = selector.select(timeout)
+                with lock:
+                    for key, mask in events:
+                        lossy_layer = key.data
+                        if lossy_layer is None:
+                            self._wakeup.drain()
+                        elif fd_map.get(key.fd) is key:
+                            # Only if it was not unregistered after select
+                            # returned.
+                            lossy_layer._reactor_readable()
+                    while tick_requests:
+                        lossy_layer = tick_requests.popleft()
+                        if lossy_layer._reactor is self:
+                            lossy_layer._reactor_tick_now()
+                    timers.run_expired()
+            except Exception as e:
+                logger.exception("Exception in the reactor thread")
+                signal.raise_signal(signal.SIGTERM)
+                raise
+
+
+_default_reactor = None
+_default_reactor_lock = threading.Lock()
+
+
+def default_reactor():
+    """Return the process-wide reactor, creating it if needed."""
+    global _default_reactor
+    with _default_reactor_lock:
+        if _default_reactor is None:
+            _default_reactor = Reactor()
+        return _default_reactor
+
+
+def _forget_default_reactor():
+    # The child shares the parent's selector and wakeup sockets, but not its
+    # thread; start over.
+    global _default_reactor, _default_reactor_lock
+    _default_reactor = None
+    _default_reactor_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_default_reactor)
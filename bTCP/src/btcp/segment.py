@@ -0,0 +1,192 @@
+"""Fast encoding of bTCP segments.
+
+BTCPSocket.build_segment_header is nice and explicit, but sending a segment
+with it means packing the header twice (with and without checksum),
+computing the checksum over a temporary copy, and concatenating header and
+payload into yet another bytes object. The helpers here do all of that in a
+single preallocated buffer.
+
+AckTemplate goes one step further for pure ACKs, whose payload is always
+zero: only the header is patched and summed.
+
+Likewise, SegmentView decodes received segments without building tuples or
+copying the payload.
+"""
+
+import struct
+
+from btcp import checksum
+from btcp.constants import *
+
+
+# Same layout as BTCPSocket.build_segment_header, compiled once.
+HEADER_STRUCT = struct.Struct("!HHBBHH")
+CKSUM_STRUCT = struct.Struct("!H")
+CKSUM_OFFSET = 8
+
+# Flag bit next to SYN (4), ACK (2) and FIN (1). On a SYN or SYN/ACK it
+# offers or accepts trusted-transport mode, on any other segment it marks the
+# checksum field as not computed (0). See BTCPSocket._checksum_ok.
+NOCKSUM_FLAG = 8
+
+_ZEROS = memoryview(bytes(PAYLOAD_SIZE))
+
+
+class SegmentEncoder:
+    """Packs header, payload and checksum of a segment into a reusable
+    SEGMENT_SIZE bytearray.
+
+    encode returns a memoryview of that buffer, which is only valid until the
+    next call to encode on the same encoder. Pass it to
+    LossyLayer.send_segment straight away, and do not keep it around; copy
+    it with bytes() if you really have to. Because the buffer is shared, an
+    encoder must only be used from one thread.
+    """
+
+    def __init__(self, cksum_func=None):
+        """cksum_func computes the checksum of a complete segment, it defaults
+        to the process-wide backend from btcp.checksum.
+        """
+        self._buf = bytearray(SEGMENT_SIZE)
+        self._view = memoryview(self._buf)
+        self._header = self._view[:HEADER_SIZE]
+        self._cksum_func = cksum_func
+        # How much of the payload area may still hold old, nonzero data.
+        self._dirty = 0
+
+    def encode(self, seqnum, acknum,
+               syn_set=False, ack_set=False, fin_set=False,
+               window=0x01, payload=b'', payload_sum=None, nocksum=False):
+        """Encode a segment and return a memoryview of it.
+
+        payload is padded with zeroes to PAYLOAD_SIZE. If payload_sum, the
+        partial checksum of the payload (see btcp.checksum.partial_sum), is
+        known, only the header is summed to compute the checksum.
+
+        nocksum sets NOCKSUM_FLAG. Unless syn_set is also given, this leaves
+        the checksum field 0 instead of computing it.
+        """
+        buf = self._buf
+        datalen = len(payload)
+        HEADER_STRUCT.pack_into(buf, 0, seqnum, acknum,
+                                nocksum << 3 | syn_set << 2 | ack_set << 1 | fin_set,
+                                window, datalen, 0)
+        end = HEADER_SIZE + datalen
+        buf[HEADER_SIZE:end] = payload
+        if self._dirty > end:
+            buf[end:self._dirty] = _ZEROS[:self._dirty - end]
+        self._dirty = end
+
+        if nocksum and not syn_set:
+            return self._view
+        if payload_sum is not None:
+            cksum = checksum.finish(checksum.add(
+                checksum.partial_sum(self._header), payload_sum))
+        elif self._cksum_func is not None:
+            cksum = self._cksum_func(buf)
+        else:
+            cksum = checksum.in_cksum(buf)
+        CKSUM_STRUCT.pack_into(buf, CKSUM_OFFSET, cksum)
+        return self._view
+
+
+class AckTemplate:
+    """Precomputed pure ACK segment: SEGMENT_SIZE bytes with an all-zero
+    payload, of which only the header is ever rewritten.
+
+    The zero payload adds nothing to the one's complement sum, so the
+    checksum is computed from the three nonzero header words directly
+    instead of summing the whole segment. Like SegmentEncoder, encode
+    returns a view of a shared buffer that is only valid until the next
+    call, so a template must only be used from one thread.
+    """
+
+    def __init__(self):
+        self._buf = bytearray(SEGMENT_SIZE)
+        self._view = memoryview(self._buf)
+
+    def encode(self, seqnum, acknum, window=0x01, fin_set=False,
+               nocksum=False):
+        """Fill in the header of the ACK and return a memoryview of it."""
+        flags = nocksum << 3 | 2 | fin_set
+        cksum = 0
+        if not nocksum:
+            # seqnum, acknum, flags/window; length and payload are zero.
+            total = seqnum + acknum + (flags << 8 | window)
+            total = (total & 0xFFFF) + (total >> 16)
+            cksum = ~((total & 0xFFFF) + (total >> 16)) & 0xFFFF
+        HEADER_STRUCT.pack_into(self._buf, 0, seqnum, acknum, flags, window,
+                                0, cksum)
+        return self._view
+
+
+class SegmentView:
+    """Zero-copy view of a received segment.
+
+    Wraps a memoryview of the datagram. The header is only decoded on first
+    access of one of its fields, and payload is a memoryview slice of the
+    datagram rather than a copy. The view is valid as long as the underlying
+    buffer is: copy the payload with bytes() before handing it to another
+    thread if the lossy layer may reuse that buffer.
+    """
+    __slots__ = ("segment", "_fields")
+
+    def __init__(self, segment):
+        self.segment = memoryview(segment)
+        self._fields = None
+
+    def _decode(self):
+        self._fields = HEADER_STRUCT.unpack_from(self.segment)
+        return self._fields
+
+    @property
+    def seqnum(self):
+        return (self._fields or self._decode())[0]
+
+    @property
+    def acknum(self):
+        return (self._fields or self._decode())[1]
+
+    @property
+    def flags(self):
+        return (self._fields or self._decode())[2]
+
+    @property
+    def syn_set(self):
+        return bool(self.flags & 4)
+
+    @property
+    def ack_set(self):
+        return bool(self.flags & 2)
+
+    @property
+    def fin_set(self):
+        return bool(self.flags & 1)
+
+    @property
+    def nocksum_set(self):
+        return bool(self.flags & NOCKSUM_FLAG)
+
+    @property
+    def window(self):
+        return (self._fields or self._decode())[3]
+
+    @property
+    def length(self):
+        return (self._fields or self._decode())[4]
+
+    @property
+    def checksum(self):
+        return (self._fields or self._decode())[5]
+
+    @property
+    def payload(self):
+        return self.segment[HEADER_SIZE:HEADER_SIZE + self.length]
+
+    def __repr__(self):
+        flags = self.flags
+        return (f"SegmentView(seq={self.seqnum}, ack={self.acknum}, "
+                f"flags={'S' if flags & 4 else '-'}"
+                f"{'A' if flags & 2 else '-'}{'F' if flags & 1 else '-'}, "
+                f"window={self.window}, len={self.length}, "
+                f"cksum={self.checksum:#06x})")
@@ -1,5 +1,9 @@
 from btcp.btcp_socket import BTCPSocket, BTCPStates, BTCPSignals, raise_NotImplementedError
 from btcp.lossy_layer import LossyLayer
+from btcp import transports
+from btcp.segment import SegmentView
+from btcp import tracing
+from btcp.tracing import TraceEvent
 from btcp.constants import *
 
 import queue
@@ -42,14 +46,35 @@ class BTCPServerSocket(BTCPSocket):
     * See <https://docs.python.org/3/library/queue.html>
     """
 
+    # AsyncBTCPServerSocket replaces this with a lossy layer that runs on an
+    # asyncio event loop instead of in a network thread.
+    _lossy_layer_class = LossyLayer
 
-    def __init__(self, window, timeout, isn=None):
+    def __init__(self, window, timeout, isn=None, checksum_backend=None,
+                 trusted_transport=False, transport=None):
         """Constructor for the bTCP server socket. Allocates local resources
         and starts an instance of the Lossy Layer.
+
+        checksum_backend optionally names the btcp.checksum backend this
+        socket uses instead of the process-wide default.
+
+        trusted_transport allows a client to switch off checksums for the
+        connection during the SYN exchange. The server only agrees while its
+        lossy layer is trusted, i.e. on loopback without effect handlers.
+
+        transport optionally names the lossy layer implementation from
+        btcp.transports to use instead of UDP, see get_transport there.
         """
         logger.debug("__init__() called.")
-        super().__init__(window, timeout, isn)
-        self._lossy_layer = LossyLayer(self, SERVER_IP, SERVER_PORT, CLIENT_IP, CLIENT_PORT)
+        super().__init__(window, timeout, isn, checksum_backend,
+                         trusted_transport)
+        lossy_layer_class = self._lossy_layer_class
+        if transport is not None:
+            lossy_layer_class = transports.get_transport(transport)
+        self._lossy_layer = lossy_layer_class(self, SERVER_IP, SERVER_PORT, CLIENT_IP, CLIENT_PORT)
+        # Room for the segments of our own window, the client may send that
+        # many at once.
+        self._lossy_layer.size_buffers(self._window)
 
         # The data buffer used by lossy_layer_segment_received to move data
         # from the network thread into the application thread. Bounded in size.
@@ -60,6 +85,11 @@ class BTCPServerSocket(BTCPSocket):
         self._recvbuf = queue.Queue(maxsize=1000)
         logger.info("Socket initialized with recvbuf size 1000")
 
+        # Next sequence number expected from the client.
+        self._acknum = 0
+        # Retransmits the SYN/ACK while waiting for the client's ACK.
+        self._synack_timer = None
+
         # Make sure the example timer exists from the start.
         self._example_timer = None
         self._lossy_layer.start_network_thread()
@@ -117,18 +147,33 @@ class BTCPServerSocket(BTCPSocket):
         function for each state.
         """
         logger.debug("lossy_layer_segment_received called")
-        logger.debug(segment)
         #raise_NotImplementedError("Only rudimentary implementation of lossy_layer_segment_received present. Read the comments & code of server_socket.py, then remove the NotImplementedError.")
+        if not self._checksum_ok(segment):
+            logger.warning("Checksum failed - ignoring segment")
+            return
+        self._verified_segment_received(segment)
 
+
+    def _verified_segment_received(self, segment):
+        """State machine part of lossy_layer_segment_received, called once the
+        checksum of segment has been verified. Also called for every valid
+        segment of a burst by lossy_layer_segments_received.
+        """
+        # The state helpers below get a SegmentView, not the raw datagram.
+        segment = SegmentView(segment)
         match self._state:
             case BTCPStates.CLOSED:
                 self._closed_segment_received(segment)
+            case BTCPStates.ACCEPTING:
+                self._accepting_segment_received(segment)
+            case BTCPStates.SYN_RCVD:
+                self._syn_rcvd_segment_received(segment)
+            case BTCPStates.ESTABLISHED:
+                self._established_segment_received(segment)
             case BTCPStates.CLOSING:
                 self._closing_segment_received(segment)
             case _:
                 self._other_segment_received(segment)
-
-        self._expire_timers()
         return
 
 
@@ -140,11 +185,9 @@ class BTCPServerSocket(BTCPSocket):
         logger.warning("Normally we wouldn't process this, but the "
                        "rudimentary implementation never leaves the CLOSED "
                        "state.")
-        # Get length from header. Change this to a proper segment header unpack
-        # after implementing BTCPSocket.unpack_segment_header in btcp_socket.py
-        datalen, = struct.unpack("!H", segment[6:8])
-        # Slice data from incoming segment.
-        chunk = segment[HEADER_SIZE:HEADER_SIZE + datalen]
+        # Copy data from incoming segment: the segment's buffer goes back to
+        # the lossy layer's pool once we return.
+        chunk = bytes(segment.payload)
         # Pass data into receive buffer so that the application thread can
         # retrieve it.
         try:
@@ -160,6 +203,87 @@ class BTCPServerSocket(BTCPSocket):
             logger.debug(chunk)
 
 
+    def _accepting_segment_received(self, segment):
+        """Helper method handling received segment in ACCEPTING state: wait
+        for the client's SYN and answer it with a SYN/ACK.
+        """
+        logger.debug("_accepting_segment_received called")
+        if not segment.syn_set or segment.ack_set or segment.fin_set:
+            logger.info("Ignoring non-SYN segment while accepting")
+            return
+        # Trusted-transport mode: the client offers it by setting
+        # NOCKSUM_FLAG on its SYN, we agree by echoing the flag.
+        self._skip_checksum = (segment.nocksum_set and self._trusted_transport
+                               and self._lossy_layer.trusted)
+        self._acknum = (segment.seqnum + 1) & 0xFFFF
+        self._peer_window_received(segment.window)
+        self._set_state(BTCPStates.SYN_RCVD)
+        self._send_synack()
+
+
+    def _syn_rcvd_segment_received(self, segment):
+        """Helper method handling received segment in SYN_RCVD state: the
+        client's ACK, or its first data segment if that ACK got lost,
+        completes the handshake.
+        """
+        logger.debug("_syn_rcvd_segment_received called")
+        if segment.syn_set:
+            logger.info("SYN retransmitted, our SYN/ACK got lost")
+            self._send_synack()
+            return
+        expected_ack = (self._seqnum + 1) & 0xFFFF
+        if ((segment.ack_set and segment.acknum == expected_ack)
+                or segment.seqnum == self._acknum):
+            self._seqnum = expected_ack
+            self._synack_timer.cancel()
+            self._synack_timer = None
+            self._set_state(BTCPStates.ESTABLISHED)
+            logger.info("Handshake complete, moved to ESTABLISHED")
+            if segment.length:
+                self._established_segment_received(segment)
+
+
+    def _established_segment_received(self, segment):
+        """Helper method handling received segment in ESTABLISHED state:
+        deliver in-order data to the receive buffer and acknowledge it
+        cumulatively.
+        """
+        if segment.syn_set:
+            logger.info("SYN retransmitted after handshake completed")
+            return
+        if not segment.length:
+            return
+        if segment.seqnum == self._acknum:
+            try:
+                # Copy data from incoming segment: the segment's buffer goes
+                # back to the lossy layer's pool once we return.
+                self._recvbuf.put_nowait(bytes(segment.payload))
+                self._acknum = (self._acknum + 1) & 0xFFFF
+            except queue.Full:
+                logger.warning("Receive buffer full, not acknowledging")
+        self._lossy_layer.send_segment(self._ack_template.encode(
+            self._seqnum, self._acknum, window=self._window,
+            nocksum=self._nocksum()))
+
+
+    def _send_synack(self):
+        self._lossy_layer.send_segment(self._encoder.encode(
+            self._seqnum, self._acknum, syn_set=True, ack_set=True,
+            window=self._window, nocksum=self._skip_checksum))
+        if self._synack_timer:
+            self._synack_timer.cancel()
+        self._synack_timer = self._lossy_layer.timers.call_later(
+            self.timeout_nanosecs, self._synack_timeout)
+
+
+    def _synack_timeout(self):
+        if self._state == BTCPStates.SYN_RCVD:
+            logger.info("No ACK for our SYN/ACK, retransmitting it")
+            if tracing.enabled:
+                tracing.record(TraceEvent.TIMER, "synack")
+            self._send_synack()
+
+
     def _closing_segment_received(self, segment):
         """Helper method handling received segment in CLOSING state
 
@@ -204,35 +328,31 @@ class BTCPServerSocket(BTCPSocket):
         """
         logger.debug("lossy_layer_tick called")
         self._start_example_timer()
-        self._expire_timers()
         #raise_NotImplementedError("No implementation of lossy_layer_tick present. Read the comments & code of server_socket.py.")
 
 
-    # The following two functions show you how you could implement a (fairly
-    # inaccurate) but easy-to-use timer.
-    # You *do* have to call _expire_timers() from *both* lossy_layer_tick
-    # and lossy_layer_segment_received, for reasons explained in
-    # lossy_layer_tick.
+    # The following two functions show you how you could implement a timer
+    # with the timer service of the lossy layer (see btcp/timers.py). The
+    # network thread calls _example_timer_expired once the timeout has
+    # passed, whether segments are arriving or not.
     def _start_example_timer(self):
         if not self._example_timer:
             logger.debug("Starting example timer.")
-            # Time in *nano*seconds, not milli- or microseconds.
-            # Using a monotonic clock ensures independence of weird stuff
-            # like leap seconds and timezone changes.
-            self._example_timer = time.monotonic_ns()
+            # Time in *nano*seconds, not milli- or microseconds, on the
+            # time.monotonic_ns() clock. Using a monotonic clock ensures
+            # independence of weird stuff like leap seconds and timezone
+            # changes.
+            self._example_timer = self._lossy_layer.timers.call_later(
+                self.timeout_nanosecs, self._example_timer_expired)
         else:
             logger.debug("Example timer already running.")
 
 
-    def _expire_timers(self):
-        curtime = time.monotonic_ns()
-        if not self._example_timer:
-            logger.debug("Example timer not running.")
-        elif curtime - self._example_timer > self.timeout_nanosecs:
-            logger.debug("Example timer elapsed.")
-            self._example_timer = None
-        else:
-            logger.debug("Example timer not yet elapsed.")
+    def _example_timer_expired(self):
+        logger.debug("Example timer elapsed.")
+        if tracing.enabled:
+            tracing.record(TraceEvent.TIMER, "example")
+        self._example_timer = None
 
 
     ###########################################################################
@@ -271,7 +391,13 @@ class BTCPServerSocket(BTCPSocket):
         this project.
         """
         logger.debug("accept called")
-        raise_NotImplementedError("No implementation of accept present. Read the comments & code of server_socket.py.")
+        #raise_NotImplementedError("No implementation of accept present. Read the comments & code of server_socket.py.")
+        self._skip_checksum = False
+        self._set_state(BTCPStates.ACCEPTING)
+        while self._state != BTCPStates.ESTABLISHED:
+            time.sleep(0.001)
+        logger.info("Accepted, trusted-transport mode %s",
+                    "on" if self._skip_checksum else "off")
 
 
     def recv(self):
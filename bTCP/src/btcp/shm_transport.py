@@ -0,0 +1,378 @@
+"""Shared-memory transport between processes on the same host.
+
+SharedMemoryLossyLayer replaces UDP by one single-producer/single-consumer
+ring of SEGMENT_SIZE slots per direction, in multiprocessing.shared_memory:
+
+    - Every lossy layer creates the ring it receives from, named after its
+      local address, and attaches to the ring of its peer (named after the
+      remote address) the first time it sends something. Until the peer has
+      created its ring, segments are dropped, just like UDP datagrams sent to
+      a port nobody listens on.
+    - Sending copies the segment into the next free slot and then publishes
+      it by advancing the ring's head index. Segments sent to a full ring are
+      dropped. Both threads of a process may send, so the producer side is
+      serialized with a lock; the consumer is only ever the network thread.
+    - The network thread hands memoryviews of the slots straight to the
+      handler stack and only advances the tail index, freeing the slots,
+      once segment(s)_received returns. The ownership rules are those of
+      btcp/buffer_pool.py: copy what has to outlive the call.
+    - While its ring is empty the network thread sleeps in select on a
+      "doorbell", an abstract AF_UNIX datagram socket. It sets a flag in the
+      ring before it does, and producers only ring the doorbell if that flag
+      is set, so a busy connection makes no system calls at all. Should a
+      wakeup still get lost in the race between the two, the consumer finds
+      the segment at the latest TIMER_TICK ms later.
+
+The head and tail indices are updated with single aligned 64 bit stores
+through memoryview casts, and slots are written before the head index that
+publishes them. That ordering holds on x86; weakly ordered CPUs are not
+supported.
+
+Abstract AF_UNIX sockets make this Linux only. SUPPORTED tells whether this
+is Linux on x86; elsewhere SharedMemoryLossyLayer raises RuntimeError. Select
+it with transport="shm" on the bTCP sockets, see btcp/transports.py.
+"""
+
+import logging
+import platform
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+from btcp.constants import *
+from btcp.lossy_layer import (LossyLayer, BottomHandler, DEFAULT_BURST_SIZE,
+                              TICK_NS, _resolve)
+from btcp.timers import TimerService
+
+
+logger = logging.getLogger(__name__)
+
+
+# Whether the rings work here, see the module docstring.
+SUPPORTED = (sys.platform.startswith("linux")
+             and platform.machine().lower() in ("x86_64", "amd64", "i386", "i686"))
+
+RING_SLOTS = 256
+
+# Ring layout: the indices each get a cache line of their own.
+_HEAD = 0       # Q, next slot the producer writes; producer only
+_TAIL = 64      # Q, next slot the consumer reads; consumer only
+_FLAGS = 128    # I sleeping, I closed; consumer only
+_LENGTHS = 192  # H per slot
+_SLOTS = _LENGTHS + ((2 * RING_SLOTS + 63) & ~63)
+RING_SIZE = _SLOTS + RING_SLOTS * SEGMENT_SIZE
+
+
+def _ring_name(address):
+    ip, port = address
+    return f"btcp-{ip}-{port}"
+
+
+def _doorbell_address(address):
+    return b"\0" + _ring_name(address).encode()
+
+
+class _Ring:
+    """Views of one ring in a shared memory block."""
+
+    def __init__(self, shm):
+        self.shm = shm
+        buf = shm.buf
+        self._views = [
+            buf[_HEAD:_HEAD + 8].cast("Q"),
+            buf[_TAIL:_TAIL + 8].cast("Q"),
+            buf[_FLAGS:_FLAGS + 8].cast("I"),
+            buf[_LENGTHS:_LENGTHS + 2 * RING_SLOTS].cast("H"),
+        ]
+        self.head, self.tail, self.flags, self.lengths = self._views
+        self.slots = [buf[_SLOTS + i * SEGMENT_SIZE:_SLOTS + (i + 1) * SEGMENT_SIZE]
+                      for i in range(RING_SLOTS)]
+
+    @property
+    def closed(self):
+        return self.flags[1]
+
+    def close(self):
+        """Release all views and unmap the block.
+
+        Slices of the slots that a handler held on to keep the mapping alive;
+        it is then only unmapped when the process exits.
+        """
+        for view in self._views + self.slots:
+            view.release()
+        self._views = self.slots = []
+        try:
+            self.shm.close()
+        except BufferError:
+            logger.warning("Segment views of %s still exist, not unmapping it",
+                           self.shm.name)
+
+
+# The blocks are not left to multiprocessing's resource tracker. It would
+# unlink a ring when any process that attached to it exits, and processes
+# sharing a tracker (the same process, or a fork) would unregister each
+# other's rings. Instead the creator unlinks its ring in destroy, and a ring
+# left behind by a crashed process is replaced by the next one created on the
+# same address.
+
+def _open(name, create=False):
+    shm = shared_memory.SharedMemory(name, create=create, size=RING_SIZE)
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return _Ring(shm)
+
+
+def _unlink(ring):
+    # SharedMemory.unlink unregisters the block again.
+    resource_tracker.register(ring.shm._name, "shared_memory")
+    ring.shm.unlink()
+
+
+def _create_ring(name):
+    try:
+        stale = _open(name)
+    except FileNotFoundError:
+        pass
+    else:
+        # Tell anyone still attached to it to let go.
+        stale.flags[1] = 1
+        stale.close()
+        _unlink(stale)
+    ring = _open(name, create=True)
+    ring.head[0] = ring.tail[0] = 0
+    ring.flags[0] = ring.flags[1] = 0
+    return ring
+
+
+def _attach_ring(name):
+    try:
+        ring = _open(name)
+    except FileNotFoundError:
+        return None
+    if ring.closed:
+        ring.close()
+        return None
+    return ring
+
+
+class SharedMemoryLossyLayer(LossyLayer):
+    """Lossy layer exchanging segments with a SharedMemoryLossyLayer in another
+    process through shared memory rings, see the module docstring."""
+
+    def handle_incoming_segments(self):
+        """The main method of the network thread, see
+        LossyLayer.handle_incoming_segments. Polls the ring, and only waits for
+        the doorbell while it is empty."""
+        event, doorbell, ring = self._event, self._doorbell, self._inbound
+        head, tail, flags, lengths, slots = (ring.head, ring.tail, ring.flags,
+                                             ring.lengths, ring.slots)
+        burst_size, burst_counts = self._burst_size, self.burst_counts
+
+        logger.info("Starting handle_incoming_segments")
+        next_tick = time.monotonic_ns() + TICK_NS
+        while not event.is_set():
+            try:
+                first = tail[0]
+                count = min(head[0] - first, burst_size)
+                if not count:
+                    flags[0] = 1
+                    # Recheck: the producer may have published a segment
+                    # without ringing before it saw the flag.
+                    if head[0] == first and not self._tick_requested:
+                        rlist, wlist, elist = select.select(
+                            [doorbell], [], [], self._wait_timeout(next_tick))
+                        if rlist:
+                            self._drain_doorbell()
+                    flags[0] = 0
+                    count = min(head[0] - first, burst_size)
+
+                if count:
+                    segments = []
+                    for seqno in range(first, first + count):
+                        i = seqno % RING_SLOTS
+                        length = lengths[i]
+                        segments.append(slots[i] if length == SEGMENT_SIZE
+                                        else slots[i][:length])
+                    burst_counts[count] += 1
+                    try:
+                        self._deliver(segments)
+                    finally:
+                        del segments
+                        # Only now the producer may reuse the slots.
+                        tail[0] = first + count
+                    now = time.monotonic_ns()
+                    next_tick = now + TICK_NS
+                else:
+                    now = time.monotonic_ns()
+                    if now >= next_tick:
+                        self._tick()
+                        next_tick = now + TICK_NS
+                if self._tick_requested:
+                    self._tick_requested = False
+                    self._tick()
+                self._run_timers(now)
+            except Exception as e:
+                logger.exception("Exception in the network thread")
+                signal.raise_signal(signal.SIGTERM)
+                raise
+
+    def __init__(self, btcp_socket, local_ip, local_port, remote_ip, remote_port,
+                 burst_size=DEFAULT_BURST_SIZE):
+        """burst_size is the maximum number of segments the network thread
+        takes from the ring per iteration.
+        """
+        logger.info("SharedMemoryLossyLayer.__init__() was called")
+        self._inbound = None
+        self._outbound = None
+        self._doorbell = None
+        self._send_lock = threading.Lock()
+        self.dropped = 0
+        # The network thread reads straight from the ring, there is no
+        # buffer pool.
+        super().__init__(btcp_socket, local_ip, local_port, remote_ip, remote_port,
+                         pool_size=0, burst_size=min(burst_size, RING_SLOTS),
+                         reactor=False, transmit_thread=False)
+        self._handler_stack = (SharedMemoryBottomHandler(self),)
+
+    def _create_timers(self):
+        """See LossyLayer._create_timers."""
+        return TimerService(self._wake)
+
+    def _open_socket(self, local_ip, local_port, remote_ip, remote_port):
+        """See LossyLayer._open_socket. Binds the doorbell and creates the
+        ring to receive from."""
+        if not SUPPORTED:
+            raise RuntimeError("The shared memory transport needs Linux on "
+                               f"x86, not {sys.platform} on {platform.machine()}")
+        # Nothing between the two processes can corrupt segments.
+        self._loopback = True
+        local_address = _resolve(local_ip, local_port)
+        self._remote_address = _resolve(remote_ip, remote_port)
+        self._local_doorbell = _doorbell_address(local_address)
+        self._doorbell = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            self._doorbell.bind(self._local_doorbell)
+        except OSError:
+            self._doorbell.close()
+            self._doorbell = None
+            raise
+        self._doorbell.setblocking(False)
+        self._inbound = _create_ring(_ring_name(local_address))
+
+    def destroy(self):
+        """Stop the network thread, then close our ring and the doorbell.
+
+        Should be safe to call multiple times, so safe to call from __del__.
+        """
+        logger.info("SharedMemoryLossyLayer.destroy() called.")
+        if self._event is not None and self._thread is not None:
+            self._event.set()
+            self._thread.join()
+        self._event = None
+        self._thread = None
+        if self._inbound is not None:
+            self._inbound.flags[1] = 1
+            self._inbound.close()
+            _unlink(self._inbound)
+            self._inbound = None
+        with self._send_lock:
+            if self._outbound is not None:
+                self._outbound.close()
+                self._outbound = None
+        if self._doorbell is not None:
+            self._doorbell.close()
+            self._doorbell = None
+
+    def wakeup(self):
+        """See LossyLayer.wakeup."""
+        if not self._tick_requested:
+            self._tick_requested = True
+            self._wake()
+
+    def _wake(self):
+        """Ring our own doorbell, unless called by the network thread."""
+        thread, doorbell = self._thread, self._doorbell
+        if thread is None or doorbell is None or threading.get_ident() == thread.ident:
+            return
+        try:
+            doorbell.sendto(b"\0", self._local_doorbell)
+        except OSError:
+            # Already ringing.
+            pass
+
+    def size_buffers(self, receive_window, send_window=None):
+        """See LossyLayer.size_buffers. The rings have a fixed size."""
+
+    def statistics(self):
+        """See LossyLayer.statistics. dropped counts the segments sent that
+        found the peer's ring full."""
+        return dict(dropped=self.dropped, burst_counts=list(self.burst_counts))
+
+    def _drain_doorbell(self):
+        try:
+            while True:
+                self._doorbell.recv(16)
+        except BlockingIOError:
+            pass
+
+    def _peer_ring(self):
+        """The ring to send to, attaching to it if needed. Called with
+        _send_lock held."""
+        ring = self._outbound
+        if ring is not None and ring.closed:
+            # The peer went away, maybe to make room for a new one.
+            ring.close()
+            ring = self._outbound = None
+        if ring is None:
+            ring = self._outbound = _attach_ring(_ring_name(self._remote_address))
+        return ring
+
+    def _produce(self, segments):
+        """Copy segments into the peer's ring, waking up its network thread if
+        it is sleeping."""
+        with self._send_lock:
+            ring = self._peer_ring()
+            if ring is None:
+                for segment in segments:
+                    pass
+                return
+            head, lengths, slots, flags = (ring.head, ring.lengths, ring.slots,
+                                           ring.flags)
+            seqno, free = head[0], RING_SLOTS - (head[0] - ring.tail[0])
+            rung = False
+            for segment in segments:
+                if not free:
+                    self.dropped += 1
+                    continue
+                i = seqno % RING_SLOTS
+                length = len(segment)
+                slots[i][:length] = segment
+                lengths[i] = length
+                seqno += 1
+                free -= 1
+                # Publish each segment as soon as it is written, so the peer
+                # can drain the ring while we are still filling it.
+                head[0] = seqno
+                if not rung and flags[0]:
+                    self._ring_doorbell()
+                    rung = True
+
+    def _ring_doorbell(self):
+        try:
+            self._doorbell.sendto(b"\0", _doorbell_address(self._remote_address))
+        except (BlockingIOError, ConnectionRefusedError, FileNotFoundError):
+            # Already ringing, or nobody home.
+            pass
+
+
+class SharedMemoryBottomHandler(BottomHandler):
+    """Bottom handler passing segments into the peer's shared memory ring."""
+
+    def send_segment(self, segment):
+        self._lossy_layer._produce((segment,))
+
+    def send_segments(self, segments):
+        self._lossy_layer._produce(segments)
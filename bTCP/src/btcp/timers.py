@@ -0,0 +1,157 @@
+"""Deadline timers for the network thread.
+
+lossy_layer_tick is only called after TIMER_TICK ms without any segment
+arriving, so timers that are only checked from there and from
+lossy_layer_segment_received fire late, or only when the next segment
+happens to arrive. Instead, every LossyLayer has timers, a TimerService of
+its own or a TimerGroup on the one of the reactor it is attached to (see
+btcp/reactor.py):
+
+    timer = self._lossy_layer.timers.call_later(self.timeout_nanosecs,
+                                                self._retransmit_timeout)
+    ...
+    timer.cancel()
+
+Deadlines are kept in a min-heap. The network thread waits for segments no
+longer than until the nearest deadline, and runs the callbacks of expired
+timers itself, just like it calls lossy_layer_segment_received and
+lossy_layer_tick: holding the handler lock while effect handlers are active,
+see LossyLayer._deliver.
+
+Timers can be started and cancelled from any thread. A timer started from
+the application thread with a deadline earlier than the one the network
+thread is waiting for wakes it up, see btcp/wakeup.py.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+
+class Timer:
+    """Handle of a started timer, returned by TimerService.call_at."""
+    __slots__ = ("deadline", "_callback", "_args")
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self._callback = callback
+        self._args = args
+
+    def cancel(self):
+        """Make sure the callback will not be called. Cancelling a timer that
+        already fired or was cancelled before does nothing."""
+        self._callback = None
+
+    @property
+    def cancelled(self):
+        return self._callback is None
+
+
+class TimerService:
+    """Min-heap of deadlines, in time.monotonic_ns() nanoseconds.
+
+    Cancelled timers stay in the heap until their deadline comes up, which
+    keeps cancel O(1); they are skipped when they are popped.
+    """
+
+    def __init__(self, wakeup=None):
+        """wakeup is called whenever a timer becomes the nearest one, to
+        wake up the thread running the timers."""
+        self._heap = []
+        # Breaks ties between equal deadlines, so Timers are never compared.
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = wakeup
+
+    def call_at(self, deadline, callback, *args):
+        """Call callback(*args) from the network thread once
+        time.monotonic_ns() reaches deadline."""
+        timer = Timer(deadline, callback, args)
+        heap = self._heap
+        with self._lock:
+            heapq.heappush(heap, (deadline, next(self._counter), timer))
+            nearest = heap[0][2] is timer
+        if nearest and self._wakeup is not None:
+            self._wakeup()
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        """Call callback(*args) from the network thread delay nanoseconds
+        from now."""
+        return self.call_at(time.monotonic_ns() + delay, callback, *args)
+
+    def next_deadline(self):
+        """Return the nearest deadline of a timer that is still running, or
+        None if there is none."""
+        heap = self._heap
+        with self._lock:
+            while heap and heap[0][2].cancelled:
+                heapq.heappop(heap)
+            return heap[0][0] if heap else None
+
+    def run_expired(self, now=None):
+        """Call the callbacks of all timers whose deadline has passed, in
+        order of deadline. Only the network thread should call this."""
+        if now is None:
+            now = time.monotonic_ns()
+        heap = self._heap
+        while True:
+            with self._lock:
+                if not heap or heap[0][0] > now:
+                    return
+                timer = heapq.heappop(heap)[2]
+            callback = timer._callback
+            if callback is not None:
+                timer._callback = None
+                callback(*timer._args)
+
+
+class TimerGroup:
+    """The timers of one lossy layer on a TimerService it shares with others,
+    see btcp/reactor.py. Same interface as TimerService for starting timers;
+    close() cancels all of them at once, when the lossy layer is destroyed.
+    """
+
+    def __init__(self, service, run=None):
+        """run(callback, args) calls the callbacks when their timers fire,
+        e.g. holding a lock; by default they are called as they are."""
+        self._service = service
+        self._run = run
+        self._closed = False
+
+    def call_at(self, deadline, callback, *args):
+        return self._service.call_at(deadline, self._fire, callback, args)
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.monotonic_ns() + delay, callback, *args)
+
+    def _fire(self, callback, args):
+        if self._closed:
+            return
+        if self._run is not None:
+            self._run(callback, args)
+        else:
+            callback(*args)
+
+    def close(self):
+        """Make sure no callback of this group is called anymore."""
+        self._closed = True
+
+
+class EventLoopTimerService:
+    """TimerService interface on top of the timers of an asyncio event loop,
+    for the lossy layer in btcp/async_lossy_layer.py.
+
+    Deadlines are still given on the time.monotonic_ns() clock. The returned
+    asyncio.TimerHandle objects have the same cancel method as Timer.
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+
+    def call_at(self, deadline, callback, *args):
+        return self.call_later(deadline - time.monotonic_ns(), callback, *args)
+
+    def call_later(self, delay, callback, *args):
+        return self._loop.call_later(delay / 1e9, callback, *args)
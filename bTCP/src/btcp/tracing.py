@@ -0,0 +1,124 @@
+"""Tracing of bTCP protocol events.
+
+The logging module is too expensive for the per-segment paths: every
+logger.debug call is a method call even when DEBUG is off, and f-string
+arguments are formatted before the call. Instead, the hot paths record
+events here, guarded by the module-level enabled flag:
+
+    if tracing.enabled:
+        tracing.record(TraceEvent.TIMER, "retransmit")
+
+With tracing disabled that is a single attribute lookup and nothing else.
+With tracing enabled, every event is stored as a plain tuple
+
+    (monotonic_ns, TraceEvent, field, ...)
+
+in a bounded ring buffer; older events are dropped once it is full. Nothing
+is formatted until the ring is exported with export(), as a readable log or
+as JSON.
+
+Tracing can be enabled with enable(), or for a whole process by setting
+BTCP_TRACE to the capacity of the ring buffer.
+"""
+
+import collections
+import json
+import os
+import sys
+import time
+from enum import IntEnum
+
+from btcp.segment import HEADER_STRUCT
+
+
+DEFAULT_CAPACITY = 65536
+
+
+class TraceEvent(IntEnum):
+    SEGMENT_IN  = 1 # seqnum, acknum, flags, window, length, checksum
+    SEGMENT_OUT = 2 # seqnum, acknum, flags, window, length, checksum
+    STATE       = 3 # old state, new state
+    TIMER       = 4 # timer name
+    RETRANSMIT  = 5 # seqnum
+
+
+FIELDS = {
+    TraceEvent.SEGMENT_IN: ("seq", "ack", "flags", "window", "len", "cksum"),
+    TraceEvent.SEGMENT_OUT: ("seq", "ack", "flags", "window", "len", "cksum"),
+    TraceEvent.STATE: ("old", "new"),
+    TraceEvent.TIMER: ("timer",),
+    TraceEvent.RETRANSMIT: ("seq",),
+}
+
+
+enabled = False
+_ring = None
+
+
+def enable(capacity=DEFAULT_CAPACITY):
+    """Start recording events into a fresh ring of the given capacity."""
+    global enabled, _ring
+    _ring = collections.deque(maxlen=capacity)
+    enabled = True
+
+
+def disable():
+    """Stop recording events. Recorded events are kept until the next
+    enable() so they can still be exported."""
+    global enabled
+    enabled = False
+
+
+def record(event, *fields):
+    """Record an event. Callers check tracing.enabled first."""
+    _ring.append((time.monotonic_ns(), event) + fields)
+
+
+def record_segment(event, segment):
+    """Record a SEGMENT_IN or SEGMENT_OUT event for a raw segment."""
+    _ring.append((time.monotonic_ns(), event)
+                 + HEADER_STRUCT.unpack_from(segment))
+
+
+def events():
+    """Return a snapshot of the recorded events, oldest first."""
+    return list(_ring.copy()) if _ring is not None else []
+
+
+def _format_field(name, value):
+    if name == "flags":
+        return (f"{'S' if value & 4 else '-'}{'A' if value & 2 else '-'}"
+                f"{'F' if value & 1 else '-'}")
+    return getattr(value, "name", value)
+
+
+def export(fp=None, fmt="log"):
+    """Write the recorded events to the file object fp (default stdout),
+    either as one readable line per event ("log") or as a JSON list of
+    objects ("json"). Timestamps are relative to the first event.
+    """
+    if fp is None:
+        fp = sys.stdout
+    snapshot = events()
+    t0 = snapshot[0][0] if snapshot else 0
+    rows = []
+    for t, event, *values in snapshot:
+        names = FIELDS.get(event, ())
+        row = {name: _format_field(name, value)
+               for name, value in zip(names, values)}
+        rows.append(((t - t0) / 1e6, TraceEvent(event).name, row))
+
+    if fmt == "json":
+        json.dump([dict(t_ms=t, event=event, **row) for t, event, row in rows],
+                  fp, indent=1)
+        fp.write("\n")
+    elif fmt == "log":
+        for t, event, row in rows:
+            fields = " ".join(f"{name}={value}" for name, value in row.items())
+            fp.write(f"{t:12.3f} {event:<11} {fields}\n")
+    else:
+        raise ValueError(f"Unknown trace export format {fmt!r}")
+
+
+if os.environ.get("BTCP_TRACE"):
+    enable(int(os.environ["BTCP_TRACE"]))
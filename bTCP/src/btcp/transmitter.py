@@ -0,0 +1,143 @@
+"""Transmit thread for the UDP socket of a lossy layer.
+
+By default whichever thread sends a segment makes the send system call
+itself, the application thread inside send or connect included, so it
+stalls whenever the kernel does. With a transmit thread the bottom of the
+handler stack only copies segments into a bounded queue, and the transmit
+thread makes the system calls:
+
+    LossyLayer(..., transmit_thread=True)
+    BTCP_TRANSMIT_THREAD=1 python3 client_app.py
+
+Every time it wakes up the transmit thread takes everything that is queued
+and sends it in batches, with UDP segmentation offload where the kernel
+supports it, see btcp/gso.py.
+
+Handing segments over to another thread is not free: a lone segment waits
+for the transmit thread to wake up, which adds to the round trip of small
+exchanges. It pays off for bulk transfers, on a host with a CPU core to
+spare for the transmit thread.
+
+The queue is a deque: appending to and popping from it is atomic, so
+producers (the application thread and the network thread) take no lock to
+queue segments. It holds at most TRANSMIT_QUEUE_SIZE segments, segments sent
+to a full queue are dropped, like those sent to a full network interface
+queue. The transmit thread only blocks on its event while the queue is
+empty, after setting a flag that tells producers to set the event; a busy
+queue costs them nothing but the append and counting it.
+
+Transmitter counts the segments queued, dropped and sent and the system
+calls made, and records a histogram of how long segments were queued, until
+the system call sending them returned. Segments the BatchSender could not
+send are counted as dropped too.
+"""
+
+import collections
+import logging
+import signal
+import threading
+import time
+
+from btcp.busy_poll import LatencyHistogram
+from btcp.constants import *
+from btcp.gso import BatchSender
+
+
+logger = logging.getLogger(__name__)
+
+
+TRANSMIT_QUEUE_SIZE = 1024
+
+
+class Transmitter:
+    """Transmit thread sending the segments queued for one UDP socket, see
+    the module docstring."""
+
+    def __init__(self, udp_socket, queue_size=TRANSMIT_QUEUE_SIZE):
+        """udp_socket must be connected to the peer."""
+        self._sender = BatchSender(udp_socket)
+        self._queue = collections.deque()
+        self._queue_size = queue_size
+        self._event = threading.Event()
+        self._sleeping = False
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="btcp-transmit",
+                                        daemon=True)
+        # queued and dropped are counted by the producers and the transmit
+        # thread alike.
+        self._counter_lock = threading.Lock()
+        self.queued = 0
+        self.dropped = 0
+        self.sent = 0
+        self.latency = LatencyHistogram()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Send what is still queued, then stop the transmit thread. Segments
+        enqueued after this are dropped."""
+        if self._thread.ident is None or self._stopping:
+            return
+        self._stopping = True
+        self._event.set()
+        self._thread.join()
+
+    def enqueue(self, segment):
+        """Queue segment for the transmit thread. segment must not change
+        anymore, pass a copy of reused buffers. Safe to call from any
+        thread."""
+        queue = self._queue
+        if len(queue) >= self._queue_size or self._stopping:
+            self._count_dropped(1)
+            return
+        queue.append((segment, time.monotonic_ns()))
+        with self._counter_lock:
+            self.queued += 1
+        if self._sleeping:
+            self._event.set()
+
+    def _count_dropped(self, count):
+        with self._counter_lock:
+            self.dropped += count
+
+    def summary(self):
+        return dict(queued=self.queued, dropped=self.dropped, sent=self.sent,
+                    syscalls=self._sender.syscalls, gso=self._sender.gso,
+                    latency=self.latency.summary())
+
+    def _run(self):
+        queue, event = self._queue, self._event
+        logger.info("Starting the transmit thread")
+        while True:
+            try:
+                if not queue:
+                    if self._stopping:
+                        return
+                    self._sleeping = True
+                    # Recheck: a producer may have appended before it saw
+                    # the flag.
+                    if not queue and not self._stopping:
+                        event.wait()
+                    event.clear()
+                    self._sleeping = False
+                    continue
+                batch = []
+                while queue:
+                    batch.append(queue.popleft())
+                self._send_batch(batch)
+            except Exception as e:
+                logger.exception("Exception in the transmit thread")
+                signal.raise_signal(signal.SIGTERM)
+                raise
+
+    def _send_batch(self, batch):
+        """Send queued (segment, enqueue time) pairs."""
+        sent = self._sender.send_segments(segment for segment, queued_at in batch)
+        now = time.monotonic_ns()
+        record = self.latency.record
+        for segment, queued_at in batch:
+            record(now - queued_at)
+        self.sent += sent
+        if sent < len(batch):
+            self._count_dropped(len(batch) - sent)
@@ -0,0 +1,40 @@
+"""Registry of the lossy layer implementations a bTCP socket can run on.
+
+    udp      LossyLayer, the default: real UDP datagrams, so client and
+             server can live in different processes or on different hosts.
+    memory   MemoryLossyLayer: client and server in the same process, see
+             btcp/memory_transport.py.
+    shm      SharedMemoryLossyLayer: client and server in different processes
+             on the same host, see btcp/shm_transport.py.
+    unix     UnixLossyLayer: AF_UNIX datagrams between processes on the same
+             host, see btcp/unix_transport.py.
+
+Pass the name as transport to the constructor of BTCPClientSocket or
+BTCPServerSocket, or a callable taking the arguments of LossyLayer, e.g. a
+functools.partial of UnixLossyLayer with the paths to use.
+"""
+
+from btcp.lossy_layer import LossyLayer
+from btcp.memory_transport import MemoryLossyLayer
+from btcp.shm_transport import SharedMemoryLossyLayer
+from btcp.unix_transport import UnixLossyLayer
+
+
+TRANSPORTS = {
+    "udp": LossyLayer,
+    "memory": MemoryLossyLayer,
+    "shm": SharedMemoryLossyLayer,
+    "unix": UnixLossyLayer,
+}
+
+
+def get_transport(name):
+    """Return the lossy layer class registered under name. Callables are
+    returned as they are."""
+    if callable(name):
+        return name
+    try:
+        return TRANSPORTS[name]
+    except KeyError:
+        raise ValueError(f"Unknown transport {name!r}, "
+                         f"choose from {sorted(TRANSPORTS)}") from None
@@ -0,0 +1,191 @@
+"""AF_UNIX datagram transport between processes on the same host.
+
+UnixLossyLayer is a LossyLayer whose socket is an AF_UNIX SOCK_DGRAM socket
+bound to a path instead of a UDP socket bound to an IP address and port.
+Everything else is LossyLayer's: the network thread or reactor, bursts,
+ticks, timers, buffer sizing and the handler stack, so effect() handlers
+work unchanged. Datagrams skip the IP and UDP layers, which makes them
+cheaper than UDP over loopback; compare the udp and unix cases of the send
+and latency suites of benchmark.py.
+
+The paths default to unix_path(ip, port): a socket file per address, in
+BTCP_UNIX_DIR or else the temporary directory. So the bTCP sockets select
+this transport with transport="unix" and need not know about paths. For
+other paths, pass local_path and remote_path; a functools.partial of
+UnixLossyLayer with them works as the transport of the bTCP sockets too.
+
+The semantics are those of UDP:
+
+    - The socket connects to the peer's path, and the kernel then drops
+      datagrams from anybody else. Segments sent before the peer bound its
+      path, or after it went away, are dropped; the lossy layer tries to
+      connect again whenever it sends.
+    - Sending never blocks. A datagram that finds the peer's queue full is
+      dropped and counted in dropped, where UDP would drop it at the peer's
+      full receive buffer.
+    - Linux limits the queue of an AF_UNIX datagram socket to
+      net.unix.max_dgram_qlen datagrams (10 by default), unless the receiving
+      socket is connected back to the sender. That is one more reason both
+      sides connect. The limit is then the sender's send buffer, which the
+      datagrams waiting at the receiver count against, so size_buffers sizes
+      it for the peer's receive window.
+
+A socket file left behind by a process that crashed is replaced. Binding a
+path that another lossy layer still receives on raises OSError, just like
+binding a UDP address that is in use.
+"""
+
+import errno
+import logging
+import os
+import socket
+import tempfile
+import threading
+
+from btcp.lossy_layer import LossyLayer, BottomHandler, _MSG_DONTWAIT
+
+
+logger = logging.getLogger(__name__)
+
+
+# send errors meaning we are not connected to a live peer.
+_PEER_GONE = (errno.ENOTCONN, errno.ECONNREFUSED)
+
+
+def unix_path(ip, port):
+    """The default path of the socket of a UnixLossyLayer for address (ip,
+    port)."""
+    directory = os.environ.get("BTCP_UNIX_DIR") or tempfile.gettempdir()
+    return os.path.join(directory, f"btcp-{ip}-{port}.sock")
+
+
+class UnixLossyLayer(LossyLayer):
+    """Lossy layer exchanging segments with a UnixLossyLayer on the same host
+    over AF_UNIX datagram sockets, see the module docstring."""
+
+    def __init__(self, btcp_socket, local_ip, local_port, remote_ip, remote_port,
+                 local_path=None, remote_path=None, transmit_thread=False,
+                 **kwargs):
+        """local_path and remote_path are the paths of the sockets of this
+        lossy layer and its peer, unix_path of their addresses by default.
+        The other keyword arguments are those of LossyLayer, except that
+        there is no transmit thread: it batches with UDP offload, and sends
+        here never block anyway.
+        """
+        logger.info("UnixLossyLayer.__init__() was called")
+        if transmit_thread:
+            raise ValueError("The transmit thread only supports UDP")
+        self._local_path = local_path or unix_path(local_ip, local_port)
+        self._remote_path = remote_path or unix_path(remote_ip, remote_port)
+        self._bound = False
+        # Both the application thread and the network thread send.
+        self._counter_lock = threading.Lock()
+        self.dropped = 0
+        super().__init__(btcp_socket, local_ip, local_port, remote_ip, remote_port,
+                         transmit_thread=False, **kwargs)
+        self._handler_stack = (UnixBottomHandler(self),)
+
+    def _open_socket(self, local_ip, local_port, remote_ip, remote_port):
+        """See LossyLayer._open_socket. The attribute keeps its name, so
+        the network thread and the reactor use the socket unchanged."""
+        self._udp_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._bind()
+        self._bound = True
+        # The kernel does not count drops at the receiver, they happen when
+        # sending; see statistics.
+        self.kernel_drops = None
+        # Nothing between the two sockets can corrupt segments.
+        self._loopback = True
+        self._remote_address = self._remote_path
+        self._connect()
+
+    def _bind(self):
+        path = self._local_path
+        try:
+            self._udp_socket.bind(path)
+        except OSError as e:
+            if e.errno != errno.EADDRINUSE:
+                raise
+            # Only a socket nobody receives on anymore refuses connections.
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as probe:
+                try:
+                    probe.connect(path)
+                except ConnectionRefusedError:
+                    stale = True
+                except OSError:
+                    stale = False
+                else:
+                    stale = False
+            if not stale:
+                raise
+            logger.warning("Replacing stale socket file %s", path)
+            os.unlink(path)
+            self._udp_socket.bind(path)
+
+    def _connect(self):
+        """Connect to the peer's path, returning whether the peer is there."""
+        try:
+            self._udp_socket.connect(self._remote_path)
+        except (FileNotFoundError, ConnectionRefusedError, PermissionError):
+            # Not up yet, gone, or connected to somebody else.
+            return False
+        return True
+
+    def destroy(self):
+        """See LossyLayer.destroy. Also removes our socket file."""
+        super().destroy()
+        if self._bound:
+            self._bound = False
+            try:
+                os.unlink(self._local_path)
+            except FileNotFoundError:
+                pass
+
+    def size_buffers(self, receive_window, send_window=None):
+        """See LossyLayer.size_buffers. Datagrams queued at the peer count
+        against our send buffer, so that has to hold the peer's receive
+        window; until the handshake told us, assume it is our own."""
+        super().size_buffers(receive_window, send_window or receive_window)
+
+    def statistics(self):
+        """See LossyLayer.statistics. dropped counts the segments sent that
+        found the peer's queue full."""
+        stats = super().statistics()
+        stats.update(dropped=self.dropped)
+        return stats
+
+    def _count_dropped(self):
+        with self._counter_lock:
+            self.dropped += 1
+
+    def _send(self, segments):
+        send = self._udp_socket.send
+        for segment in segments:
+            try:
+                send(segment, _MSG_DONTWAIT)
+            except BlockingIOError:
+                self._count_dropped()
+            except OSError as e:
+                if e.errno not in _PEER_GONE:
+                    raise
+                # Not connected yet, or the peer was replaced.
+                if not self._connect():
+                    continue
+                try:
+                    send(segment, _MSG_DONTWAIT)
+                except BlockingIOError:
+                    self._count_dropped()
+                except OSError as e:
+                    if e.errno not in _PEER_GONE:
+                        raise
+
+
+class UnixBottomHandler(BottomHandler):
+    """Bottom handler sending segments over the AF_UNIX socket, without ever
+    blocking."""
+
+    def send_segment(self, segment):
+        self._lossy_layer._send((segment,))
+
+    def send_segments(self, segments):
+        self._lossy_layer._send(segments)
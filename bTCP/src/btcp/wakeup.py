@@ -0,0 +1,55 @@
+"""Waking up a thread that waits in select.
+
+The network thread (or reactor) waits in select for segments, ticks and
+timers. Other threads use a Wakeup to interrupt that wait right away: to
+have it stop when the lossy layer is destroyed, to notice a timer that was
+started with a deadline earlier than it is waiting for, or to pass on that
+the application queued data to send.
+
+A Wakeup is the read end of a socketpair, which goes into the select set
+next to the UDP socket, and wake writes a byte to the other end. Writes are
+non-blocking, so a wakeup that is already pending costs nothing more, and
+wake does not write at all when called by the waiting thread itself: it is
+not waiting, and will check for work before it waits again.
+"""
+
+import socket
+import threading
+
+
+class Wakeup:
+    """Self-pipe for one waiting thread, see the module docstring."""
+
+    def __init__(self):
+        self._receiver, self._sender = socket.socketpair()
+        self._receiver.setblocking(False)
+        self._sender.setblocking(False)
+        # Thread ident of the waiting thread, set by it; see wake.
+        self.owner = None
+
+    def fileno(self):
+        """The file descriptor to wait for in select."""
+        return self._receiver.fileno()
+
+    def wake(self):
+        """Interrupt the owner's wait. Safe to call from any thread."""
+        if threading.get_ident() == self.owner:
+            return
+        try:
+            self._sender.send(b"\0")
+        except OSError:
+            # Already pending, or closed.
+            pass
+
+    def drain(self):
+        """Consume pending wakeups, once select said the Wakeup is
+        readable."""
+        try:
+            while self._receiver.recv(64):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        self._receiver.close()
+        self._sender.close()
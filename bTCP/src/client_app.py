@@ -4,7 +4,9 @@ import argparse
 import time
 import logging
 import btcp.client_socket
+from btcp import tracing
 from btcp.client_socket import BTCPClientSocket
+from btcp.transports import TRANSPORTS
 
 """This exposes a constant bytes object called TEST_BYTES_85MIB which, as the
 name suggests, is a little over 85 MiB in size. You can send it, receive it,
@@ -69,8 +71,19 @@ def btcp_file_transfer_client():
     parser.add_argument("-s", "--suppress-not-implemented-errors",
                         action="store_true",
                         help="Suppresses initial NotImplementedErrors")
+    parser.add_argument("--transport",
+                        choices=sorted(TRANSPORTS),
+                        help="Lossy layer to run bTCP on; both sides must "
+                             "use the same one",
+                        default="udp")
+    parser.add_argument("--trace",
+                        help="Record bTCP protocol events and write them to "
+                             "this file on exit, as JSON if it ends in .json")
     args = parser.parse_args()
 
+    if args.trace:
+        tracing.enable()
+
     logging.basicConfig(level=getattr(logging, args.loglevel.upper()),
                         format="%(asctime)s:%(name)s:%(levelname)s:%(message)s")
     logger.info("Set up logger")
@@ -80,7 +93,8 @@ def btcp_file_transfer_client():
 
     # Create a bTCP client socket with the given window size and timeout value
     logger.info("Creating client socket")
-    s = BTCPClientSocket(args.window, args.timeout)
+    s = BTCPClientSocket(args.window, args.timeout,
+                         transport=args.transport)
 
     # Connect. By default this doesn't actually do anything: our rudimentary
     # implementation relies on you starting the server before the client,
@@ -133,6 +147,12 @@ def btcp_file_transfer_client():
     logger.info("Calling close")
     s.close()
 
+    if args.trace:
+        logger.info("Writing trace to %s", args.trace)
+        with open(args.trace, 'w') as tracefile:
+            tracing.export(tracefile,
+                           "json" if args.trace.endswith(".json") else "log")
+
 
 if __name__ == "__main__":
     logger = logging.getLogger("client_app.py")
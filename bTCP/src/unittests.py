@@ -14,16 +14,34 @@ import logging
 import btcp.server_socket
 import btcp.client_socket
 import btcp.btcp_socket
+import btcp.checksum
+import btcp.segment
+import btcp.buffer_pool
+import btcp.busy_poll
+import btcp.tracing
+import btcp.timers
+import btcp.async_socket
+import btcp.memory_transport
+import btcp.reactor
+import btcp.shm_transport
+import btcp.transmitter
+import btcp.unix_transport
+import asyncio
+import io
+import json
 import queue
 import contextlib
 import threading
 import select
+import socket
 import string
 import struct
 import time
 import queue
 import sys
 import os
+import tempfile
+import random
 
 DEFAULT_WINDOW = 10 
 DEFAULT_TIMEOUT = 2 # seconds
@@ -630,6 +648,1101 @@ class T(unittest.TestCase):
 
 
 
+class Checksum(unittest.TestCase):
+    """Tests for the checksum backends in btcp/checksum.py, these do not need
+    a working bTCP implementation and run in-process."""
+
+    def _random_segments(self, count=200):
+        rng = random.Random(0x6274)
+        segments = [bytes(btcp.constants.SEGMENT_SIZE),
+                    b"\xff" * btcp.constants.SEGMENT_SIZE,
+                    b"\x00" * 8 + b"\xff\xff" + b"\x00" * 1008]
+        for _ in range(count):
+            segments.append(rng.randbytes(btcp.constants.SEGMENT_SIZE))
+        return segments
+
+    def test_backends_match_reference(self):
+        reference = btcp.checksum.get_backend("reference")
+        for name in btcp.checksum.BACKENDS:
+            backend = btcp.checksum.get_backend(name)
+            for segment in self._random_segments():
+                for buf in (segment, bytearray(segment), memoryview(segment)):
+                    self.assertEqual(backend(buf), reference(segment),
+                                     f"{name} backend differs from reference")
+
+    def test_verify_with_backend(self):
+        for name in btcp.checksum.BACKENDS:
+            backend = btcp.checksum.get_backend(name)
+            for segment in self._random_segments(20):
+                segment = bytearray(segment)
+                struct.pack_into("!H", segment, 8, backend(segment))
+                self.assertTrue(btcp.checksum.verify(backend, segment))
+                segment[100] ^= 0x10
+                self.assertFalse(btcp.checksum.verify(backend, segment))
+
+    def test_verify_batch(self):
+        rng = random.Random(5)
+        segments = []
+        for i, segment in enumerate(self._random_segments(64)):
+            segment = bytearray(segment)
+            struct.pack_into("!H", segment, 8,
+                             btcp.btcp_socket.BTCPSocket.in_cksum(segment))
+            if i % 3 == 0:
+                segment[rng.randrange(len(segment))] ^= 1 << rng.randrange(8)
+            segments.append(bytes(segment))
+        expected = [btcp.checksum.verify(btcp.checksum.in_cksum, segment)
+                    for segment in segments]
+        self.assertIn(False, expected)
+        self.assertEqual(btcp.checksum.verify_batch(segments), expected)
+        self.assertEqual(btcp.btcp_socket.BTCPSocket.verify_checksums(segments),
+                         expected)
+        for name in btcp.checksum.BACKENDS:
+            backend = btcp.checksum.get_backend(name)
+            self.assertEqual(btcp.checksum.verify_batch(segments, backend),
+                             expected)
+            self.assertEqual(btcp.checksum.verify_batch(segments[:1], backend),
+                             expected[:1])
+
+    def test_incremental_header_update(self):
+        # The payload's partial sum is computed once, after that only header
+        # fields change, as on retransmission with a new ack number or window.
+        rng = random.Random(1624)
+        build = btcp.btcp_socket.BTCPSocket.build_segment_header
+        for datalen in (0, 1, 17, 1007, btcp.constants.PAYLOAD_SIZE):
+            chunk = rng.randbytes(datalen)
+            payload_sum = btcp.checksum.partial_sum(chunk)
+            padded = chunk + bytes(btcp.constants.PAYLOAD_SIZE - datalen)
+            fields = [dict(seqnum=0, acknum=0, window=0)]
+            for _ in range(200):
+                fields.append(dict(seqnum=rng.randrange(0x10000),
+                                   acknum=rng.randrange(0x10000),
+                                   syn_set=rng.random() < .5,
+                                   ack_set=rng.random() < .5,
+                                   fin_set=rng.random() < .5,
+                                   window=rng.randrange(0x100)))
+            for f in fields:
+                header = build(length=datalen, **f)
+                cksum = btcp.checksum.finish(btcp.checksum.add(
+                    btcp.checksum.partial_sum(header), payload_sum))
+                self.assertEqual(
+                    cksum, btcp.btcp_socket.BTCPSocket.in_cksum(header + padded))
+
+
+
+
+class Segment(unittest.TestCase):
+    """Tests for the segment codec in btcp/segment.py."""
+
+    def _expected(self, payload, **fields):
+        build = btcp.btcp_socket.BTCPSocket.build_segment_header
+        padded = payload + bytes(btcp.constants.PAYLOAD_SIZE - len(payload))
+        cksum = btcp.btcp_socket.BTCPSocket.in_cksum(
+            build(length=len(payload), **fields) + padded)
+        return build(length=len(payload), checksum=cksum, **fields) + padded
+
+    def test_encoder_matches_build_segment_header(self):
+        rng = random.Random(3)
+        encoder = btcp.segment.SegmentEncoder()
+        # Shrinking payloads check that the reused buffer gets cleared.
+        for datalen in (1008, 500, 0, 33, 1007, 2):
+            payload = rng.randbytes(datalen)
+            fields = dict(seqnum=rng.randrange(0x10000),
+                          acknum=rng.randrange(0x10000),
+                          ack_set=True, fin_set=datalen == 0, window=7)
+            expected = self._expected(payload, **fields)
+            self.assertEqual(bytes(encoder.encode(payload=payload, **fields)),
+                             expected)
+            payload_sum = btcp.checksum.partial_sum(payload)
+            self.assertEqual(bytes(encoder.encode(payload=payload,
+                                                  payload_sum=payload_sum,
+                                                  **fields)),
+                             expected)
+
+    def test_segment_view_matches_unpack(self):
+        rng = random.Random(4)
+        unpack = btcp.btcp_socket.BTCPSocket.unpack_segment_header
+        for datalen in (0, 1, 500, 1008):
+            payload = rng.randbytes(datalen)
+            segment = self._expected(payload, seqnum=rng.randrange(0x10000),
+                                     acknum=rng.randrange(0x10000),
+                                     syn_set=True, fin_set=True, window=99)
+            for buf in (segment, bytearray(segment), memoryview(segment)):
+                view = btcp.segment.SegmentView(buf)
+                self.assertEqual((view.seqnum, view.acknum, view.syn_set,
+                                  view.ack_set, view.fin_set, view.window,
+                                  view.length, view.checksum),
+                                 unpack(segment[:btcp.constants.HEADER_SIZE]))
+                self.assertIsInstance(view.payload, memoryview)
+                self.assertEqual(view.payload, payload)
+
+    def test_ack_template_matches_encoder(self):
+        rng = random.Random(5)
+        template = btcp.segment.AckTemplate()
+        encoder = btcp.segment.SegmentEncoder()
+        for _ in range(200):
+            fields = dict(seqnum=rng.randrange(0x10000),
+                          acknum=rng.randrange(0x10000),
+                          window=rng.randrange(0x100),
+                          fin_set=rng.random() < 0.5)
+            self.assertEqual(bytes(template.encode(**fields)),
+                             bytes(encoder.encode(ack_set=True, **fields)))
+
+    def test_nocksum_skips_checksum_except_on_syn(self):
+        encoder = btcp.segment.SegmentEncoder()
+        segment = btcp.segment.SegmentView(bytes(encoder.encode(
+            1, 2, ack_set=True, payload=b"data", nocksum=True)))
+        self.assertTrue(segment.nocksum_set)
+        self.assertEqual(segment.checksum, 0)
+        syn = bytes(encoder.encode(1, 2, syn_set=True, nocksum=True))
+        self.assertTrue(btcp.btcp_socket.BTCPSocket.verify_checksum(syn))
+
+
+
+
+class BufferPool(unittest.TestCase):
+    """Tests for the receive buffer pool in btcp/buffer_pool.py."""
+
+    def test_buffers_are_reused(self):
+        pool = btcp.buffer_pool.SegmentBufferPool(2)
+        first = pool.acquire()
+        self.assertEqual(len(first), btcp.constants.SEGMENT_SIZE)
+        pool.release(first)
+        self.assertIs(pool.acquire(), first)
+        pool.acquire()
+        pool.acquire()
+        self.assertEqual(pool.misses, 1)
+
+    def test_debug_catches_use_after_release(self):
+        pool = btcp.buffer_pool.SegmentBufferPool(1, debug=True)
+        buf = pool.acquire()
+        buf[0] = 42
+        pool.release(buf)
+        with self.assertRaises(ValueError):
+            buf[0]
+        with self.assertRaises(RuntimeError):
+            pool.release(buf)
+        with self.assertRaises(RuntimeError):
+            pool.release(memoryview(bytearray(btcp.constants.SEGMENT_SIZE)))
+
+    def test_debug_catches_write_after_release(self):
+        pool = btcp.buffer_pool.SegmentBufferPool(1, debug=True)
+        buf = pool.acquire()
+        stale_slice = buf[:10]
+        pool.release(buf)
+        self.assertEqual(bytes(stale_slice), bytes([btcp.buffer_pool.POISON]) * 10)
+        stale_slice[0] = 0
+        with self.assertRaises(RuntimeError):
+            pool.acquire()
+
+
+
+
+class Tracing(unittest.TestCase):
+    """Tests for the event tracing in btcp/tracing.py."""
+
+    def tearDown(self):
+        btcp.tracing.disable()
+
+    def test_ring_is_bounded_and_exports(self):
+        TraceEvent = btcp.tracing.TraceEvent
+        btcp.tracing.enable(capacity=4)
+        segment = bytes(btcp.segment.SegmentEncoder().encode(
+            7, 8, syn_set=True, ack_set=True, window=5, payload=b"hi"))
+        for seqnum in range(10):
+            btcp.tracing.record(TraceEvent.RETRANSMIT, seqnum)
+        btcp.tracing.record_segment(TraceEvent.SEGMENT_OUT, segment)
+        btcp.tracing.record(TraceEvent.STATE, btcp.btcp_socket.BTCPStates.SYN_SENT,
+                            btcp.btcp_socket.BTCPStates.ESTABLISHED)
+        btcp.tracing.disable()
+        events = btcp.tracing.events()
+        self.assertEqual(len(events), 4)
+        self.assertEqual([e[1] for e in events],
+                         [TraceEvent.RETRANSMIT, TraceEvent.RETRANSMIT,
+                          TraceEvent.SEGMENT_OUT, TraceEvent.STATE])
+
+        log = io.StringIO()
+        btcp.tracing.export(log)
+        lines = log.getvalue().splitlines()
+        self.assertIn("SEGMENT_OUT seq=7 ack=8 flags=SA- window=5 len=2", lines[2])
+        self.assertIn("old=SYN_SENT new=ESTABLISHED", lines[3])
+
+        out = io.StringIO()
+        btcp.tracing.export(out, "json")
+        exported = json.loads(out.getvalue())
+        self.assertEqual(exported[1], dict(t_ms=exported[1]["t_ms"],
+                                           event="RETRANSMIT", seq=9))
+
+
+
+
+class LossyLayerBurst(unittest.TestCase):
+    """Tests for the burst-draining receive loop in btcp/lossy_layer.py."""
+
+    class RecordingSocket:
+        def __init__(self):
+            self.batches = []
+
+        def lossy_layer_segment_received(self, segment):
+            self.batches.append([bytes(segment)])
+
+        def lossy_layer_segments_received(self, segments):
+            self.batches.append([bytes(segment) for segment in segments])
+
+        def lossy_layer_tick(self):
+            pass
+
+    def _receive(self, count, effect=None, **layer_kwargs):
+        recorder = self.RecordingSocket()
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.bind(("127.0.0.1", 0))
+        layer = btcp.lossy_layer.LossyLayer(recorder, "127.0.0.1", 0,
+                                            *sender.getsockname(), burst_size=4,
+                                            **layer_kwargs)
+        self.layer = layer
+        segments = [bytes([i]) * btcp.constants.SEGMENT_SIZE for i in range(count)]
+        with contextlib.ExitStack() as stack:
+            if effect is not None:
+                stack.enter_context(layer.effect(effect))
+            for segment in segments:
+                sender.sendto(segment, layer._udp_socket.getsockname())
+            layer.start_network_thread()
+            deadline = time.time() + 5
+            while (sum(map(len, recorder.batches)) < count
+                   and time.time() < deadline):
+                time.sleep(0.001)
+            layer.destroy()
+        sender.close()
+        self.assertEqual(sum(recorder.batches, []), segments)
+        return recorder.batches, layer.burst_counts
+
+    def test_pending_datagrams_are_drained_in_bursts(self):
+        batches, burst_counts = self._receive(6)
+        self.assertEqual(list(map(len, batches)), [4, 2])
+        self.assertEqual(burst_counts, [0, 0, 1, 0, 1])
+
+    def test_basic_handlers_pass_bursts_on(self):
+        batches, burst_counts = self._receive(6, Identity)
+        self.assertEqual(list(map(len, batches)), [4, 2])
+
+    def test_handlers_without_segments_received_get_single_segments(self):
+        batches, burst_counts = self._receive(6, SegmentLenChecker)
+        self.assertEqual(list(map(len, batches)), [1] * 6)
+        self.assertEqual(burst_counts[4], 1)
+
+    def test_network_thread_drains_bursts(self):
+        batches, burst_counts = self._receive(6, reactor=False)
+        self.assertEqual(list(map(len, batches)), [4, 2])
+        self.assertEqual(burst_counts, [0, 0, 1, 0, 1])
+
+    def test_busy_polling_drains_bursts(self):
+        batches, burst_counts = self._receive(6, busy_poll=1000)
+        self.assertEqual(list(map(len, batches)), [4, 2])
+        self.assertEqual(burst_counts, [0, 0, 1, 0, 1])
+        self.assertEqual(self.layer.busy_poll.hits, 2)
+        self.assertEqual(self.layer.busy_poll.gaps.total, 1)
+
+    def test_busy_poll_budget_adapts(self):
+        poll = btcp.busy_poll.BusyPoll(50_000)
+        now = 0
+        for gap in [10_000] * 20:
+            now += gap
+            poll.arrived(now)
+        self.assertEqual(poll.budget, 20_000)
+        # Sparse traffic switches spinning off, and it resumes once segments
+        # come in quickly again.
+        for gap in [1_000_000] * 20:
+            now += gap
+            poll.arrived(now)
+        self.assertEqual(poll.budget, 0)
+        for gap in [10_000] * 20:
+            now += gap
+            poll.arrived(now)
+        self.assertGreater(poll.budget, 0)
+        self.assertEqual(poll.gaps.total, 59)
+        self.assertEqual(poll.gaps.percentile(0.5), 16384)
+
+    def test_kernel_drops_are_counted(self):
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.bind(("127.0.0.1", 0))
+        self.addCleanup(sender.close)
+        recorder = self.RecordingSocket()
+        layer = btcp.lossy_layer.LossyLayer(recorder, "127.0.0.1", 0,
+                                            *sender.getsockname())
+        self.addCleanup(layer.destroy)
+        if layer.kernel_drops is None:
+            self.skipTest("The kernel does not report drops")
+        sender.connect(layer._udp_socket.getsockname())
+        # Far more than the default receive buffer holds.
+        for _ in range(500):
+            sender.send(bytes(btcp.constants.SEGMENT_SIZE))
+        layer.start_network_thread()
+        deadline = time.time() + 5
+        while not recorder.batches and time.time() < deadline:
+            time.sleep(0.001)
+        # Let the network thread empty the receive buffer; the kernel reports
+        # drops along with the datagrams queued after them.
+        time.sleep(0.05)
+        sender.send(b"x")
+        while (not (recorder.batches and recorder.batches[-1][-1] == b"x")
+               and time.time() < deadline):
+            time.sleep(0.001)
+        received = sum(map(len, recorder.batches))
+        self.assertEqual(layer.statistics()["kernel_drops"], 501 - received)
+        self.assertGreater(layer.kernel_drops, 0)
+
+    def test_buffers_are_sized_for_the_window(self):
+        peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        peer.bind(("127.0.0.1", 0))
+        self.addCleanup(peer.close)
+        layer = btcp.lossy_layer.LossyLayer(self.RecordingSocket(), "127.0.0.1", 0,
+                                            *peer.getsockname())
+        self.addCleanup(layer.destroy)
+        wanted = 200 * btcp.lossy_layer.SEGMENT_TRUESIZE
+        try:
+            with open("/proc/sys/net/core/rmem_max") as f:
+                if int(f.read()) < wanted:
+                    self.skipTest("net.core.rmem_max is too small")
+        except OSError:
+            pass
+        before = layer.statistics()["receive_buffer"]
+        layer.size_buffers(200)
+        self.assertGreaterEqual(layer.statistics()["receive_buffer"], wanted)
+        # Never shrinks them.
+        layer.size_buffers(1, 1)
+        self.assertGreaterEqual(layer.statistics()["receive_buffer"], wanted)
+        self.assertGreaterEqual(layer.statistics()["send_buffer"], before)
+
+    def test_send_segments_from_a_single_encoder(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(5)
+        layer = btcp.lossy_layer.LossyLayer(self.RecordingSocket(), "127.0.0.1", 0,
+                                            *receiver.getsockname())
+        layer.start_network_thread()
+        encoder = btcp.segment.SegmentEncoder()
+        for effect in (None, Identity, SegmentLenChecker):
+            with contextlib.ExitStack() as stack:
+                if effect is not None:
+                    stack.enter_context(layer.effect(effect))
+                layer.send_segments(encoder.encode(seqnum, 0, payload=b"x")
+                                    for seqnum in range(3))
+            received = [btcp.segment.SegmentView(receiver.recv(2048)).seqnum
+                        for _ in range(3)]
+            self.assertEqual(received, [0, 1, 2])
+        layer.destroy()
+        receiver.close()
+
+    def test_send_segments_batches_system_calls(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        receiver.settimeout(5)
+        self.addCleanup(receiver.close)
+        layer = btcp.lossy_layer.LossyLayer(self.RecordingSocket(), "127.0.0.1", 0,
+                                            *receiver.getsockname(),
+                                            transmit_thread=False)
+        self.addCleanup(layer.destroy)
+        layer.start_network_thread()
+        encoder = btcp.segment.SegmentEncoder()
+        layer.send_segments(encoder.encode(seqnum, 0, payload=b"x")
+                            for seqnum in range(100))
+        received = [btcp.segment.SegmentView(receiver.recv(2048)).seqnum
+                    for _ in range(100)]
+        self.assertEqual(received, list(range(100)))
+        sender = layer._batch_sender
+        self.assertEqual(sender.syscalls, 2 if sender.gso else 100)
+
+    def test_datagrams_from_other_addresses_are_dropped(self):
+        peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        peer.bind(("127.0.0.1", 0))
+        stranger = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        recorder = LossyLayerBurst.RecordingSocket()
+        layer = btcp.lossy_layer.LossyLayer(recorder, "127.0.0.1", 0,
+                                            *peer.getsockname())
+        layer.start_network_thread()
+        stranger.sendto(b"x" * 10, layer._udp_socket.getsockname())
+        peer.sendto(b"y" * 10, layer._udp_socket.getsockname())
+        deadline = time.time() + 5
+        while not recorder.batches and time.time() < deadline:
+            time.sleep(0.001)
+        layer.destroy()
+        peer.close()
+        stranger.close()
+        self.assertEqual(recorder.batches, [[b"y" * 10]])
+
+
+
+
+class HandlerChain(unittest.TestCase):
+    """Tests for the copy-on-write handler stack in btcp/lossy_layer.py."""
+
+    def test_segments_bypass_the_lock_without_effects(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(5)
+        layer = btcp.lossy_layer.LossyLayer(LossyLayerBurst.RecordingSocket(),
+                                            "127.0.0.1", 0, *receiver.getsockname())
+        layer.start_network_thread()
+        locked, release = threading.Event(), threading.Event()
+        def hold_lock():
+            with layer._handler_lock:
+                locked.set()
+                release.wait()
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        try:
+            locked.wait()
+            layer.send_segment(bytes(btcp.constants.SEGMENT_SIZE))
+            self.assertEqual(len(receiver.recv(2048)), btcp.constants.SEGMENT_SIZE)
+        finally:
+            release.set()
+            holder.join()
+        bottom = layer._handler_stack
+        with layer.effect(Identity) as outer:
+            with layer.effect(Identity) as inner:
+                self.assertEqual(layer._handler_stack, bottom + (outer, inner))
+                self.assertIs(inner._old_handler, outer)
+            self.assertEqual(layer._handler_stack, bottom + (outer,))
+        self.assertEqual(layer._handler_stack, bottom)
+        layer.destroy()
+        receiver.close()
+
+
+
+
+class TrustedTransport(unittest.TestCase):
+    """Tests for trusted-transport mode of the bTCP sockets."""
+
+    def _server(self):
+        s = btcp.server_socket.BTCPServerSocket(DEFAULT_WINDOW, DEFAULT_TIMEOUT,
+                                                trusted_transport=True)
+        self.addCleanup(s.close)
+        return s
+
+    def test_effect_handlers_make_transport_untrusted(self):
+        s = self._server()
+        self.assertTrue(s._lossy_layer.trusted)
+        with s._lossy_layer.effect(SegmentLenChecker):
+            self.assertFalse(s._lossy_layer.trusted)
+        self.assertTrue(s._lossy_layer.trusted)
+
+    def test_corrupted_flag_does_not_skip_verification(self):
+        s = self._server()
+        s._skip_checksum = True
+        encoder = btcp.segment.SegmentEncoder()
+        unchecked = bytes(encoder.encode(1, 2, ack_set=True, payload=b"data",
+                                         nocksum=True))
+        corrupted = bytearray(encoder.encode(1, 2, ack_set=True,
+                                             payload=b"data"))
+        corrupted[4] |= btcp.segment.NOCKSUM_FLAG
+        corrupted = bytes(corrupted)
+        self.assertTrue(s._checksum_ok(unchecked))
+        self.assertFalse(s._checksum_ok(corrupted))
+        delivered = []
+        s._verified_segment_received = delivered.append
+        s.lossy_layer_segments_received([unchecked, corrupted, unchecked])
+        self.assertEqual(delivered, [unchecked, unchecked])
+
+
+
+
+class Timers(unittest.TestCase):
+    """Tests for the timer service in btcp/timers.py."""
+
+    def test_timers_fire_in_deadline_order(self):
+        timers = btcp.timers.TimerService()
+        fired = []
+        for deadline in (30, 10, 20, 10):
+            timers.call_at(deadline, fired.append, deadline)
+        timers.call_at(5, fired.append, 5).cancel()
+        self.assertEqual(timers.next_deadline(), 10)
+        timers.run_expired(now=20)
+        self.assertEqual(fired, [10, 10, 20])
+        self.assertEqual(timers.next_deadline(), 30)
+        timers.run_expired(now=100)
+        self.assertEqual(fired, [10, 10, 20, 30])
+        self.assertIsNone(timers.next_deadline())
+
+    def test_timers_fire_on_time_under_traffic(self):
+        # Segments arriving more often than TIMER_TICK used to hold off ticks,
+        # and with them every timer, indefinitely.
+        recorder = LossyLayerBurst.RecordingSocket()
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.bind(("127.0.0.1", 0))
+        layer = btcp.lossy_layer.LossyLayer(recorder, "127.0.0.1", 0,
+                                            *sender.getsockname())
+        fired = []
+        layer.start_network_thread()
+        deadline = time.monotonic_ns() + 300_000_000
+        layer.timers.call_at(deadline, lambda: fired.append(time.monotonic_ns()))
+        while not fired and time.monotonic_ns() < deadline + 2_000_000_000:
+            sender.sendto(bytes(btcp.constants.SEGMENT_SIZE),
+                          layer._udp_socket.getsockname())
+            time.sleep(0.02)
+        layer.destroy()
+        sender.close()
+        self.assertTrue(fired)
+        self.assertLess(fired[0] - deadline, 50_000_000)
+        self.assertGreater(len(recorder.batches), 5)
+
+    def test_timers_hold_handler_lock_under_effects(self):
+        peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        peer.bind(("127.0.0.1", 0))
+        self.addCleanup(peer.close)
+        for reactor in (False, btcp.reactor.Reactor()):
+            with self.subTest(reactor=bool(reactor)):
+                layer = btcp.lossy_layer.LossyLayer(
+                    LossyLayerBurst.RecordingSocket(), "127.0.0.1", 0,
+                    *peer.getsockname(), reactor=reactor, transmit_thread=False)
+                self.addCleanup(layer.destroy)
+                layer.start_network_thread()
+                owned = []
+                fired = threading.Event()
+
+                def callback():
+                    owned.append(layer._handler_lock._is_owned())
+                    fired.set()
+
+                with layer.effect(btcp.lossy_layer.BasicHandler):
+                    layer.timers.call_later(0, callback)
+                    self.assertTrue(fired.wait(5))
+                self.assertEqual(owned, [True])
+
+
+
+
+class Reactor(unittest.TestCase):
+    """Tests for the shared reactor in btcp/reactor.py."""
+
+    class TickingSocket(LossyLayerBurst.RecordingSocket):
+        def __init__(self):
+            super().__init__()
+            self.ticks = 0
+
+        def lossy_layer_tick(self):
+            self.ticks += 1
+
+    def _layer(self, reactor, peer):
+        # A transmit thread would be a thread of its own.
+        layer = btcp.lossy_layer.LossyLayer(self.TickingSocket(), "127.0.0.1", 0,
+                                            *peer.getsockname(), reactor=reactor,
+                                            transmit_thread=False)
+        self.addCleanup(layer.destroy)
+        layer.start_network_thread()
+        return layer
+
+    def test_lossy_layers_share_one_thread(self):
+        reactor = btcp.reactor.Reactor()
+        peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        peer.bind(("127.0.0.1", 0))
+        self.addCleanup(peer.close)
+        threads = threading.active_count()
+        layers = [self._layer(reactor, peer) for _ in range(4)]
+        self.assertEqual(threading.active_count(), threads + 1)
+
+        for i, layer in enumerate(layers):
+            peer.sendto(bytes([i]) * 10, layer._udp_socket.getsockname())
+        deadline = time.time() + 5
+        while (not all(layer._bTCP_socket.batches for layer in layers)
+               and time.time() < deadline):
+            time.sleep(0.001)
+        self.assertEqual([layer._bTCP_socket.batches for layer in layers],
+                         [[[bytes([i]) * 10]] for i in range(4)])
+        time.sleep(btcp.constants.TIMER_TICK / 1000 * 2.5)
+        self.assertTrue(all(layer._bTCP_socket.ticks for layer in layers))
+
+    def test_destroy_cancels_timers(self):
+        reactor = btcp.reactor.Reactor()
+        peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        peer.bind(("127.0.0.1", 0))
+        self.addCleanup(peer.close)
+        layer = self._layer(reactor, peer)
+        fired = []
+        layer.timers.call_later(20_000_000, fired.append, 1)
+        layer.destroy()
+        ticks = layer._bTCP_socket.ticks
+        time.sleep(btcp.constants.TIMER_TICK / 1000 * 1.5)
+        self.assertEqual(fired, [])
+        self.assertEqual(layer._bTCP_socket.ticks, ticks)
+
+
+class Wakeup(unittest.TestCase):
+    """Tests for waking up the network thread, see btcp/wakeup.py."""
+
+    def _layer(self, **layer_kwargs):
+        peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        peer.bind(("127.0.0.1", 0))
+        self.addCleanup(peer.close)
+        layer = btcp.lossy_layer.LossyLayer(Reactor.TickingSocket(), "127.0.0.1", 0,
+                                            *peer.getsockname(), **layer_kwargs)
+        self.addCleanup(layer.destroy)
+        layer.start_network_thread()
+        return layer
+
+    def _assert_ticks_right_away(self, layer):
+        # Give the first tick time to pass.
+        time.sleep(btcp.constants.TIMER_TICK / 1000 * 1.2)
+        ticks = layer._bTCP_socket.ticks
+        layer.wakeup()
+        deadline = time.time() + btcp.constants.TIMER_TICK / 1000 / 2
+        while layer._bTCP_socket.ticks == ticks and time.time() < deadline:
+            time.sleep(0.001)
+        self.assertEqual(layer._bTCP_socket.ticks, ticks + 1)
+
+    def test_wakeup_ticks_right_away(self):
+        self._assert_ticks_right_away(self._layer(reactor=False))
+
+    def test_wakeup_ticks_right_away_on_reactor(self):
+        self._assert_ticks_right_away(self._layer(reactor=btcp.reactor.Reactor()))
+
+    def test_wakeup_ticks_right_away_busy_polling(self):
+        self._assert_ticks_right_away(self._layer(busy_poll=50))
+
+    def test_destroy_does_not_wait_for_a_tick(self):
+        layer = self._layer(reactor=False)
+        start = time.monotonic()
+        layer.destroy()
+        self.assertLess(time.monotonic() - start, btcp.constants.TIMER_TICK / 1000 / 2)
+
+    def test_wakeup_after_destroy_does_nothing(self):
+        for reactor in (False, btcp.reactor.Reactor()):
+            with self.subTest(reactor=bool(reactor)):
+                layer = self._layer(reactor=reactor)
+                layer.destroy()
+                layer.wakeup()
+
+    def test_earlier_timer_wakes_network_thread(self):
+        layer = self._layer(reactor=False)
+        fired = threading.Event()
+        start = time.monotonic()
+        layer.timers.call_later(1_000_000, fired.set)
+        self.assertTrue(fired.wait(5))
+        self.assertLess(time.monotonic() - start, btcp.constants.TIMER_TICK / 1000 / 2)
+
+
+class ImmediateTransmit(unittest.TestCase):
+    """Tests for sending data as soon as send() queued it or an ACK opened the
+    window, see BTCPClientSocket._transmit."""
+
+    class InFlight(btcp.lossy_layer.BasicHandler):
+        """Records the most segments the client had unacknowledged."""
+        def __init__(self, old_handler, client):
+            super().__init__(old_handler)
+            self._client = client
+            self.most = 0
+
+        def send_segment(self, segment):
+            self.most = max(self.most, len(self._client._unacked))
+            self._old_handler.send_segment(segment)
+
+    def _connect(self, server_window):
+        s = btcp.server_socket.BTCPServerSocket(server_window, DEFAULT_TIMEOUT)
+        c = btcp.client_socket.BTCPClientSocket(DEFAULT_WINDOW, DEFAULT_TIMEOUT)
+        self.addCleanup(s.close)
+        self.addCleanup(c.close)
+        accepting = threading.Thread(target=s.accept)
+        accepting.start()
+        c.connect()
+        accepting.join()
+        return c, s
+
+    def test_send_does_not_wait_for_a_tick(self):
+        c, s = self._connect(DEFAULT_WINDOW)
+        start = time.monotonic()
+        c.send(b"ping")
+        self.assertEqual(s._recvbuf.get(timeout=5), b"ping")
+        self.assertLess(time.monotonic() - start,
+                        btcp.constants.TIMER_TICK / 1000 / 2)
+
+    def test_data_sent_before_connect_waits_for_the_handshake(self):
+        s = btcp.server_socket.BTCPServerSocket(DEFAULT_WINDOW, DEFAULT_TIMEOUT)
+        c = btcp.client_socket.BTCPClientSocket(DEFAULT_WINDOW, DEFAULT_TIMEOUT)
+        self.addCleanup(s.close)
+        self.addCleanup(c.close)
+        seqnum = c._seqnum
+        c.send(b"early data")
+        # Give the network thread time to act on the wakeup.
+        time.sleep(btcp.constants.TIMER_TICK / 1000 / 4)
+        self.assertEqual((c._seqnum, c._unacked), (seqnum, {}))
+        accepting = threading.Thread(target=s.accept)
+        accepting.start()
+        c.connect()
+        accepting.join()
+        self.assertEqual(s._recvbuf.get(timeout=5), b"early data")
+
+    def test_acks_open_the_window(self):
+        c, s = self._connect(3)
+        with c._lossy_layer.effect(self.InFlight, c) as in_flight:
+            start = time.monotonic()
+            c.send(bytes(range(256)) * 4 * 20)
+            chunks = [s._recvbuf.get(timeout=5) for _ in range(21)]
+            elapsed = time.monotonic() - start
+        self.assertEqual(b"".join(chunks), bytes(range(256)) * 4 * 20)
+        self.assertLessEqual(in_flight.most, 3)
+        # Every chunk after the first three waits for an ACK, not a tick.
+        self.assertLess(elapsed, btcp.constants.TIMER_TICK / 1000 / 2)
+
+
+class TransmitThread(unittest.TestCase):
+    """Tests for the transmit thread in btcp/transmitter.py."""
+
+    def _receiver(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        receiver.settimeout(5)
+        self.addCleanup(receiver.close)
+        return receiver
+
+    def test_segments_are_sent_in_order(self):
+        receiver = self._receiver()
+        layer = btcp.lossy_layer.LossyLayer(LossyLayerBurst.RecordingSocket(),
+                                            "127.0.0.1", 0, *receiver.getsockname(),
+                                            transmit_thread=True)
+        self.addCleanup(layer.destroy)
+        layer.start_network_thread()
+        encoder = btcp.segment.SegmentEncoder()
+        layer.send_segments(encoder.encode(seqnum, 0, payload=b"x")
+                            for seqnum in range(100))
+        layer.send_segment(b"short")
+        received = [receiver.recv(2048) for _ in range(101)]
+        self.assertEqual([btcp.segment.SegmentView(segment).seqnum
+                          for segment in received[:-1]], list(range(100)))
+        self.assertEqual(received[-1], b"short")
+        layer.destroy()
+        stats = layer.statistics()["transmit"]
+        self.assertEqual((stats["queued"], stats["sent"], stats["dropped"]),
+                         (101, 101, 0))
+        self.assertEqual(stats["latency"]["count"], 101)
+        if stats["gso"]:
+            self.assertLess(stats["syscalls"], 101)
+
+    def test_full_queue_drops_and_stop_flushes(self):
+        receiver = self._receiver()
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.connect(receiver.getsockname())
+        self.addCleanup(sender.close)
+        transmitter = btcp.transmitter.Transmitter(sender, queue_size=2)
+        for segment in (b"a", b"b", b"c"):
+            transmitter.enqueue(segment)
+        self.assertEqual(transmitter.dropped, 1)
+        transmitter.start()
+        transmitter.stop()
+        self.assertEqual([receiver.recv(2048) for _ in range(2)], [b"a", b"b"])
+        transmitter.enqueue(b"d")
+        self.assertEqual(transmitter.dropped, 2)
+
+    def test_refused_earlier_datagram_is_retried(self):
+        receiver = self._receiver()
+        address = receiver.getsockname()
+        receiver.close()
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.connect(address)
+        self.addCleanup(sender.close)
+        # Nobody listens yet: the ICMP error is reported on the next call.
+        sender.send(b"lost")
+        time.sleep(0.05)
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(address)
+        receiver.settimeout(5)
+        self.addCleanup(receiver.close)
+        transmitter = btcp.transmitter.Transmitter(sender)
+        segments = [bytes([i]) * btcp.constants.SEGMENT_SIZE for i in range(3)]
+        for segment in segments:
+            transmitter.enqueue(segment)
+        transmitter.start()
+        transmitter.stop()
+        self.assertEqual([receiver.recv(2048) for _ in range(3)], segments)
+        self.assertEqual((transmitter.sent, transmitter.dropped), (3, 0))
+
+
+
+class MemoryTransport(unittest.TestCase):
+    """Tests for the in-process transport in btcp/memory_transport.py."""
+
+    def _pair(self):
+        MemoryLossyLayer = btcp.memory_transport.MemoryLossyLayer
+        a = MemoryLossyLayer(LossyLayerBurst.RecordingSocket(),
+                             "127.0.0.1", 1, "127.0.0.1", 2)
+        b = MemoryLossyLayer(LossyLayerBurst.RecordingSocket(),
+                             "127.0.0.1", 2, "127.0.0.1", 1)
+        self.addCleanup(a.destroy)
+        self.addCleanup(b.destroy)
+        a.start_network_thread()
+        b.start_network_thread()
+        return a, b
+
+    def _wait_for(self, recorder, count):
+        deadline = time.time() + 5
+        while sum(map(len, recorder.batches)) < count and time.time() < deadline:
+            time.sleep(0.001)
+        return sum(recorder.batches, [])
+
+    def test_segments_pass_through_effects(self):
+        a, b = self._pair()
+        encoder = btcp.segment.SegmentEncoder()
+        with a.effect(Duplication):
+            a.send_segments(encoder.encode(seqnum, 0) for seqnum in range(3))
+            a.send_segment(encoder.encode(3, 0))
+        received = self._wait_for(b._bTCP_socket, 8)
+        self.assertEqual([btcp.segment.SegmentView(s).seqnum for s in received],
+                         [0, 0, 1, 1, 2, 2, 3, 3])
+        self.assertTrue(a.trusted)
+
+    def test_full_inbox_drops_under_concurrent_senders(self):
+        MemoryLossyLayer = btcp.memory_transport.MemoryLossyLayer
+        a = MemoryLossyLayer(LossyLayerBurst.RecordingSocket(),
+                             "127.0.0.1", 3, "127.0.0.1", 4)
+        b = MemoryLossyLayer(LossyLayerBurst.RecordingSocket(),
+                             "127.0.0.1", 4, "127.0.0.1", 3, inbox_size=100)
+        self.addCleanup(a.destroy)
+        self.addCleanup(b.destroy)
+        segment = bytes(btcp.constants.SEGMENT_SIZE)
+
+        def send():
+            for _ in range(1000):
+                a.send_segment(segment)
+
+        # b's network thread is not running, so nothing drains its inbox.
+        senders = [threading.Thread(target=send) for _ in range(4)]
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+        self.assertEqual((len(b._inbox), b.dropped), (100, 3900))
+
+    def test_address_in_use(self):
+        a, b = self._pair()
+        with self.assertRaises(OSError):
+            btcp.memory_transport.MemoryLossyLayer(
+                LossyLayerBurst.RecordingSocket(), "localhost", 1, "127.0.0.1", 2)
+
+    def test_sockets_connect_in_process(self):
+        s = btcp.server_socket.BTCPServerSocket(DEFAULT_WINDOW, DEFAULT_TIMEOUT,
+                                                trusted_transport=True,
+                                                transport="memory")
+        c = btcp.client_socket.BTCPClientSocket(DEFAULT_WINDOW, DEFAULT_TIMEOUT,
+                                                trusted_transport=True,
+                                                transport="memory")
+        try:
+            accepting = threading.Thread(target=s.accept)
+            accepting.start()
+            c.connect()
+            accepting.join()
+            self.assertTrue(c._skip_checksum)
+            self.assertTrue(s._skip_checksum)
+        finally:
+            c.close()
+            s.close()
+
+
+
+@unittest.skipUnless(btcp.shm_transport.SUPPORTED, "needs Linux on x86")
+class SharedMemoryTransport(unittest.TestCase):
+    """Tests for the shared memory transport in btcp/shm_transport.py."""
+
+    _wait_for = MemoryTransport._wait_for
+
+    def _ports(self, count):
+        """Ports no other test run on this host uses at the same time: those
+        of UDP sockets that stay bound until the test ends."""
+        ports = []
+        for _ in range(count):
+            reservation = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            reservation.bind(("127.0.0.1", 0))
+            self.addCleanup(reservation.close)
+            ports.append(reservation.getsockname()[1])
+        return ports
+
+    def _layer(self, local_port, remote_port):
+        layer = btcp.shm_transport.SharedMemoryLossyLayer(
+            LossyLayerBurst.RecordingSocket(),
+            "127.0.0.1", local_port, "127.0.0.1", remote_port)
+        self.addCleanup(layer.destroy)
+        layer.start_network_thread()
+        return layer
+
+    def test_segments_pass_through_rings(self):
+        a_port, b_port = self._ports(2)
+        a = self._layer(a_port, b_port)
+        encoder = btcp.segment.SegmentEncoder()
+        # Nobody has created the peer's ring yet.
+        a.send_segment(encoder.encode(0, 0))
+        b = self._layer(b_port, a_port)
+        with a.effect(Duplication):
+            a.send_segments(encoder.encode(seqnum, 0, payload=b"x" * seqnum)
+                            for seqnum in range(1, 4))
+        b.send_segment(encoder.encode(9, 0))
+        received = self._wait_for(b._bTCP_socket, 6)
+        self.assertEqual([btcp.segment.SegmentView(s).seqnum for s in received],
+                         [1, 1, 2, 2, 3, 3])
+        self.assertEqual(bytes(btcp.segment.SegmentView(received[-1]).payload),
+                         b"xxx")
+        received = self._wait_for(a._bTCP_socket, 1)
+        self.assertEqual(btcp.segment.SegmentView(received[0]).seqnum, 9)
+        self.assertTrue(a.trusted)
+
+    def test_full_ring_drops(self):
+        a_port, b_port = self._ports(2)
+        a = self._layer(a_port, b_port)
+        b = btcp.shm_transport.SharedMemoryLossyLayer(
+            LossyLayerBurst.RecordingSocket(),
+            "127.0.0.1", b_port, "127.0.0.1", a_port)
+        self.addCleanup(b.destroy)
+        segment = bytes(btcp.constants.SEGMENT_SIZE)
+        # b's network thread is not running, so nothing drains its ring.
+        a.send_segments([segment] * (btcp.shm_transport.RING_SLOTS + 10))
+        self.assertEqual(a.dropped, 10)
+        b.start_network_thread()
+        received = self._wait_for(b._bTCP_socket, btcp.shm_transport.RING_SLOTS)
+        self.assertEqual(len(received), btcp.shm_transport.RING_SLOTS)
+
+    def test_ring_is_replaced(self):
+        a_port, b_port = self._ports(2)
+        a = self._layer(a_port, b_port)
+        b = self._layer(b_port, a_port)
+        a.send_segment(bytes(btcp.constants.SEGMENT_SIZE))
+        self._wait_for(b._bTCP_socket, 1)
+        b.destroy()
+        self.assertFalse(os.path.exists(f"/dev/shm/btcp-127.0.0.1-{b_port}"))
+        b = self._layer(b_port, a_port)
+        a.send_segment(bytes(btcp.constants.SEGMENT_SIZE))
+        self.assertEqual(len(self._wait_for(b._bTCP_socket, 1)), 1)
+
+    def test_sockets_connect_across_processes(self):
+        barrier = multiprocessing.Barrier(2)
+        run_in_separate_processes((barrier,),
+                                  SharedMemoryTransport._connect_client,
+                                  SharedMemoryTransport._connect_server)
+
+    @staticmethod
+    def _connect_client(barrier):
+        # Only connect once the server's ring exists.
+        barrier.wait()
+        c = btcp.client_socket.BTCPClientSocket(DEFAULT_WINDOW, DEFAULT_TIMEOUT,
+                                                trusted_transport=True,
+                                                transport="shm")
+        c.connect()
+        assert c._skip_checksum
+        c.close()
+
+    @staticmethod
+    def _connect_server(barrier):
+        s = btcp.server_socket.BTCPServerSocket(DEFAULT_WINDOW, DEFAULT_TIMEOUT,
+                                                trusted_transport=True,
+                                                transport="shm")
+        barrier.wait()
+        s.accept()
+        assert s._skip_checksum
+        s.close()
+
+
+
+
+class UnixTransport(unittest.TestCase):
+    """Tests for the AF_UNIX transport in btcp/unix_transport.py."""
+
+    _wait_for = MemoryTransport._wait_for
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def _layer(self, local, remote, start=True):
+        layer = btcp.unix_transport.UnixLossyLayer(
+            LossyLayerBurst.RecordingSocket(), "127.0.0.1", 0, "127.0.0.1", 0,
+            local_path=os.path.join(self.directory, local),
+            remote_path=os.path.join(self.directory, remote))
+        self.addCleanup(layer.destroy)
+        if start:
+            layer.start_network_thread()
+        return layer
+
+    def test_segments_pass_through_effects(self):
+        a = self._layer("a", "b")
+        encoder = btcp.segment.SegmentEncoder()
+        # b is not there yet.
+        a.send_segment(encoder.encode(0, 0))
+        b = self._layer("b", "a")
+        with a.effect(Duplication):
+            a.send_segments(encoder.encode(seqnum, 0) for seqnum in range(1, 4))
+        b.send_segment(encoder.encode(9, 0))
+        received = self._wait_for(b._bTCP_socket, 6)
+        self.assertEqual([btcp.segment.SegmentView(s).seqnum for s in received],
+                         [1, 1, 2, 2, 3, 3])
+        received = self._wait_for(a._bTCP_socket, 1)
+        self.assertEqual(btcp.segment.SegmentView(received[0]).seqnum, 9)
+        self.assertTrue(a.trusted)
+
+    def test_full_queue_drops(self):
+        a = self._layer("a", "b")
+        # b's network thread is not running, so nothing drains its queue.
+        b = self._layer("b", "a", start=False)
+        a.send_segments([bytes(btcp.constants.SEGMENT_SIZE)] * 1000)
+        dropped = a.statistics()["dropped"]
+        self.assertGreater(dropped, 0)
+        # Connected both ways, the queue holds more than max_dgram_qlen.
+        self.assertLess(dropped, 1000 - 11)
+
+    def test_stale_path_is_replaced(self):
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        stale.bind(os.path.join(self.directory, "a"))
+        stale.close()
+        a = self._layer("a", "b")
+        with self.assertRaises(OSError):
+            self._layer("a", "b")
+        a.destroy()
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "a")))
+
+    def test_sockets_connect(self):
+        os.environ["BTCP_UNIX_DIR"] = self.directory
+        self.addCleanup(os.environ.pop, "BTCP_UNIX_DIR")
+        s = btcp.server_socket.BTCPServerSocket(DEFAULT_WINDOW, DEFAULT_TIMEOUT,
+                                                trusted_transport=True,
+                                                transport="unix")
+        c = btcp.client_socket.BTCPClientSocket(DEFAULT_WINDOW, DEFAULT_TIMEOUT,
+                                                trusted_transport=True,
+                                                transport="unix")
+        try:
+            accepting = threading.Thread(target=s.accept)
+            accepting.start()
+            c.connect()
+            accepting.join()
+            self.assertTrue(c._skip_checksum)
+            self.assertTrue(s._skip_checksum)
+        finally:
+            c.close()
+            s.close()
+
+
+
+class AsyncSockets(unittest.TestCase):
+    """Tests for the asyncio sockets in btcp/async_socket.py."""
+
+    def test_transfer_on_one_event_loop(self):
+        async def transfer():
+            s = btcp.async_socket.AsyncBTCPServerSocket(DEFAULT_WINDOW, DEFAULT_TIMEOUT)
+            c = btcp.async_socket.AsyncBTCPClientSocket(DEFAULT_WINDOW, DEFAULT_TIMEOUT)
+            try:
+                await asyncio.wait_for(asyncio.gather(s.accept(), c.connect()), 5)
+                data = random.Random(6).randbytes(10000)
+                self.assertEqual(await c.send(data), len(data))
+                received = bytearray()
+                while len(received) < len(data):
+                    chunk = await s.recv()
+                    self.assertTrue(chunk)
+                    received += chunk
+                self.assertEqual(received, data)
+                await asyncio.wait_for(c.shutdown(), 5)
+            finally:
+                c.close()
+                s.close()
+        asyncio.run(transfer())
+
+
+
+
 class Identity(btcp.lossy_layer.BasicHandler):
     """Handler creator that does nothing in particular"""
     pass